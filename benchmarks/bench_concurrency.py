@@ -0,0 +1,114 @@
+"""
+Measures command throughput as the per-command-type concurrency limit grows.
+
+Issues a batch of "update_file_list" commands against a fake shell client that
+takes a fixed amount of time to respond, and reports commands per second for
+each concurrency limit. No satellite or Major Tom connection is needed.
+
+Usage: python3 benchmarks/bench_concurrency.py [--commands 32] [--latency 0.2]
+"""
+import argparse
+import asyncio
+import os
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from majortom_gateway.command import Command  # noqa: E402
+from kubos_sat import KubosSat  # noqa: E402
+
+FAKE_SHELL_CLIENT = """#!/bin/sh
+if [ "$1" = "--help" ]; then exit 0; fi
+sleep {latency}
+echo "-rw-r--r--    1 kubos    kubos         1024 Jan  1 00:00 file.txt"
+"""
+
+KUBOS_CONFIG = """
+[shell-service.addr]
+ip = "127.0.0.1"
+port = 8050
+"""
+
+
+class FakeGateway:
+    def __init__(self):
+        self.completed = 0
+        self.failed = []
+
+    async def transmit_command_update(self, command_id, state, dict={}):
+        pass
+
+    async def complete_command(self, command_id, output):
+        self.completed += 1
+
+    async def fail_command(self, command_id, errors):
+        self.failed.append(errors)
+
+    async def update_file_list(self, system, files, timestamp=None):
+        pass
+
+    async def update_command_definitions(self, system, definitions):
+        pass
+
+
+def write_file(directory, name, content, executable=False):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write(content)
+    if executable:
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+async def run_batch(workdir, shell_client, commands, limit):
+    satellite = KubosSat(
+        name="Bench Sat",
+        ip="127.0.0.1",
+        sat_config_path=write_file(workdir, "config.toml", KUBOS_CONFIG),
+        shell_client_path=shell_client,
+        file_list_directories=["/home/kubos/"],
+        command_limits={"update_file_list": limit})
+    satellite.build_command_definitions(satellite.load_config())
+    gateway = FakeGateway()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        satellite.command_callback(
+            command=Command({
+                "id": i,
+                "type": "update_file_list",
+                "system": satellite.name,
+                "fields": [{"name": "directory_to_update", "value": "All Directories"}]}),
+            gateway=gateway)
+        for i in range(commands)])
+    elapsed = time.perf_counter() - start
+
+    if gateway.failed:
+        raise RuntimeError(f"Commands failed: {gateway.failed[0]}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Seconds the fake shell client takes to respond")
+    parser.add_argument("--limits", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        shell_client = write_file(
+            workdir, "fake-shell-client",
+            FAKE_SHELL_CLIENT.format(latency=args.latency),
+            executable=True)
+        print(f"{'limit':>6} {'seconds':>9} {'commands/s':>11}")
+        for limit in args.limits:
+            elapsed = asyncio.run(run_batch(workdir, shell_client, args.commands, limit))
+            print(f"{limit:>6} {elapsed:>9.2f} {args.commands / elapsed:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares parsing a large directory listing in the "stat" and "ls" file list modes.
+
+Generates the output the shell service would return for a directory with the given
+number of files in each mode, and times kubos_sat.shell_service.parse_stat_output
+against parse_ls_output.
+
+Usage: python3 benchmarks/bench_listing.py [--entries 100000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kubos_sat.shell_service import parse_ls_output, parse_stat_output  # noqa: E402
+
+DIRECTORY = "/var/log/"
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def ls_listing(entries):
+    lines = [f"total {entries * 4}"]
+    for i in range(entries):
+        if i % 2:
+            date = f"{MONTHS[i % 12]} {i % 28 + 1:>2} {i % 24:02}:{i % 60:02}"
+        else:
+            date = f"{MONTHS[i % 12]} {i % 28 + 1:>2}  2019"
+        lines.append(f"-rw-r--r--    1 kubos    kubos     {i * 37 % 1000000:>8} {date} app-{i}.log")
+    return "\n".join(lines) + "\n"
+
+
+def stat_listing(entries):
+    lines = [
+        f"regular file|{i * 37 % 1000000}|{1546300800 + i * 600}|{DIRECTORY}app-{i}.log"
+        for i in range(entries)]
+    return "\n".join(lines) + "\n"
+
+
+def best_time(parse, file_output, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        files = parse(directory=DIRECTORY, file_output=file_output)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(files)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'mode':>5} {'entries':>8} {'files':>8} {'best ms':>9}")
+    for mode, parse, file_output in (
+            ("ls", parse_ls_output, ls_listing(args.entries)),
+            ("stat", parse_stat_output, stat_listing(args.entries))):
+        elapsed, files = best_time(parse, file_output, args.repeat)
+        print(f"{mode:>5} {args.entries:>8} {files:>8} {elapsed * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Compares the gateway's time from launch until it's ready to resolve commands.
+
+Each startup runs in a fresh process against a generated KubOS config and stand-in
+file and shell client binaries whose --help takes the given number of seconds:
+- "sequential" imports everything up front, then parses the config and probes each client in turn
+- "concurrent" is run.py's pipeline, which imports majortom_gateway while the config is
+  parsed and the clients are probed concurrently
+
+The time is measured from launching the process, so interpreter startup is included.
+
+Usage: python3 benchmarks/bench_startup.py [--probe-seconds 0.2] [--repeat 5]
+"""
+import argparse
+import asyncio
+import importlib
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+KUBOS_CONFIG = """
+[file-transfer-service]
+downlink_ip = "127.0.0.1"
+downlink_port = 8080
+[file-transfer-service.addr]
+ip = "127.0.0.1"
+port = 8040
+[shell-service.addr]
+ip = "127.0.0.1"
+port = 8050
+"""
+
+
+def write_fixtures(directory, probe_seconds):
+    config_path = os.path.join(directory, "config.toml")
+    with open(config_path, "w") as f:
+        f.write(KUBOS_CONFIG)
+    client_paths = []
+    for name in ("kubos-file-client", "kubos-shell-client"):
+        client_path = os.path.join(directory, name)
+        with open(client_path, "w") as f:
+            f.write(f"#!/bin/sh\nsleep {probe_seconds}\n")
+        os.chmod(client_path, os.stat(client_path).st_mode | stat.S_IXUSR)
+        client_paths.append(client_path)
+    return config_path, client_paths
+
+
+def start(mode, directory):
+    """Runs in a child process and prints "ready" once commands can be resolved"""
+    config_path, (file_client_path, shell_client_path) = (
+        os.path.join(directory, "config.toml"),
+        (os.path.join(directory, "kubos-file-client"), os.path.join(directory, "kubos-shell-client")))
+
+    if mode == "sequential":
+        from majortom_gateway import GatewayAPI
+        from kubos_sat import KubosSat
+        satellite = KubosSat(
+            name="bench", ip="127.0.0.1", sat_config_path=config_path,
+            file_client_path=file_client_path, shell_client_path=shell_client_path,
+            file_list_directories=["/home/kubos"])
+        GatewayAPI(host="127.0.0.1", gateway_token="bench", command_callback=satellite.command_callback)
+        satellite.build_command_definitions(satellite.load_config())
+    else:
+        from kubos_sat import KubosSat
+        from kubos_sat import executor
+
+        async def start_gateway():
+            satellite = KubosSat(
+                name="bench", ip="127.0.0.1", sat_config_path=config_path,
+                file_client_path=file_client_path, shell_client_path=shell_client_path,
+                file_list_directories=["/home/kubos"])
+            preparation = satellite.prepare()
+            majortom_gateway = await executor.run_blocking(importlib.import_module, "majortom_gateway")
+            majortom_gateway.GatewayAPI(
+                host="127.0.0.1", gateway_token="bench", command_callback=satellite.command_callback)
+            await preparation
+            return satellite
+
+        satellite = asyncio.get_event_loop().run_until_complete(start_gateway())
+    assert "uplink_file" in satellite.definitions and "update_file_list" in satellite.definitions
+    print("ready", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--probe-seconds", type=float, default=0.2,
+                        help="How long each stand-in client binary takes to answer --help")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        start(*args.child)
+        return
+
+    print(f"{'mode':>11} {'probe s':>8} {'best s':>7} {'mean s':>7}")
+    with tempfile.TemporaryDirectory() as directory:
+        write_fixtures(directory, args.probe_seconds)
+        for mode in ("sequential", "concurrent"):
+            times = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                process = subprocess.Popen(
+                    [sys.executable, __file__, "--child", mode, directory],
+                    stdout=subprocess.PIPE, cwd=ROOT)
+                line = process.stdout.readline()
+                times.append(time.perf_counter() - started)
+                process.wait()
+                if line.strip() != b"ready":
+                    raise RuntimeError(f"{mode} startup failed with exit code {process.returncode}")
+            print(f"{mode:>11} {args.probe_seconds:>8} {min(times):>7.2f} {sum(times) / len(times):>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
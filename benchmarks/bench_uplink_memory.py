@@ -0,0 +1,109 @@
+"""
+Compares peak gateway memory when fetching a staged file from Major Tom for uplink.
+
+A local HTTP server stands in for Major Tom and serves a generated file of the requested
+size. Each download mode runs in its own process so its peak RSS can be measured on its own:
+- "buffered" uses GatewayAPI.download_staged_file, which returns the whole file as bytes
+- "streaming" uses kubos_sat.major_tom.download_staged_file, which writes it to disk in chunks
+
+Usage: python3 benchmarks/bench_uplink_memory.py [--sizes 16 64 256]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web  # noqa: E402
+
+BLOCK = b"kubos" * 13107 + b"k"  # 64 KiB
+
+
+def serve(port, ready):
+    async def staged_file(request):
+        size = int(request.match_info["size"])
+        response = web.StreamResponse(headers={
+            "Content-Disposition": f'attachment; filename="image-{size}.bin"; filename*=UTF-8\'\'image.bin',
+            "Content-Length": str(size)})
+        await response.prepare(request)
+        remaining = size
+        while remaining > 0:
+            block = BLOCK[:min(remaining, len(BLOCK))]
+            await response.write(block)
+            remaining -= len(block)
+        return response
+
+    async def start():
+        app = web.Application()
+        app.router.add_get("/staged/{size}", staged_file)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        ready.set()
+        while True:
+            await asyncio.sleep(3600)
+
+    asyncio.run(start())
+
+
+def download(mode, port, size, directory):
+    """Runs in a child process and prints its peak RSS in MiB"""
+    from majortom_gateway import GatewayAPI
+    from kubos_sat import major_tom
+
+    gateway = GatewayAPI(host=f"127.0.0.1:{port}", gateway_token="bench", http=True)
+    start = time.perf_counter()
+    if mode == "buffered":
+        filename, content = gateway.download_staged_file(gateway_download_path=f"/staged/{size}")
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write(content)
+    else:
+        async def stream():
+            try:
+                return await major_tom.download_staged_file(
+                    gateway=gateway, gateway_download_path=f"/staged/{size}", directory=directory)
+            finally:
+                await major_tom.get_session().close()
+        asyncio.run(stream())
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{peak_rss:.1f} {elapsed:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 64, 256],
+                        help="File sizes to fetch, in MiB")
+    parser.add_argument("--port", type=int, default=18400)
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, size, directory = args.child
+        download(mode, args.port, int(size), directory)
+        return
+
+    ready = threading.Event()
+    threading.Thread(target=serve, args=(args.port, ready), daemon=True).start()
+    ready.wait()
+
+    print(f"{'size MiB':>9} {'mode':>10} {'peak RSS MiB':>13} {'seconds':>8}")
+    for size_mib in args.sizes:
+        for mode in ("buffered", "streaming"):
+            with tempfile.TemporaryDirectory() as directory:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--port", str(args.port),
+                     "--child", mode, str(size_mib * 1024 * 1024), directory],
+                    capture_output=True, check=True)
+            peak_rss, elapsed = output.stdout.decode().split()
+            print(f"{size_mib:>9} {mode:>10} {peak_rss:>13} {elapsed:>8}")
+
+
+if __name__ == "__main__":
+    main()
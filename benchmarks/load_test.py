@@ -0,0 +1,254 @@
+"""
+Load test of KubosSat.command_callback against local stand-ins for the satellite and Major Tom.
+
+Commands are issued at the given rate (with exponentially distributed gaps) for the given
+duration, picked at random from a weighted mix of command types:
+- downlink_file: downlinks a file through the fake file client and uploads it to the fake Major Tom
+- uplink_file: downloads a staged file from the fake Major Tom and uplinks it through the fake file client
+- update_file_list: lists the satellite's directories through the fake shell client
+- app: starts an app through the fake app service
+- graphql: sends a raw telemetry query to the fake monitor service
+
+With --native-file-client, file transfers go through the native file protocol client to a fake
+file transfer service instead, which drops --link-loss of the chunks.
+
+Reports throughput, p50/p99 latency per command type and the gateway's peak RSS. The stand-in servers
+run in their own process, so they aren't included in it. With --max-p99, --min-throughput or
+--max-failures, it exits with status 1 when a result is past its threshold, so it can run in CI.
+
+Usage: python3 benchmarks/load_test.py [--rate 20] [--duration 10] [--mix downlink_file=1 update_file_list=1 app=2 graphql=2]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from majortom_gateway.command import Command  # noqa: E402
+from kubos_sat import KubosSat, graphql, major_tom, metrics  # noqa: E402
+from kubos_sat import command_updates, file_protocol  # noqa: E402
+import standins  # noqa: E402
+
+KUBOS_CONFIG = """
+[file-transfer-service]
+downlink_ip = "127.0.0.1"
+downlink_port = 8080
+[file-transfer-service.addr]
+ip = "127.0.0.1"
+port = 8040
+[shell-service.addr]
+ip = "127.0.0.1"
+port = 8050
+[app-service.addr]
+ip = "127.0.0.1"
+port = {graphql_port}
+[monitor-service.addr]
+ip = "127.0.0.1"
+port = {graphql_port}
+"""
+
+COMMAND_TYPES = ["downlink_file", "uplink_file", "update_file_list", "app", "graphql"]
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def make_satellite(workdir, satellite_dir, args):
+    file_client, shell_client = standins.write_clients(
+        workdir, latency=args.client_latency, throughput=args.link_throughput)
+    config_path = os.path.join(workdir, "config.toml")
+    with open(config_path, "w") as f:
+        f.write(KUBOS_CONFIG.format(graphql_port=args.graphql_port))
+    directories = []
+    for index in range(args.directories):
+        directory = os.path.join(satellite_dir, f"dir{index}") + "/"
+        os.makedirs(directory)
+        for file_index in range(args.files_per_directory):
+            with open(os.path.join(directory, f"file{file_index}.bin"), "wb") as f:
+                f.write(b"k" * args.file_size)
+        directories.append(directory)
+    return KubosSat(
+        name="Bench Sat",
+        ip="127.0.0.1",
+        sat_config_path=config_path,
+        file_client_path=file_client,
+        shell_client_path=shell_client,
+        file_list_directories=directories,
+        default_uplink_dir=os.path.join(satellite_dir, "uplinked") + "/",
+        command_limits={"update_kubos_config_toml": 1, "command_definitions_update": 1},
+        default_command_limit=args.command_limit,
+        transfer_workers=args.transfer_workers)
+
+
+def make_command(command_id, command_type, satellite, args, rng):
+    if command_type == "downlink_file":
+        directory = rng.choice(satellite.file_list_directories)
+        fields = {"filename": f"{directory}file{rng.randrange(args.files_per_directory)}.bin", "priority": "normal"}
+    elif command_type == "uplink_file":
+        fields = {
+            "gateway_download_path": f"/staged/{args.file_size}",
+            "destination_directory": satellite.default_uplink_dir,
+            "destination_name": f"uplink{command_id}.bin",
+            "register_as_mission_app": "no",
+            "priority": "normal"}
+    elif command_type == "update_file_list":
+        fields = {"directory_to_update": "All Directories", "full_list": "no"}
+    elif command_type == "app":
+        command_type = standins.APPS[0]["app"]["name"]
+        fields = {"args": "--bench"}
+    else:
+        command_type = "graphql-monitor-service"
+        fields = {
+            "ip": "127.0.0.1", "port": str(args.graphql_port),
+            "query": "{ memInfo { total free available } }", "variables": None}
+    return Command({
+        "id": command_id,
+        "type": command_type,
+        "system": satellite.name,
+        "fields": [{"name": name, "value": value} for name, value in fields.items()]})
+
+
+async def run(args, mix):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        satellite_dir = os.path.join(workdir, "satellite")
+        os.makedirs(os.path.join(satellite_dir, "uplinked"))
+        satellite = make_satellite(workdir, satellite_dir, args)
+        gateway = standins.FakeGateway(major_tom_port=args.major_tom_port, send_latency=args.send_latency)
+        satellite.command_updates = command_updates.CommandUpdateChannel(
+            gateway=gateway, flush_interval=args.flush_interval)
+        satellite.command_updates.start()
+        await satellite.prepare()
+        await satellite.fetch_apps(gateway=gateway)
+
+        types = list(mix)
+        weights = [mix[command_type] for command_type in types]
+        started = {}
+        kinds = {}
+        tasks = []
+        start = time.perf_counter()
+        command_id = 0
+        while time.perf_counter() - start < args.duration:
+            command_type = rng.choices(types, weights)[0]
+            command = make_command(command_id, command_type, satellite, args, rng)
+            started[command_id] = time.perf_counter()
+            kinds[command_id] = command_type
+            tasks.append(asyncio.ensure_future(satellite.command_callback(command=command, gateway=gateway)))
+            command_id += 1
+            await asyncio.sleep(rng.expovariate(args.rate))
+        issued = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+        await satellite.command_updates.stop()
+        elapsed = time.perf_counter() - start
+        await graphql.client.close()
+        await major_tom.get_session().close()
+
+    results = {}
+    for command_type in types + ["all"]:
+        ids = [i for i in kinds if command_type in ("all", kinds[i])]
+        latencies = [gateway.finished[i][1] - started[i] for i in ids if i in gateway.finished]
+        results[command_type] = {
+            "commands": len(ids),
+            "failed": sum(1 for i in ids if gateway.finished.get(i, ("",))[0] != "completed"),
+            "throughput": len(ids) / elapsed,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99)}
+    results["all"]["issue_seconds"] = issued
+    results["all"]["total_seconds"] = elapsed
+    results["all"]["messages"] = gateway.messages
+    results["all"]["peak_rss_mib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return results, gateway.errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=20, help="Commands issued per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to issue commands for")
+    parser.add_argument("--mix", nargs="+", default=["downlink_file=1", "update_file_list=1", "app=2", "graphql=2"],
+                        help=f"Weights of each command type, from: {', '.join(COMMAND_TYPES)}")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--client-latency", type=float, default=0.05, help="Seconds each fake client call takes")
+    parser.add_argument("--link-throughput", type=float, default=10e6, help="Bytes per second of fake file transfers")
+    parser.add_argument("--graphql-latency", type=float, default=0.01)
+    parser.add_argument("--major-tom-latency", type=float, default=0.01)
+    parser.add_argument("--send-latency", type=float, default=0, help="Seconds each message to Major Tom takes")
+    parser.add_argument("--flush-interval", type=float, default=command_updates.DEFAULT_FLUSH_INTERVAL,
+                        help="Seconds between sends of queued command updates. Latencies include the wait for it.")
+    parser.add_argument("--native-file-client", action="store_true",
+                        help="Transfer files with the native file protocol client and a fake file transfer service")
+    parser.add_argument("--link-loss", type=float, default=0,
+                        help="Fraction of file protocol chunks the fake file transfer service drops")
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--directories", type=int, default=4)
+    parser.add_argument("--files-per-directory", type=int, default=50)
+    parser.add_argument("--transfer-workers", type=int, default=2)
+    parser.add_argument("--command-limit", type=int, default=None)
+    parser.add_argument("--graphql-port", type=int, default=18600)
+    parser.add_argument("--major-tom-port", type=int, default=18601)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--metrics", action="store_true", help="Print the gateway's own metrics afterwards")
+    parser.add_argument("--max-p99", type=float, help="Fail if the overall p99 latency is above this many seconds")
+    parser.add_argument("--min-throughput", type=float, help="Fail if fewer commands per second complete")
+    parser.add_argument("--max-failures", type=int, help="Fail if more commands than this don't complete")
+    args = parser.parse_args()
+
+    mix = {}
+    for entry in args.mix:
+        command_type, _, weight = entry.partition("=")
+        if command_type not in COMMAND_TYPES:
+            parser.error(f"Unknown command type in --mix: {command_type}")
+        mix[command_type] = float(weight or 1)
+
+    servers = standins.serve_in_process(
+        graphql_port=args.graphql_port, major_tom_port=args.major_tom_port,
+        graphql_latency=args.graphql_latency, major_tom_latency=args.major_tom_latency)
+    file_service = None
+    if args.native_file_client:
+        file_protocol.configure(enabled=True)
+        file_service = standins.serve_file_service_in_process(port=8040, loss=args.link_loss)
+    try:
+        results, errors = asyncio.run(run(args, mix))
+    finally:
+        servers.terminate()
+        if file_service is not None:
+            file_service.terminate()
+
+    print(f"{'command':>17} {'count':>6} {'failed':>6} {'per s':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for command_type, result in results.items():
+        print(f"{command_type:>17} {result['commands']:>6} {result['failed']:>6} {result['throughput']:>7.1f} "
+              f"{result['p50'] * 1000:>8.1f} {result['p99'] * 1000:>8.1f}")
+    overall = results["all"]
+    print(f"Issued for {overall['issue_seconds']:.1f}s, all finished after {overall['total_seconds']:.1f}s. "
+          f"{overall['messages']} messages to Major Tom. Peak RSS {overall['peak_rss_mib']:.1f} MiB")
+    if errors:
+        print(f"First failure: {next(iter(errors.values()))}")
+    if args.metrics:
+        print(metrics.registry.render())
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.max_p99 is not None and overall["p99"] > args.max_p99:
+        regressions.append(f"p99 latency {overall['p99']:.3f}s is above {args.max_p99}s")
+    if args.min_throughput is not None and overall["throughput"] < args.min_throughput:
+        regressions.append(f"throughput {overall['throughput']:.1f}/s is below {args.min_throughput}/s")
+    if args.max_failures is not None and overall["failed"] > args.max_failures:
+        regressions.append(f"{overall['failed']} commands failed, more than {args.max_failures}")
+    if regressions:
+        print("FAILED: " + "; ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+Local stand-ins for a KubOS satellite and Major Tom, shared by the benchmarks.
+
+- FakeGateway replaces GatewayAPI. It records when each command finished and how, and can
+  take a fixed time to send each message to simulate a slow websocket.
+- serve_in_process starts a fake KubOS GraphQL service (app-service and telemetry queries)
+  and a fake Major Tom file API in a separate process, so they don't compete with the gateway
+  for the event loop or count towards its memory use.
+- write_clients writes fake kubos-file-client and kubos-shell-client executables with a
+  configurable latency and throughput. The "satellite" is a local directory: the shell client
+  runs commands locally and the file client copies files in and out of it.
+- serve_file_service_in_process starts a fake KubOS file transfer service speaking the UDP file
+  protocol, for the native client. It also reads and writes local paths, and can drop a fraction
+  of the chunks it sends and receives to simulate a lossy link.
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import stat
+import time
+
+from kubos_sat.graphql import _matching_close, _tokenize
+from kubos_sat import file_protocol
+
+FAKE_FILE_CLIENT = """#!/bin/sh
+# Usage: kubos-file-client -h host -P port -r ip -p port (upload|download) source destination
+[ "$1" = "--help" ] && exit 0
+size=$(wc -c < "${{10}}")
+sleep $(awk "BEGIN {{ print {latency} + $size / {throughput} }}")
+cp "${{10}}" "${{11}}"
+echo "Transfer complete: $size bytes"
+"""
+
+FAKE_SHELL_CLIENT = """#!/bin/sh
+# Usage: kubos-shell-client -i ip -p port run -c command
+[ "$1" = "--help" ] && exit 0
+sleep {latency}
+exec sh -c "$7"
+"""
+
+APPS = [{
+    "active": True,
+    "app": {"name": "bench-app", "executable": "/home/kubos/apps/bench-app", "config": "", "version": "1.0", "author": "bench"}}]
+
+
+def write_clients(directory, latency=0.05, throughput=1e6):
+    """
+    Writes fake client binaries to the directory and returns their paths.
+    Each call takes latency seconds, plus the file size divided by throughput (bytes per second) for transfers.
+    """
+    paths = []
+    for name, script in (("kubos-file-client", FAKE_FILE_CLIENT), ("kubos-shell-client", FAKE_SHELL_CLIENT)):
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write(script.format(latency=latency, throughput=throughput))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        paths.append(path)
+    return paths
+
+
+def root_fields(query):
+    """Yields the response key and field name of each root field of a GraphQL document"""
+    tokens = _tokenize(query)
+    start = next(index for index, token in enumerate(tokens) if token[1] == "{")
+    index = start + 1
+    end = _matching_close(tokens, start)
+    while index < end:
+        key = field = tokens[index][1]
+        if tokens[index + 1][1] == ":":
+            field = tokens[index + 2][1]
+            index += 2
+        yield key, field
+        index += 1
+        # Skip the arguments and selection set
+        while index < end and tokens[index][1] in ("(", "{"):
+            index = _matching_close(tokens, index) + 1
+
+
+def resolve_field(field):
+    if field == "registeredApps":
+        return APPS
+    if field == "memInfo":
+        return {"total": 4096000, "free": 1024000, "available": 2048000 + int(time.time()) % 1000}
+    if field == "ping":
+        return "pong"
+    return {"success": True, "errors": "", "pid": 1234}
+
+
+async def serve(graphql_port, major_tom_port, graphql_latency, major_tom_latency):
+    from aiohttp import web
+
+    async def graphql(request):
+        body = await request.json()
+        await asyncio.sleep(graphql_latency)
+        return web.json_response({"data": {key: resolve_field(field) for key, field in root_fields(body["query"])}})
+
+    async def staged_file(request):
+        size = int(request.match_info["size"])
+        await asyncio.sleep(major_tom_latency)
+        response = web.StreamResponse(headers={
+            "Content-Disposition": f'attachment; filename="staged-{size}.bin"; filename*=UTF-8\'\'staged.bin',
+            "Content-Length": str(size)})
+        await response.prepare(request)
+        block = b"k" * 65536
+        remaining = size
+        while remaining > 0:
+            await response.write(block[:min(remaining, len(block))])
+            remaining -= min(remaining, len(block))
+        return response
+
+    async def direct_upload(request):
+        form = await request.post()
+        await asyncio.sleep(major_tom_latency)
+        return web.json_response({
+            "direct_upload": {"url": f"http://127.0.0.1:{major_tom_port}/upload"},
+            "signed_id": f"signed-{form['filename']}"})
+
+    async def upload(request):
+        async for _ in request.content.iter_chunked(65536):
+            pass
+        await asyncio.sleep(major_tom_latency)
+        return web.Response(status=204)
+
+    async def downlinked_file(request):
+        await request.json()
+        await asyncio.sleep(major_tom_latency)
+        return web.json_response({})
+
+    graphql_app = web.Application()
+    graphql_app.router.add_post("/graphql", graphql)
+    major_tom_app = web.Application(client_max_size=2 ** 32)
+    major_tom_app.router.add_get("/staged/{size}", staged_file)
+    major_tom_app.router.add_post("/rails/active_storage/direct_uploads", direct_upload)
+    major_tom_app.router.add_put("/upload", upload)
+    major_tom_app.router.add_post("/gateway_api/v1.0/downlinked_files", downlinked_file)
+    for app, port in ((graphql_app, graphql_port), (major_tom_app, major_tom_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+    while True:
+        await asyncio.sleep(3600)
+
+
+def _serve(*args):
+    asyncio.run(serve(*args))
+
+
+def serve_in_process(graphql_port, major_tom_port, graphql_latency=0.01, major_tom_latency=0.01):
+    """Starts the fake GraphQL service and Major Tom in a child process and waits until they accept connections"""
+    process = multiprocessing.Process(
+        target=_serve, args=(graphql_port, major_tom_port, graphql_latency, major_tom_latency), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 30
+    for port in (graphql_port, major_tom_port):
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or not process.is_alive():
+                    process.terminate()
+                    raise RuntimeError(f"Stand-in server didn't start on port {port}")
+                time.sleep(0.05)
+    return process
+
+
+class FakeFileService(asyncio.DatagramProtocol):
+    """
+    Stands in for the KubOS file transfer service. Drops each chunk with probability loss, in both directions,
+    and sends a NAK for the chunks it's missing after hold seconds without receiving one.
+    """
+
+    def __init__(self, chunk_size=4096, loss=0.0, hold=0.2):
+        self.chunk_size = chunk_size
+        self.loss = loss
+        self.hold = hold
+        self.transport = None
+        self.uploads = {}  # Chunks received, target path and NAK timer of each upload, by channel id
+        self.downloads = {}  # Contents of the file being sent on each channel
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.get_extra_info("socket").setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, file_protocol.RECEIVE_BUFFER)
+
+    def send(self, addr, *message):
+        self.transport.sendto(file_protocol.encode(list(message)), addr)
+
+    def send_chunk(self, addr, channel_id, file_digest, data, index):
+        if random.random() >= self.loss:
+            self.send(addr, channel_id, file_digest, index, data[index * self.chunk_size:(index + 1) * self.chunk_size])
+
+    def datagram_received(self, data, addr):
+        message = file_protocol.decode(data)
+        channel_id = message[0]
+        if message[1] == "import":
+            try:
+                with open(message[2], "rb") as f:
+                    content = f.read()
+            except OSError as e:
+                self.send(addr, channel_id, False, str(e))
+                return
+            file_digest = file_protocol.file_hash(content)
+            num_chunks = -(-len(content) // self.chunk_size)
+            self.downloads[channel_id] = content
+            self.send(addr, channel_id, True, file_digest, num_chunks, 0o644)
+            for index in range(num_chunks):
+                self.send_chunk(addr, channel_id, file_digest, content, index)
+        elif message[1] == "export":
+            upload = self.uploads.setdefault(channel_id, {"chunks": {}, "timer": None})
+            upload.update(hash=message[2], path=message[3])
+            self.check_upload(addr, channel_id)
+        elif len(message) == 3 and isinstance(message[1], str):
+            upload = self.uploads.setdefault(channel_id, {"chunks": {}, "timer": None})
+            upload["num_chunks"] = message[2]
+        elif len(message) == 4 and isinstance(message[2], bool):
+            content = self.downloads.get(channel_id)
+            if message[2]:
+                self.downloads.pop(channel_id, None)
+            elif content is not None:
+                for index in file_protocol.ranges_indexes(message[3]):
+                    self.send_chunk(addr, channel_id, message[1], content, index)
+        elif len(message) == 4 and channel_id in self.uploads:
+            if random.random() < self.loss:
+                return
+            self.uploads[channel_id]["chunks"][message[2]] = bytes(message[3])
+            self.check_upload(addr, channel_id)
+
+    def check_upload(self, addr, channel_id):
+        upload = self.uploads[channel_id]
+        if upload["timer"] is not None:
+            upload["timer"].cancel()
+            upload["timer"] = None
+        if "path" not in upload or "num_chunks" not in upload:
+            return
+        missing = [index for index in range(upload["num_chunks"]) if index not in upload["chunks"]]
+        if missing:
+            upload["timer"] = asyncio.get_running_loop().call_later(
+                self.hold, self.send, addr, channel_id, upload["hash"], False, file_protocol.missing_ranges(missing))
+            return
+        content = b"".join(upload["chunks"][index] for index in range(upload["num_chunks"]))
+        self.send(addr, channel_id, upload["hash"], True, upload["num_chunks"])
+        if file_protocol.file_hash(content) != upload["hash"]:
+            self.send(addr, channel_id, False, "Hash mismatch")
+        else:
+            with open(upload["path"], "wb") as f:
+                f.write(content)
+            self.send(addr, channel_id, True)
+        del self.uploads[channel_id]
+
+
+async def serve_file_service(port, chunk_size, loss, hold):
+    await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: FakeFileService(chunk_size=chunk_size, loss=loss, hold=hold), local_addr=("127.0.0.1", port))
+    while True:
+        await asyncio.sleep(3600)
+
+
+def _serve_file_service(*args):
+    asyncio.run(serve_file_service(*args))
+
+
+def serve_file_service_in_process(port, chunk_size=4096, loss=0.0, hold=0.2):
+    """Starts the fake file transfer service in a child process"""
+    process = multiprocessing.Process(
+        target=_serve_file_service, args=(port, chunk_size, loss, hold), daemon=True)
+    process.start()
+    # UDP has no connection to wait for, so this waits until the port is taken instead
+    deadline = time.monotonic() + 30
+    while True:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.bind(("127.0.0.1", port))
+        except OSError:
+            return process
+        finally:
+            probe.close()
+        if time.monotonic() > deadline or not process.is_alive():
+            process.terminate()
+            raise RuntimeError(f"Stand-in file transfer service didn't start on port {port}")
+        time.sleep(0.05)
+
+
+class FakeGateway:
+    """
+    Stands in for GatewayAPI. Staged file downloads and downlinked file uploads go to the fake Major Tom.
+    *.finished maps command ids to the state they finished in and the time they finished.
+    """
+
+    def __init__(self, major_tom_port, send_latency=0):
+        self.host = f"127.0.0.1:{major_tom_port}"
+        self.http = True
+        self.headers = {"X-Gateway-Token": "bench"}
+        self.send_latency = send_latency
+        self.finished = {}
+        self.errors = {}
+        self.messages = 0
+
+    async def transmit(self, payload):
+        self.messages += 1
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+
+    async def transmit_command_update(self, command_id, state, dict={}):
+        await self.transmit({"type": "command_update", "command": {"id": command_id, "state": state, **dict}})
+        if state in ("completed", "failed", "cancelled"):
+            self.finished.setdefault(command_id, (state, time.perf_counter()))
+            if state == "failed":
+                self.errors[command_id] = dict.get("errors")
+
+    async def complete_command(self, command_id, output):
+        await self.transmit_command_update(command_id=command_id, state="completed", dict={"output": output})
+
+    async def fail_command(self, command_id, errors):
+        await self.transmit_command_update(command_id=command_id, state="failed", dict={"errors": errors})
+
+    async def cancel_command(self, command_id):
+        await self.transmit_command_update(command_id=command_id, state="cancelled")
+
+    async def transmitted_command(self, command_id, payload="None Provided"):
+        await self.transmit_command_update(command_id=command_id, state="transmitted_to_system", dict={"payload": payload})
+
+    async def update_command_definitions(self, system, definitions):
+        await self.transmit({"type": "command_definitions_update"})
+
+    async def update_file_list(self, system, files, timestamp=None):
+        await self.transmit({"type": "file_list"})
+
+    async def transmit_metrics(self, metrics):
+        await self.transmit({"type": "measurements"})
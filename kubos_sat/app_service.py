@@ -1,16 +1,56 @@
 import logging
 import json
-import asyncio
+import os
 import textwrap
 from kubos_sat import graphql
+from kubos_sat import executor
 
 logger = logging.getLogger(__name__)
 
 
+def app_definition(app):
+    return {
+        "display_name": f"Execute {app['name']}",
+        "description": f'Issues the "StartApp" mutation to the app service with the argument string provided. Author: {app["author"]}, Version: {app["version"]}, Config: {app["config"]}',
+        "tags": ["Mission Apps"],
+        "fields": [
+            {"name": "args", "type": "string"}
+        ]
+    }
+
+
 class AppService:
-    def __init__(self, port):
+    """
+    *.apps holds the active apps registered with the app service, by name, as last retrieved from it.
+    With a cache_path, they're saved there and loaded at startup, so their commands are available
+    before the app service has been queried.
+    """
+
+    def __init__(self, port, cache_path=None):
         self.port = port
-        self.apps = []
+        self.cache_path = cache_path
+        self.apps = self.load_cache()
+        self.refreshes = set()  # Background refreshes started by commands
+
+    def load_cache(self):
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return {app["name"]: app for app in json.load(f)["apps"]}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"App registry cache {self.cache_path} is corrupt, ignoring it: {e}")
+            return {}
+
+    def save_cache(self):
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.cache_path + ".tmp", "w") as f:
+            json.dump({"apps": list(self.apps.values())}, f)
+        os.replace(self.cache_path + ".tmp", self.cache_path)
 
     def build(self, kubos_sat):
         kubos_sat.definitions.update({
@@ -29,52 +69,24 @@ class AppService:
                 ]
             }
         })
+        self.build_app_commands(kubos_sat=kubos_sat, changed=self.apps)
 
-    def build_from_app_service(self, kubos_sat, gateway, command=None):
-        # remove current app commands
-        for app in self.apps:
-            kubos_sat.definitions.pop(app)
-        self.apps = []
-
-        query = textwrap.dedent("""
-            {registeredApps {
-                active
-                app {name, executable, config, version, author}}}""")
-        result = graphql.query_with_validation(query=query,
-                                               ip=kubos_sat.ip,
-                                               port=self.port)
-
-        apps = []
-        for entry in result["data"]["registeredApps"]:
-            if entry["active"]:
-                apps.append(entry["app"])
+    def build_app_commands(self, kubos_sat, changed, removed=()):
+        """Updates the definitions of the changed apps and the commands that list every app"""
+        for name in removed:
+            kubos_sat.definitions.pop(name, None)
+        for name in changed:
+            kubos_sat.definitions[name] = app_definition(self.apps[name])
 
-        if apps == []:
-            logger.warning("No Active Apps")
-            if command:
-                asyncio.ensure_future(gateway.complete_command(
-                    command_id=command.id,
-                    output="No Active Apps registered"))
+        if not self.apps:
+            kubos_sat.definitions.pop("uninstall_app", None)
+            kubos_sat.definitions.pop("kill_app", None)
             return
-
-        app_names = []
-        for app in apps:
-            app_names.append(app["name"])
-            self.apps.append(app["name"])
-            kubos_sat.definitions.update(
-                {app["name"]: {
-                    "display_name": f"Execute {app['name']}",
-                    "description": f'Issues the "StartApp" mutation to the app service with the argument string provided. Author: {app["author"]}, Version: {app["version"]}, Config: {app["config"]}',
-                    "tags": ["Mission Apps"],
-                    "fields": [
-                        {"name": "args", "type": "string"}
-                    ]
-                }}
-            )
+        app_names = list(self.apps)
         kubos_sat.definitions.update(
             {"uninstall_app": {
                 "display_name": "Uninstall App",
-                "description": 'Uninstalls all versions of an app. Issue a raw mutation to uninstall only a specific version. App will still appear in command options until the "Retrieve Apps" command is re-issued.',
+                "description": 'Uninstalls all versions of an app. Issue a raw mutation to uninstall only a specific version.',
                 "tags": ["Mission Apps"],
                 "fields": [
                     {"name": "app", "type": "string", "range": app_names},
@@ -95,15 +107,64 @@ class AppService:
             }}
         )
 
-        asyncio.ensure_future(gateway.update_command_definitions(
-            system=kubos_sat.name,
-            definitions=kubos_sat.definitions))
+    async def refresh(self, kubos_sat, gateway):
+        """
+        Queries the app service for the registered apps, and updates the commands of the apps that were added,
+        changed or removed since the last query. Returns the names of those apps.
+        """
+        query = textwrap.dedent("""
+            {registeredApps {
+                active
+                app {name, executable, config, version, author}}}""")
+        result = await graphql.query_with_validation(query=query,
+                                                     ip=kubos_sat.ip,
+                                                     port=self.port)
+
+        apps = {}
+        for entry in result["data"]["registeredApps"]:
+            if entry["active"]:
+                apps[entry["app"]["name"]] = entry["app"]
+
+        changed = [name for name, app in apps.items() if self.apps.get(name) != app]
+        removed = [name for name in self.apps if name not in apps]
+        if not changed and not removed:
+            logger.debug("Registered apps are unchanged")
+            return [], []
+        logger.info(f"Registered apps changed. Updated: {changed}, removed: {removed}")
+        self.apps = apps
+        self.build_app_commands(kubos_sat=kubos_sat, changed=changed, removed=removed)
+        if self.cache_path is not None:
+            await executor.run_blocking(self.save_cache)
+        await kubos_sat.push_command_definitions(gateway=gateway)
+        return changed, removed
+
+    def refresh_in_background(self, kubos_sat, gateway):
+        """Picks up a change made by a command, without holding up its completion"""
+        executor.run_in_background(
+            self.refresh(kubos_sat=kubos_sat, gateway=gateway),
+            tasks=self.refreshes, description="refresh the registered apps")
+
+    async def build_from_app_service(self, kubos_sat, gateway, command=None):
+        changed, removed = await self.refresh(kubos_sat=kubos_sat, gateway=gateway)
+
+        if not self.apps:
+            logger.warning("No Active Apps")
+            if command:
+                await gateway.complete_command(
+                    command_id=command.id,
+                    output="No Active Apps registered")
+            return
+
         if command:
-            asyncio.ensure_future(gateway.complete_command(
+            if changed or removed:
+                output = f"Updated execution commands for registered apps: {list(self.apps)}. Changed: {changed}, removed: {removed}"
+            else:
+                output = f"Execution commands are already up to date for registered apps: {list(self.apps)}"
+            await gateway.complete_command(
                 command_id=command.id,
-                output=f"Added execution commands for registered apps: {app_names}"))
+                output=output)
 
-    def start_app(self, kubos_sat, gateway, command):
+    async def start_app(self, kubos_sat, gateway, command):
         args = json.dumps(command.fields["args"].split(" "))
         mutation = textwrap.dedent("""
             mutation StartApp($app_name: String!,$app_args: [String!]){
@@ -114,14 +175,14 @@ class AppService:
             "app_name": command.type,
             "app_args": args
         }
-        graphql.query_with_command_updates(query=mutation,
-                                           ip=kubos_sat.ip,
-                                           port=self.port,
-                                           gateway=gateway,
-                                           command_id=command.id,
-                                           variables=variables)
-
-    def uninstall_app(self, kubos_sat, gateway, command):
+        await graphql.query_with_command_updates(query=mutation,
+                                                 ip=kubos_sat.ip,
+                                                 port=self.port,
+                                                 gateway=gateway,
+                                                 command_id=command.id,
+                                                 variables=variables)
+
+    async def uninstall_app(self, kubos_sat, gateway, command):
         mutation = textwrap.dedent("""
             mutation Uninstall($app_name: String!){
                 uninstall(name:$app_name){
@@ -130,14 +191,15 @@ class AppService:
         variables = {
             "app_name": command.fields["app"]
         }
-        graphql.query_with_command_updates(query=mutation,
-                                           ip=kubos_sat.ip,
-                                           port=self.port,
-                                           gateway=gateway,
-                                           command_id=command.id,
-                                           variables=variables)
-
-    def kill_app(self, kubos_sat, gateway, command):
+        await graphql.query_with_command_updates(query=mutation,
+                                                 ip=kubos_sat.ip,
+                                                 port=self.port,
+                                                 gateway=gateway,
+                                                 command_id=command.id,
+                                                 variables=variables)
+        self.refresh_in_background(kubos_sat=kubos_sat, gateway=gateway)
+
+    async def kill_app(self, kubos_sat, gateway, command):
         mutation = textwrap.dedent("""
             mutation KillApp($app_name: String!,$signal: Int){
                 killApp(name: $app_name, signal: $signal) {
@@ -147,14 +209,14 @@ class AppService:
             "app_name": command.fields["app"],
             "signal": int(command.fields["signal"])
         }
-        graphql.query_with_command_updates(query=mutation,
-                                           ip=kubos_sat.ip,
-                                           port=self.port,
-                                           gateway=gateway,
-                                           command_id=command.id,
-                                           variables=variables)
-
-    def register_app(self, kubos_sat, gateway, command, app_path=None):
+        await graphql.query_with_command_updates(query=mutation,
+                                                 ip=kubos_sat.ip,
+                                                 port=self.port,
+                                                 gateway=gateway,
+                                                 command_id=command.id,
+                                                 variables=variables)
+
+    async def register_app(self, kubos_sat, gateway, command, app_path=None):
         # Allows register to be called from other commands as well
         if not app_path:
             app_path = command.fields["app_path"]
@@ -169,9 +231,10 @@ class AppService:
         variables = {
             "app_path": app_path
         }
-        graphql.query_with_command_updates(query=mutation,
-                                           ip=kubos_sat.ip,
-                                           port=self.port,
-                                           gateway=gateway,
-                                           command_id=command.id,
-                                           variables=variables)
+        await graphql.query_with_command_updates(query=mutation,
+                                                 ip=kubos_sat.ip,
+                                                 port=self.port,
+                                                 gateway=gateway,
+                                                 command_id=command.id,
+                                                 variables=variables)
+        self.refresh_in_background(kubos_sat=kubos_sat, gateway=gateway)
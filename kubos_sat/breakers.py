@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import logging
+import time
+from kubos_sat import metrics
+from kubos_sat.exceptions import ServiceTimeoutError, ServiceUnavailableError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+DEFAULT_DEADLINE_MULTIPLIER = 4
+DEFAULT_MIN_DEADLINE = 5
+DEFAULT_SAMPLES = 100
+DEFAULT_SHELL_CLIENT_TIMEOUT = 120
+MIN_SAMPLES = 10
+DEADLINE_QUANTILE = 0.99
+
+_failure_threshold = DEFAULT_FAILURE_THRESHOLD
+_reset_timeout = DEFAULT_RESET_TIMEOUT
+_deadline_multiplier = DEFAULT_DEADLINE_MULTIPLIER
+_min_deadline = DEFAULT_MIN_DEADLINE
+_shell_client_timeout = DEFAULT_SHELL_CLIENT_TIMEOUT
+_file_client_timeout = None  # Transfers take as long as the file needs, so they have no deadline unless one is set
+guards = {}  # ServiceGuard of each GraphQL service and client binary, by name
+
+
+def configure(failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT,
+              deadline_multiplier=DEFAULT_DEADLINE_MULTIPLIER, min_deadline=DEFAULT_MIN_DEADLINE,
+              shell_client_timeout=DEFAULT_SHELL_CLIENT_TIMEOUT, file_client_timeout=None):
+    """Sets the settings of the guards created from now on"""
+    global _failure_threshold, _reset_timeout, _deadline_multiplier, _min_deadline
+    global _shell_client_timeout, _file_client_timeout
+    _failure_threshold = failure_threshold
+    _reset_timeout = reset_timeout
+    _deadline_multiplier = deadline_multiplier
+    _min_deadline = min_deadline
+    _shell_client_timeout = shell_client_timeout
+    _file_client_timeout = file_client_timeout
+
+
+class AdaptiveDeadline:
+    """
+    Seconds a call is given before it's abandoned: multiplier times the 99th percentile of the
+    last successful calls' durations, kept between minimum and maximum.
+    Until enough calls have succeeded to go by, it's the maximum. A maximum of None means no deadline then.
+    """
+
+    def __init__(self, maximum, minimum=DEFAULT_MIN_DEADLINE, multiplier=DEFAULT_DEADLINE_MULTIPLIER,
+                 samples=DEFAULT_SAMPLES):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.multiplier = multiplier
+        self.durations = collections.deque(maxlen=samples)
+
+    def observe(self, seconds):
+        self.durations.append(seconds)
+
+    @property
+    def value(self):
+        if self.multiplier is None or len(self.durations) < MIN_SAMPLES:
+            return self.maximum
+        ordered = sorted(self.durations)
+        deadline = max(self.minimum, self.multiplier * ordered[int(DEADLINE_QUANTILE * (len(ordered) - 1))])
+        return deadline if self.maximum is None else min(deadline, self.maximum)
+
+
+class ServiceGuard:
+    """
+    Deadline and circuit breaker for one service.
+    After failure_threshold calls in a row fail or miss their deadline, the breaker opens and calls fail
+    straight away with ServiceUnavailableError. While it's open, probe is called every reset_timeout
+    seconds in the background, and the breaker closes once it succeeds. Without a probe, one call is let
+    through every reset_timeout seconds to test the service.
+    """
+
+    def __init__(self, name, max_deadline, adaptive=True, probe=None):
+        self.name = name
+        self.deadline = AdaptiveDeadline(
+            maximum=max_deadline, minimum=_min_deadline, multiplier=_deadline_multiplier if adaptive else None)
+        self.failure_threshold = _failure_threshold
+        self.reset_timeout = _reset_timeout
+        self.probe = probe
+        self.failures = 0
+        self.opened_at = None
+        self.probing = None
+        metrics.gauge("breaker_open", lambda: int(self.opened_at is not None), service=name)
+        metrics.gauge("deadline_seconds", lambda: self.deadline.value or 0, service=name)
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def check(self):
+        """Raises ServiceUnavailableError if the breaker is open and it isn't time to test the service"""
+        if self.opened_at is None:
+            return
+        retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.probe is None and retry_in <= 0:
+            # Lets this call through to test the service. Calls after it fail fast until it finishes.
+            self.opened_at = time.monotonic()
+            return
+        metrics.increment("breaker_rejected_total", service=self.name)
+        raise ServiceUnavailableError(service=self.name, failures=self.failures, retry_in=max(retry_in, 0))
+
+    def record_success(self, seconds=None):
+        if seconds is not None:
+            self.deadline.observe(seconds)
+        if self.opened_at is not None:
+            logger.info(f"{self.name} has recovered. Closing its circuit breaker.")
+            if self.probing is not None:
+                self.probing.cancel()
+                self.probing = None
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self, error):
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.failure_threshold:
+            logger.warning(
+                f"{self.name} failed {self.failures} times in a row, most recently with {type(error).__name__}: {error}. "
+                f"Failing calls to it for the next {self.reset_timeout}s.")
+            self.opened_at = time.monotonic()
+            if self.probe is not None:
+                self.probing = asyncio.ensure_future(self.probe_until_recovered())
+        elif self.opened_at is not None:
+            # The test call failed, so the breaker stays open for another reset_timeout
+            self.opened_at = time.monotonic()
+
+    async def probe_until_recovered(self):
+        while self.opened_at is not None:
+            await asyncio.sleep(self.reset_timeout)
+            try:
+                await asyncio.wait_for(self.probe(), timeout=self.deadline.maximum)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"Probe of {self.name} failed: {type(e).__name__}: {e}")
+                self.opened_at = time.monotonic()
+                continue
+            self.probing = None
+            self.record_success()
+
+    async def call(self, function, failures=(Exception,)):
+        """
+        Awaits function() within the deadline. Exceptions of the failures types, and missing the deadline,
+        count towards opening the breaker.
+        """
+        self.check()
+        deadline = self.deadline.value
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(function(), timeout=deadline)
+        except asyncio.TimeoutError:
+            error = ServiceTimeoutError(service=self.name, deadline=deadline)
+            self.record_failure(error)
+            raise error
+        except failures as e:
+            self.record_failure(e)
+            raise
+        self.record_success(time.monotonic() - start)
+        return result
+
+
+def guard(name, max_deadline, adaptive=True, probe=None):
+    """Returns the guard of the named service, creating it the first time"""
+    if name not in guards:
+        guards[name] = ServiceGuard(name=name, max_deadline=max_deadline, adaptive=adaptive, probe=probe)
+    return guards[name]
+
+
+def shell_client_guard(ip, port, probe):
+    return guard(name=f"Shell service {ip}:{port}", max_deadline=_shell_client_timeout, probe=probe)
+
+
+def file_client_guard(ip, port):
+    # Transfer times depend on the file size rather than the service, so the deadline doesn't adapt
+    return guard(name=f"File transfer service {ip}:{port}", max_deadline=_file_client_timeout, adaptive=False)
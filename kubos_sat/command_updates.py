@@ -0,0 +1,107 @@
+import asyncio
+import collections
+import logging
+from kubos_sat import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 0.2
+DEFAULT_MAX_PENDING = 1000
+TERMINAL_STATES = ("completed", "failed", "cancelled")
+FINISHED_HISTORY = 1000
+
+
+class CommandUpdateChannel:
+    """
+    Stands in for the gateway when resolvers send command updates, and sends them to Major Tom in order.
+    Updates are queued per command and all queued updates are sent every flush interval.
+    A queued update is replaced by a newer one for the same command and state, so a burst of status
+    messages only sends the latest, and updates for a command that has already finished are dropped.
+    Resolvers wait when more than max_pending updates are queued.
+    Everything else is passed through to the gateway.
+    """
+
+    def __init__(self, gateway, flush_interval=DEFAULT_FLUSH_INTERVAL, max_pending=DEFAULT_MAX_PENDING):
+        self.gateway = gateway
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()  # Queued [state, fields] updates by command id
+        self.size = 0
+        self.coalesced = 0
+        self.finished = collections.OrderedDict()  # Recently finished command ids
+        self.changed = asyncio.Condition()
+        self.flushing = asyncio.Lock()
+        self.task = None
+        metrics.gauge("command_updates_pending", lambda: self.size)
+
+    def __getattr__(self, name):
+        return getattr(self.gateway, name)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Stops the periodic flush and sends anything still queued"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    def _queue(self, command_id, state, fields):
+        if command_id in self.finished:
+            logger.debug(f'Dropping "{state}" update for command {command_id}, which already finished')
+            return
+        updates = self.pending.setdefault(command_id, [])
+        if updates and updates[-1][0] == state and state not in TERMINAL_STATES:
+            updates[-1][1].update(fields)
+            self.coalesced += 1
+        else:
+            updates.append([state, dict(fields)])
+            self.size += 1
+        if state in TERMINAL_STATES:
+            self.finished[command_id] = True
+            if len(self.finished) > FINISHED_HISTORY:
+                self.finished.popitem(last=False)
+
+    async def transmit_command_update(self, command_id: int, state: str, dict={}):
+        # Queued before waiting for room, so each command's updates keep the order they were made in
+        self._queue(command_id=command_id, state=state, fields=dict)
+        if self.size > self.max_pending:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.size <= self.max_pending)
+
+    async def fail_command(self, command_id: int, errors: list):
+        await self.transmit_command_update(command_id=command_id, state="failed", dict={"errors": errors})
+
+    async def complete_command(self, command_id: int, output: str):
+        await self.transmit_command_update(command_id=command_id, state="completed", dict={"output": output})
+
+    async def cancel_command(self, command_id: int):
+        await self.transmit_command_update(command_id=command_id, state="cancelled")
+
+    async def transmitted_command(self, command_id: int, payload="None Provided"):
+        await self.transmit_command_update(command_id=command_id, state="transmitted_to_system", dict={"payload": payload})
+
+    async def flush(self):
+        """Sends every queued update"""
+        async with self.flushing:
+            while self.pending:
+                command_id, updates = self.pending.popitem(last=False)
+                try:
+                    for state, fields in updates:
+                        # Waits for the websocket to take each message, so a slow Major Tom slows the flush down
+                        with metrics.timed("major_tom", call="command_update"):
+                            await self.gateway.transmit_command_update(command_id=command_id, state=state, dict=fields)
+                finally:
+                    async with self.changed:
+                        self.size -= len(updates)
+                        self.changed.notify_all()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                # Shielded so stopping doesn't drop updates that are partway through being sent
+                await asyncio.shield(self.flush())
+            except Exception as e:
+                logger.warning(f"Failed to send command updates: {type(e).__name__}: {e}")
@@ -0,0 +1,138 @@
+import gzip
+import logging
+import os
+import shlex
+import shutil
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_SIZE = 4096
+DEFAULT_MIN_SAVING = 0.1
+DEFAULT_LEVEL = 6
+DEFAULT_REMOTE_DIRECTORY = "/tmp/"
+MODES = ["auto", "yes", "no"]
+# Formats that are already compressed, so compressing them again only costs time on the satellite
+COMPRESSED_EXTENSIONS = (
+    ".gz", ".tgz", ".bz2", ".xz", ".lz4", ".zst", ".zip", ".7z",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp4", ".mkv", ".ipk")
+
+_enabled = False
+_min_size = DEFAULT_MIN_SIZE
+_min_saving = DEFAULT_MIN_SAVING
+_level = DEFAULT_LEVEL
+_remote_directory = DEFAULT_REMOTE_DIRECTORY
+
+
+def configure(enabled=False, min_size=DEFAULT_MIN_SIZE, min_saving=DEFAULT_MIN_SAVING, level=DEFAULT_LEVEL,
+              remote_directory=DEFAULT_REMOTE_DIRECTORY):
+    """Sets whether uplinks and downlinks can be gzip compressed, and when "auto" compresses them"""
+    global _enabled, _min_size, _min_saving, _level, _remote_directory
+    _enabled = enabled
+    _min_size = min_size
+    _min_saving = min_saving
+    _level = level
+    _remote_directory = remote_directory
+
+
+def available(kubos_sat):
+    """Compression needs the shell service to compress and decompress files on the satellite"""
+    return _enabled and kubos_sat.shell_service is not None and kubos_sat.shell_service.shell_client_path is not None
+
+
+def field(kubos_sat):
+    """The compression field of the uplink and downlink commands"""
+    if "shell-service" in kubos_sat.config and _enabled:
+        return {"name": "compression", "type": "string", "range": MODES, "default": "auto"}
+    return {"name": "compression", "type": "string", "value": "no"}
+
+
+def worth_compressing(mode, path, size):
+    """Whether a file should be compressed before it's transferred. Size is None when it isn't known."""
+    if mode == "yes":
+        return True
+    if mode != "auto":
+        return False
+    if path.lower().endswith(COMPRESSED_EXTENSIONS):
+        return False
+    return size is None or size >= _min_size
+
+
+def saves_enough(size, compressed_size):
+    return compressed_size <= size * (1 - _min_saving)
+
+
+def remote_path(path, suffix):
+    """Temporary path on the satellite for the compressed copy of a file"""
+    return os.path.join(_remote_directory, f"{os.path.basename(path)}.{suffix}.gz")
+
+
+def compress_command(source, destination, limit=""):
+    """limit is put in front of gzip to stop it on the satellite, such as a ShellService.timeout_prefix"""
+    return f"{limit}gzip -c -{_level} {shlex.quote(source)} > {shlex.quote(destination)}"
+
+
+def decompress_command(source, destination, limit=""):
+    """
+    Decompresses a file on the satellite next to its destination, and only moves it over the destination once
+    that succeeds, so a failure partway through leaves a file already there intact.
+    limit is put in front of gunzip like in compress_command.
+    """
+    partial = shlex.quote(f"{destination}.tmp")
+    return (f"{limit}gunzip -c {shlex.quote(source)} > {partial} && mv -f {partial} {shlex.quote(destination)} "
+            f"|| {{ rm -f {partial}; exit 1; }}")
+
+
+def free_space_command(paths):
+    """
+    Shows the free space of the filesystems that files on the satellite are written to, one df line per path.
+    The line is empty for a path df fails for, such as one in a missing directory.
+    """
+    return "printf '%s\\n' " + " ".join(
+        f'"$(df -Pk {shlex.quote(os.path.dirname(path) or ".")} 2>/dev/null | tail -n 1)"' for path in paths)
+
+
+def space_shortfall(output, needed):
+    """
+    Checks the output of free_space_command against the bytes needed at each of its paths.
+    Paths on the same filesystem share its free space. Paths whose line can't be read aren't checked.
+    Returns a description of the first filesystem without enough room, or None if they all have enough.
+    """
+    free = {}
+    used = {}
+    for line, size in zip(output.split("\n"), needed):
+        # The filesystem name can contain spaces, so the columns are counted from the end
+        fields = line.split()
+        try:
+            available = int(fields[-3]) * 1024
+        except (IndexError, ValueError):
+            continue
+        mount = fields[-1]
+        free[mount] = available
+        used[mount] = used.get(mount, 0) + size
+    for mount, size in used.items():
+        if size > free[mount]:
+            return f"{size} bytes are needed on {mount} and {free[mount]} are free"
+    return None
+
+
+def compress_file(source, destination):
+    """Returns the size of the compressed file"""
+    with open(source, "rb") as f, gzip.open(destination, "wb", compresslevel=_level) as compressed:
+        shutil.copyfileobj(f, compressed, 1024 * 1024)
+    return os.path.getsize(destination)
+
+
+def decompress_file(source, destination):
+    """Returns the size of the decompressed file"""
+    with gzip.open(source, "rb") as compressed, open(destination, "wb") as f:
+        shutil.copyfileobj(compressed, f, 1024 * 1024)
+    return os.path.getsize(destination)
+
+
+def savings(size, compressed_size):
+    """Summary of the bytes compression kept off the link, for the command output"""
+    saved = size - compressed_size
+    if saved < 0:
+        return f"Compressed {size} bytes to {compressed_size} for the transfer, which added {-saved} bytes."
+    percent = 100 * saved / size if size else 0
+    return f"Compressed {size} bytes to {compressed_size} for the transfer, saving {saved} bytes ({percent:.0f}%)."
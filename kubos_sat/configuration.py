@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+from kubos_sat import KubosSat
+from kubos_sat.kubos_sat import DEFAULT_CONFIG_WATCH_INTERVAL
+from kubos_sat import executor
+from kubos_sat import graphql
+from kubos_sat import breakers
+from kubos_sat import telemetry
+from kubos_sat import major_tom
+from kubos_sat import file_protocol
+from kubos_sat import compression
+from kubos_sat import shell_service
+from kubos_sat import command_updates
+from kubos_sat import metrics
+from kubos_sat import link
+from kubos_sat.file_service import TransferScheduler, DEFAULT_TRANSFER_WORKERS
+from kubos_sat.file_cache import UplinkCache, DownlinkCache, DEFAULT_MAX_SIZE_MB
+
+logger = logging.getLogger(__name__)
+
+# Builds the gateway from the parsed gateway_config.local.toml, the same way for run.py and the supervisor's workers
+
+
+def configure_modules(gateway_config):
+    """Applies the concurrency, graphql, breakers, transfers, file-protocol, shell-commands and compression sections to the modules that share them"""
+    concurrency_config = gateway_config.get("concurrency", {})
+    executor.configure(
+        max_workers=concurrency_config.get("blocking-workers", executor.DEFAULT_BLOCKING_WORKERS))
+
+    graphql_config = gateway_config.get("graphql", {})
+    graphql.configure(
+        connect_timeout=graphql_config.get("connect-timeout", graphql.DEFAULT_CONNECT_TIMEOUT),
+        read_timeout=graphql_config.get("read-timeout", graphql.DEFAULT_READ_TIMEOUT),
+        max_in_flight=graphql_config.get("max-in-flight", graphql.DEFAULT_MAX_IN_FLIGHT),
+        keepalive_timeout=graphql_config.get("keepalive-timeout", graphql.DEFAULT_KEEPALIVE_TIMEOUT),
+        batch_window=graphql_config.get("batch-window", graphql.DEFAULT_BATCH_WINDOW),
+        max_batch_size=graphql_config.get("max-batch-size", graphql.DEFAULT_MAX_BATCH_SIZE))
+
+    breakers_config = gateway_config.get("breakers", {})
+    breakers.configure(
+        failure_threshold=breakers_config.get("failure-threshold", breakers.DEFAULT_FAILURE_THRESHOLD),
+        reset_timeout=breakers_config.get("reset-timeout", breakers.DEFAULT_RESET_TIMEOUT),
+        deadline_multiplier=breakers_config.get("deadline-multiplier", breakers.DEFAULT_DEADLINE_MULTIPLIER),
+        min_deadline=breakers_config.get("min-deadline", breakers.DEFAULT_MIN_DEADLINE),
+        shell_client_timeout=breakers_config.get("shell-client-timeout", breakers.DEFAULT_SHELL_CLIENT_TIMEOUT),
+        file_client_timeout=breakers_config.get("file-client-timeout"))
+
+    transfers_config = gateway_config.get("transfers", {})
+    major_tom.configure(
+        chunk_size=transfers_config.get("chunk-size", major_tom.DEFAULT_CHUNK_SIZE),
+        hash_algorithm=transfers_config.get("hash"))
+
+    file_protocol_config = gateway_config.get("file-protocol", {})
+    file_protocol.configure(
+        enabled="file-protocol" in gateway_config,
+        chunk_size=file_protocol_config.get("chunk-size", file_protocol.DEFAULT_CHUNK_SIZE),
+        window=file_protocol_config.get("window", file_protocol.DEFAULT_WINDOW),
+        timeout=file_protocol_config.get("timeout", file_protocol.DEFAULT_TIMEOUT),
+        retries=file_protocol_config.get("retries", file_protocol.DEFAULT_RETRIES))
+
+    shell_commands_config = gateway_config.get("shell-commands", {})
+    shell_service.configure(
+        output_limit=shell_commands_config.get("output-limit", shell_service.DEFAULT_OUTPUT_LIMIT),
+        update_interval=shell_commands_config.get("update-interval", shell_service.DEFAULT_UPDATE_INTERVAL),
+        command_timeout=shell_commands_config.get("default-timeout", shell_service.DEFAULT_COMMAND_TIMEOUT),
+        spool_directory=shell_commands_config.get("spool-directory", shell_service.DEFAULT_SPOOL_DIRECTORY))
+
+    compression_config = gateway_config.get("compression", {})
+    compression.configure(
+        enabled="compression" in gateway_config,
+        min_size=compression_config.get("min-size", compression.DEFAULT_MIN_SIZE),
+        min_saving=compression_config.get("min-saving", compression.DEFAULT_MIN_SAVING),
+        level=compression_config.get("level", compression.DEFAULT_LEVEL),
+        remote_directory=compression_config.get("remote-directory", compression.DEFAULT_REMOTE_DIRECTORY))
+
+
+def satellite_configs(gateway_config):
+    """
+    A [[satellites]] array declares several satellites served from one gateway. Their client-binaries, link,
+    concurrency and telemetry tables default to the top-level ones.
+    """
+    if "satellites" in gateway_config:
+        return gateway_config["satellites"]
+    return [gateway_config["satellite"]]
+
+
+def build_transfer_scheduler(gateway_config):
+    """Shared by every satellite, each limited to its own transfer-workers of them"""
+    transfers_config = gateway_config.get("transfers", {})
+    return TransferScheduler(workers=transfers_config.get("workers", DEFAULT_TRANSFER_WORKERS))
+
+
+def build_uplink_cache(gateway_config, subdirectory=None):
+    if "uplink-cache" not in gateway_config:
+        return None
+    directory = gateway_config["uplink-cache"]["directory"]
+    if subdirectory is not None:
+        directory = os.path.join(directory, subdirectory)
+    return UplinkCache(
+        directory=directory,
+        max_size_mb=gateway_config["uplink-cache"].get("max-size-mb", DEFAULT_MAX_SIZE_MB))
+
+
+def build_satellite(satellite_config, gateway_config, transfer_scheduler, uplink_cache=None, own_downlink_cache=False):
+    """
+    Creates the KubosSat for a satellite table.
+    With own_downlink_cache, its downlink cache is kept in a subdirectory named after it. Files are cached
+    by their path on the satellite, so that's needed whenever the cache directory serves more than one satellite.
+    """
+    client_binaries = satellite_config.get("client-binaries", gateway_config.get("client-binaries", {}))
+    concurrency_config = satellite_config.get("concurrency", gateway_config.get("concurrency", {}))
+
+    downlink_cache = None
+    if "downlink-cache" in gateway_config:
+        downlink_cache_directory = gateway_config["downlink-cache"]["directory"]
+        if own_downlink_cache:
+            downlink_cache_directory = os.path.join(downlink_cache_directory, satellite_config["name"])
+        downlink_cache = DownlinkCache(
+            directory=downlink_cache_directory,
+            max_size_mb=gateway_config["downlink-cache"].get("max-size-mb", DEFAULT_MAX_SIZE_MB))
+
+    app_cache_path = None
+    if "apps" in gateway_config and "cache-directory" in gateway_config["apps"]:
+        app_cache_path = os.path.join(gateway_config["apps"]["cache-directory"], f"{satellite_config['name']}.json")
+
+    satellite = KubosSat(
+        name=satellite_config["name"],
+        ip=satellite_config["ip"],
+        sat_config_path=satellite_config["config-path"],
+        file_client_path=client_binaries.get("file-client"),
+        shell_client_path=client_binaries["shell-client"],
+        file_list_directories=satellite_config["file-list-directories"],
+        default_uplink_dir=satellite_config["default-uplink-directory"],
+        file_list_mode=satellite_config.get("file-list-mode", "stat"),
+        command_limits=concurrency_config.get("command-limits"),
+        default_command_limit=concurrency_config.get("default-command-limit"),
+        max_commands=concurrency_config.get("max-commands"),
+        transfer_workers=satellite_config.get("transfer-workers", transfer_scheduler.workers),
+        transfer_scheduler=transfer_scheduler,
+        uplink_cache=uplink_cache,
+        downlink_cache=downlink_cache,
+        app_cache_path=app_cache_path)
+
+    link_config = satellite_config.get("link", gateway_config.get("link"))
+    if link_config is not None:
+        queue_path = None
+        if "queue-directory" in link_config:
+            queue_path = os.path.join(link_config["queue-directory"], f"{satellite_config['name']}.json")
+        satellite.link_monitor = link.LinkMonitor(
+            kubos_sat=satellite,
+            service=link_config.get("probe-service", link.DEFAULT_PROBE_SERVICE),
+            interval=link_config.get("probe-interval", link.DEFAULT_PROBE_INTERVAL),
+            timeout=link_config.get("probe-timeout", link.DEFAULT_PROBE_TIMEOUT),
+            failures_to_down=link_config.get("failures-to-down", link.DEFAULT_FAILURES_TO_DOWN),
+            queue_path=queue_path)
+    return satellite
+
+
+def build_command_updates(gateway_config, gateway):
+    command_updates_config = gateway_config.get("command-updates", {})
+    return command_updates.CommandUpdateChannel(
+        gateway=gateway,
+        flush_interval=command_updates_config.get("flush-interval", command_updates.DEFAULT_FLUSH_INTERVAL),
+        max_pending=command_updates_config.get("max-pending", command_updates.DEFAULT_MAX_PENDING))
+
+
+def start_background_tasks(satellite, satellite_config, gateway_config, gateway):
+    """
+    Starts watching the satellite's KubOS config, polling its telemetry and refreshing its file list and apps,
+    and monitoring its link, as configured.
+    Must be called once the satellite is prepared. Returns the tasks and services started, for stop_background_tasks.
+    """
+    started = []
+    logger.debug(f"Watching KubOS Config for Changes: {satellite.name}")
+    started.append(asyncio.ensure_future(satellite.watch_config(
+        gateway=gateway,
+        interval=satellite_config.get("config-watch-interval", DEFAULT_CONFIG_WATCH_INTERVAL))))
+
+    telemetry_config = satellite_config.get("telemetry", gateway_config.get("telemetry"))
+    if telemetry_config is not None:
+        logger.debug(f"Starting Telemetry Polling: {satellite.name}")
+        telemetry_service = telemetry.TelemetryService(
+            kubos_sat=satellite,
+            gateway=gateway,
+            definitions=telemetry_config.get("queries", []),
+            queue_size=telemetry_config.get("queue-size", telemetry.DEFAULT_QUEUE_SIZE),
+            batch_size=telemetry_config.get("batch-size", telemetry.DEFAULT_BATCH_SIZE),
+            flush_interval=telemetry_config.get("flush-interval", telemetry.DEFAULT_FLUSH_INTERVAL))
+        telemetry_service.start()
+        started.append(telemetry_service)
+
+    if "file-list-refresh-interval" in satellite_config:
+        started.append(asyncio.ensure_future(satellite.refresh_file_list_periodically(
+            gateway=gateway,
+            interval=satellite_config["file-list-refresh-interval"])))
+
+    if satellite.link_monitor is not None:
+        logger.debug(f"Monitoring the Link: {satellite.name}")
+        started.append(asyncio.ensure_future(satellite.link_monitor.run()))
+
+    apps_config = gateway_config.get("apps", {})
+    if "refresh-interval" in apps_config:
+        started.append(asyncio.ensure_future(satellite.refresh_apps_periodically(
+            gateway=gateway,
+            interval=apps_config["refresh-interval"])))
+    return started
+
+
+def stop_background_tasks(started):
+    for task in started:
+        if isinstance(task, telemetry.TelemetryService):
+            task.stop()
+        else:
+            task.cancel()
+
+
+async def start_metrics(gateway_config, gateway, system, health=None):
+    """Serves and pushes the gateway's own metrics, as configured in the metrics section"""
+    metrics_config = gateway_config.get("metrics")
+    if metrics_config is None:
+        return
+    if "port" in metrics_config:
+        await metrics.serve(
+            host=metrics_config.get("host", metrics.DEFAULT_HOST),
+            port=metrics_config["port"],
+            health=health)
+    if "push-interval" in metrics_config:
+        logger.debug("Sending Gateway Metrics to MajorTom")
+        asyncio.ensure_future(metrics.push_periodically(
+            gateway=gateway,
+            system=metrics_config.get("system", system),
+            interval=metrics_config["push-interval"],
+            subsystem=metrics_config.get("subsystem", metrics.DEFAULT_SUBSYSTEM)))
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Constellation:
+    """
+    Serves several satellites over one Major Tom connection.
+    Commands are routed to the satellite named by their system. A single satellite gets every command,
+    as before constellations were supported.
+    """
+
+    def __init__(self, satellites):
+        self.satellites = {satellite.name: satellite for satellite in satellites}
+        self.command_updates = None
+
+    def use_command_updates(self, command_updates):
+        """Sends every satellite's command updates through one CommandUpdateChannel"""
+        self.command_updates = command_updates
+        for satellite in self.satellites.values():
+            satellite.command_updates = command_updates
+
+    def prepare(self):
+        """Prepares every satellite concurrently. Returns a future that finishes once they're all ready."""
+        return asyncio.gather(*[satellite.prepare() for satellite in self.satellites.values()])
+
+    def start(self, gateway):
+        for satellite in self.satellites.values():
+            satellite.start(gateway=gateway)
+
+    def satellite_for(self, system):
+        if len(self.satellites) == 1:
+            return next(iter(self.satellites.values()))
+        return self.satellites.get(system)
+
+    async def command_callback(self, command, gateway):
+        satellite = self.satellite_for(command.system)
+        if satellite is None:
+            await (self.command_updates or gateway).fail_command(
+                command_id=command.id,
+                errors=[f"System: {command.system} is not served by this gateway. Satellites served: {list(self.satellites)}"])
+            return
+        await satellite.command_callback(command=command, gateway=gateway)
+
+    async def cancel_callback(self, command_id, gateway):
+        for satellite in self.satellites.values():
+            if command_id in satellite.running_commands:
+                await satellite.cancel_callback(command_id=command_id, gateway=gateway)
+                return
+        # The command already finished or never reached a satellite
+        await (self.command_updates or gateway).cancel_command(command_id=command_id)
@@ -55,3 +55,40 @@ class FileTransferError(GatewayError):
     def __init__(self, output):
         self.output = output
         super().__init__(f"File Failed to Transfer: {output.stderr.decode('ascii')}")
+
+
+class ServiceUnavailableError(GatewayError):
+    """
+    Raised without contacting a service whose circuit breaker is open after repeated failures.
+    *.service is the name of the GraphQL service or client binary
+    *.retry_in is the number of seconds until the service is tested again
+    """
+
+    def __init__(self, service, failures, retry_in):
+        self.service = service
+        self.retry_in = retry_in
+        super().__init__(
+            f"{service} is unavailable after {failures} failures in a row. It will be tried again in {retry_in:.0f}s.")
+
+
+class ServiceTimeoutError(GatewayError):
+    """
+    Raised when a service doesn't respond within its deadline.
+    *.deadline is the number of seconds it was given
+    """
+
+    def __init__(self, service, deadline):
+        self.service = service
+        self.deadline = deadline
+        super().__init__(f"{service} didn't respond within its deadline of {deadline:.1f}s")
+
+
+class FileProtocolError(GatewayError):
+    """
+    Raised when the file transfer service reports that a transfer failed, or a downloaded file doesn't match its hash.
+    *.service is the name of the file transfer service
+    """
+
+    def __init__(self, service, message):
+        self.service = service
+        super().__init__(f"File Failed to Transfer through {service}: {message}")
@@ -0,0 +1,151 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from kubos_sat import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCKING_WORKERS = 8
+
+_executor = None
+_max_workers = DEFAULT_BLOCKING_WORKERS
+
+
+def configure(max_workers=DEFAULT_BLOCKING_WORKERS):
+    """Sets the size of the shared executor used for blocking calls. Must be called before it is first used."""
+    global _max_workers
+    if _executor is not None:
+        logger.warning(
+            f"Blocking executor already started with {_max_workers} workers. Ignoring new size: {max_workers}")
+        return
+    _max_workers = max_workers
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=_max_workers, thread_name_prefix="kubos-gateway-blocking")
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking function in the shared, bounded executor so it doesn't stall the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_subprocess(args, check=False):
+    """
+    Runs a client binary as an asyncio subprocess.
+    Returns a subprocess.CompletedProcess so callers can treat it like the output of subprocess.run.
+    The child is killed if the awaiting task is cancelled.
+    """
+    with metrics.timed("subprocess", client=os.path.basename(args[0])):
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+    output = subprocess.CompletedProcess(
+        args=args, returncode=process.returncode, stdout=stdout, stderr=stderr)
+    if check:
+        output.check_returncode()
+    return output
+
+
+async def stream_subprocess(args, output_callback, read_size=4096):
+    """
+    Runs a client binary as an asyncio subprocess, awaiting output_callback(data) with each piece of its
+    stdout and stderr as it's produced, in the order it was written. Returns the exit status.
+    The pipe isn't read while output_callback runs, so a slow callback slows the child rather than buffering.
+    The child and anything it started are killed if the awaiting task is cancelled.
+    """
+    with metrics.timed("subprocess", client=os.path.basename(args[0])):
+        # In its own process group, so processes it starts that hold the pipe open are killed with it
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True)
+        try:
+            while True:
+                data = await process.stdout.read(read_size)
+                if not data:
+                    break
+                await output_callback(data)
+            return await process.wait()
+        except BaseException:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGKILL)
+            await process.wait()
+            raise
+
+
+def run_in_background(coroutine, tasks, description):
+    """
+    Runs a coroutine without waiting for it. Its task is held in the tasks set until it's done,
+    so it can't be garbage collected partway, and a failure is logged with the description.
+    """
+    task = asyncio.ensure_future(coroutine)
+    tasks.add(task)
+
+    def done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Failed to {description}: {type(task.exception()).__name__}: {task.exception()}")
+
+    task.add_done_callback(done)
+    return task
+
+
+class CommandLimiter:
+    """
+    Limits how many commands of each type can be resolved at once.
+    *.limits maps command types to their maximum number of concurrent commands
+    *.default_limit applies to any other command type. None means unlimited.
+    *.total_limit caps the number of commands of all types together. None means unlimited.
+    """
+
+    def __init__(self, limits=None, default_limit=None, total_limit=None):
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.semaphores = {}
+        self.total = asyncio.Semaphore(total_limit) if total_limit is not None else None
+
+    def _semaphore(self, command_type):
+        limit = self.limits.get(command_type, self.default_limit)
+        if limit is None:
+            return None
+        if command_type not in self.semaphores:
+            self.semaphores[command_type] = asyncio.Semaphore(limit)
+        return self.semaphores[command_type]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, command_type):
+        # The command type's limit is waited on first, so a command doesn't hold a share of the total while it waits
+        semaphores = [semaphore for semaphore in (self._semaphore(command_type), self.total) if semaphore is not None]
+        if not semaphores:
+            yield
+            return
+        acquired = []
+        try:
+            with metrics.timed("command_limit_wait", command_type=command_type):
+                for semaphore in semaphores:
+                    await semaphore.acquire()
+                    acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in acquired:
+                semaphore.release()
@@ -0,0 +1,181 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE_MB = 1024
+INDEX_FILENAME = "index.json"
+
+
+class FileCache:
+    """
+    Persistent on-disk cache of files, each stored under a key in an objects directory.
+    An index of the stored files is saved alongside them, and the least recently used
+    files are evicted when the cache is larger than its size cap.
+    """
+    name = "File cache"
+
+    def __init__(self, directory, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.directory = directory
+        self.objects_directory = os.path.join(directory, "objects")
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.pins = {}
+        os.makedirs(self.objects_directory, exist_ok=True)
+        self.index = self._load_index()
+
+    def _empty_index(self):
+        return {"objects": {}}
+
+    def _load_index(self):
+        index_path = os.path.join(self.directory, INDEX_FILENAME)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return self._empty_index()
+        except ValueError as e:
+            logger.warning(f"{self.name} index is corrupt, starting with an empty cache: {e}")
+            return self._empty_index()
+        # Drop entries whose files were removed from under the cache
+        index["objects"] = {
+            key: entry for key, entry in index["objects"].items()
+            if os.path.exists(self.object_path(key))}
+        self._drop_references(index)
+        return index
+
+    def _drop_references(self, index):
+        """Removes anything in the index that refers to objects that are no longer cached"""
+
+    def _save_index(self):
+        index_path = os.path.join(self.directory, INDEX_FILENAME)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+    def object_path(self, key):
+        return os.path.join(self.objects_directory, key)
+
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self.index["objects"].values())
+
+    def stats(self):
+        return f"{self.name}: {self.hits} hits, {self.misses} misses, {len(self.index['objects'])} files, {self.size / 1e6:.1f} MB"
+
+    def _touch(self, key):
+        self.index["objects"][key]["last_used"] = time.time()
+
+    @contextlib.contextmanager
+    def pinned(self, object_path):
+        """Keeps a cached file from being evicted while it's in use"""
+        key = os.path.basename(object_path)
+        self.pins[key] = self.pins.get(key, 0) + 1
+        try:
+            yield object_path
+        finally:
+            self.pins[key] -= 1
+            if self.pins[key] == 0:
+                del self.pins[key]
+
+    def evict(self, keep=None):
+        size = self.size
+        by_last_use = sorted(self.index["objects"].items(), key=lambda item: item[1]["last_used"])
+        for key, entry in by_last_use:
+            if size <= self.max_size:
+                break
+            if key == keep or key in self.pins:
+                continue
+            logger.debug(f"Evicting {key} from the {self.name.lower()}")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.object_path(key))
+            del self.index["objects"][key]
+            size -= entry["size"]
+        self._drop_references(self.index)
+
+
+class UplinkCache(FileCache):
+    """
+    Cache of staged files downloaded from Major Tom for uplink.
+    File contents are stored once per sha256 hash, and an index maps each staged file's
+    download path to its hash, so a repeat uplink of the same staged file skips the download.
+    """
+    name = "Uplink cache"
+
+    def _empty_index(self):
+        return {"paths": {}, "objects": {}}
+
+    def _drop_references(self, index):
+        index["paths"] = {
+            path: entry for path, entry in index["paths"].items()
+            if entry["hash"] in index["objects"]}
+
+    def lookup(self, gateway_download_path):
+        """Returns the filename and cached file path for a staged file, or None if it isn't cached"""
+        entry = self.index["paths"].get(gateway_download_path)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(entry["hash"])
+        self._save_index()
+        return entry["filename"], self.object_path(entry["hash"])
+
+    def store(self, gateway_download_path, filename, local_path, digest):
+        """Moves a downloaded file into the cache and returns its cached path"""
+        object_path = self.object_path(digest)
+        if digest in self.index["objects"]:
+            # Same contents as a file that's already cached
+            os.remove(local_path)
+        else:
+            os.replace(local_path, object_path)
+            self.index["objects"][digest] = {"size": os.path.getsize(object_path)}
+        self._touch(digest)
+        self.index["paths"][gateway_download_path] = {"filename": filename, "hash": digest}
+        self.evict(keep=digest)
+        self._save_index()
+        return object_path
+
+
+class DownlinkCache(FileCache):
+    """
+    Cache of files downlinked from the satellite.
+    Each file is stored with the version (size and modification time) it had on the satellite
+    when it was downlinked, so an unchanged file can be re-uploaded without transferring it again.
+    """
+    name = "Downlink cache"
+
+    @staticmethod
+    def key(remote_path):
+        return hashlib.sha256(remote_path.encode()).hexdigest()
+
+    def lookup(self, remote_path, version):
+        """Returns the cached file path if the file hasn't changed on the satellite, otherwise None"""
+        key = self.key(remote_path)
+        entry = self.index["objects"].get(key)
+        if entry is None or entry["version"] != list(version):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(key)
+        self._save_index()
+        return self.object_path(key)
+
+    def store(self, remote_path, version, local_path):
+        """Moves a downlinked file into the cache and returns its cached path"""
+        key = self.key(remote_path)
+        object_path = self.object_path(key)
+        os.replace(local_path, object_path)
+        self.index["objects"][key] = {
+            "remote_path": remote_path,
+            "version": list(version),
+            "size": os.path.getsize(object_path)}
+        self._touch(key)
+        self.evict(keep=key)
+        self._save_index()
+        return object_path
@@ -0,0 +1,418 @@
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import random
+import socket
+import struct
+from kubos_sat import executor
+from kubos_sat import metrics
+from kubos_sat.exceptions import FileProtocolError, ServiceTimeoutError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 4096
+DEFAULT_WINDOW = 64
+DEFAULT_TIMEOUT = 2
+DEFAULT_RETRIES = 5
+MAX_CHUNK_SIZE = 65000  # A chunk and its header have to fit in one UDP datagram
+HASH_SIZE = 16
+RECEIVE_BUFFER = 4 * 1024 * 1024  # Room for a burst of chunks from the service, capped by the OS at net.core.rmem_max
+
+_enabled = False
+_chunk_size = DEFAULT_CHUNK_SIZE
+_window = DEFAULT_WINDOW
+_timeout = DEFAULT_TIMEOUT
+_retries = DEFAULT_RETRIES
+_endpoints = {}  # Endpoint bound to each local address, shared by the transfers using it
+_binding = asyncio.Lock()
+
+
+def configure(enabled=False, chunk_size=DEFAULT_CHUNK_SIZE, window=DEFAULT_WINDOW, timeout=DEFAULT_TIMEOUT,
+              retries=DEFAULT_RETRIES):
+    """Sets whether transfers use the native client instead of the file client binary, and how it sends files"""
+    global _enabled, _chunk_size, _window, _timeout, _retries
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise ValueError(f"File protocol chunk-size must be between 1 and {MAX_CHUNK_SIZE}, not: {chunk_size}")
+    _enabled = enabled
+    _chunk_size = chunk_size
+    _window = window
+    _timeout = timeout
+    _retries = retries
+
+
+def enabled():
+    return _enabled
+
+
+# The file transfer service's messages are CBOR arrays. Only the types they use are supported:
+# integers, byte and text strings, arrays, booleans and null.
+
+def _head(major, value):
+    if value < 24:
+        return bytes((major << 5 | value,))
+    if value < 0x100:
+        return struct.pack(">BB", major << 5 | 24, value)
+    if value < 0x10000:
+        return struct.pack(">BH", major << 5 | 25, value)
+    if value < 0x100000000:
+        return struct.pack(">BI", major << 5 | 26, value)
+    return struct.pack(">BQ", major << 5 | 27, value)
+
+
+def _encode(value, parts):
+    if value is True:
+        parts.append(b"\xf5")
+    elif value is False:
+        parts.append(b"\xf4")
+    elif value is None:
+        parts.append(b"\xf6")
+    elif isinstance(value, int):
+        parts.append(_head(0, value) if value >= 0 else _head(1, -1 - value))
+    elif isinstance(value, str):
+        encoded = value.encode()
+        parts.append(_head(3, len(encoded)))
+        parts.append(encoded)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(_head(2, memoryview(value).nbytes))
+        parts.append(value)
+    elif isinstance(value, (list, tuple)):
+        parts.append(_head(4, len(value)))
+        for item in value:
+            _encode(item, parts)
+    else:
+        raise TypeError(f"Can't encode {type(value).__name__} in a file protocol message")
+
+
+def encode(message):
+    """Returns the datagram for a message. Byte strings, such as chunks, are copied straight into it."""
+    parts = []
+    _encode(message, parts)
+    return b"".join(parts)
+
+
+def _decode(view, offset):
+    initial = view[offset]
+    major, info = initial >> 5, initial & 0x1f
+    offset += 1
+    if major == 7:
+        if info not in (20, 21, 22):
+            raise ValueError(f"Unsupported CBOR simple value: {info}")
+        return (False, True, None)[info - 20], offset
+    if info < 24:
+        value = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        value = int.from_bytes(view[offset:offset + size], "big")
+        offset += size
+    else:
+        raise ValueError("Indefinite length CBOR items aren't supported")
+    if major == 0:
+        return value, offset
+    if major == 1:
+        return -1 - value, offset
+    if major in (2, 3):
+        if offset + value > len(view):
+            raise ValueError("Truncated CBOR string")
+        string = view[offset:offset + value]
+        return (string if major == 2 else str(string, "utf-8")), offset + value
+    if major == 4:
+        items = []
+        for _ in range(value):
+            item, offset = _decode(view, offset)
+            items.append(item)
+        return items, offset
+    raise ValueError(f"Unsupported CBOR major type: {major}")
+
+
+def decode(datagram):
+    """
+    Returns the message in a datagram. Byte strings are returned as memoryviews of the datagram,
+    so chunks aren't copied until they're written to disk.
+    """
+    view = memoryview(datagram)
+    try:
+        message, end = _decode(view, 0)
+    except IndexError:
+        raise ValueError("Truncated CBOR message") from None
+    if end != len(view):
+        raise ValueError(f"{len(view) - end} bytes after the end of the CBOR message")
+    return message
+
+
+def missing_ranges(missing):
+    """Flattens sorted chunk indexes into [start, end, start, end...], with exclusive ends, as sent in a NAK"""
+    ranges = []
+    for index in missing:
+        if ranges and ranges[-1] == index:
+            ranges[-1] = index + 1
+        else:
+            ranges.extend((index, index + 1))
+    return ranges
+
+
+def ranges_indexes(ranges):
+    """Chunk indexes in the ranges of a NAK, which are either flattened or [start, end] pairs"""
+    if ranges and isinstance(ranges[0], list):
+        ranges = [bound for pair in ranges for bound in pair]
+    for start, end in zip(ranges[::2], ranges[1::2]):
+        yield from range(start, end)
+
+
+def file_hash(data):
+    return hashlib.blake2b(data, digest_size=HASH_SIZE).hexdigest()
+
+
+def _hash_file(path):
+    digest = hashlib.blake2b(digest_size=HASH_SIZE)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_chunks(fd, chunks, chunk_length):
+    for index, chunk in chunks:
+        os.pwrite(fd, chunk, index * chunk_length)
+
+
+class Endpoint(asyncio.DatagramProtocol):
+    """
+    UDP socket on the gateway's downlink address. Transfers share it, each on its own channel,
+    and the messages it receives are passed to the transfer of their channel.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.channels = {}  # Queue of received messages for each transfer, by channel id
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+
+    def datagram_received(self, data, addr):
+        try:
+            message = decode(data)
+            queue = self.channels.get(message[0])
+        except (ValueError, TypeError, IndexError, KeyError) as e:
+            logger.debug(f"Ignoring malformed file protocol message from {addr}: {e}")
+            metrics.increment("file_protocol_malformed_total")
+            return
+        if queue is None:
+            # Usually a late retransmission for a transfer that has finished
+            logger.debug(f"Ignoring file protocol message for unknown channel {message[0]} from {addr}")
+            return
+        queue.put_nowait(message)
+
+    def error_received(self, exc):
+        logger.debug(f"File protocol socket error: {type(exc).__name__}: {exc}")
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def open_channel(self):
+        channel_id = random.randint(1, 0xffffffff)
+        while channel_id in self.channels:
+            channel_id = random.randint(1, 0xffffffff)
+        self.channels[channel_id] = asyncio.Queue()
+        return channel_id
+
+
+async def get_endpoint(host, port):
+    async with _binding:
+        endpoint = _endpoints.get((host, port))
+        if endpoint is None or endpoint.transport is None or endpoint.transport.is_closing():
+            _, endpoint = await asyncio.get_running_loop().create_datagram_endpoint(
+                Endpoint, local_addr=(host, port))
+            _endpoints[(host, port)] = endpoint
+        return endpoint
+
+
+class Transfer:
+    """
+    One upload or download over a channel of an endpoint.
+    Uploads are sent in bursts of window chunks, waiting for the socket to drain between them.
+    Downloads are written to disk window chunks at a time.
+    Only the chunks the receiver reports missing are sent again. A transfer fails with ServiceTimeoutError
+    after retries waits of timeout seconds in a row without hearing from the service.
+    progress_callback is called with the bytes transferred so far and the total size (None until it's known).
+    """
+
+    def __init__(self, endpoint, remote, chunk_size, window, timeout, retries, progress_callback=None):
+        self.endpoint = endpoint
+        self.remote = remote
+        self.chunk_size = chunk_size
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.progress_callback = progress_callback
+        self.service = f"File transfer service {remote[0]}:{remote[1]}"
+        self.channel_id = None
+        self.messages = None
+
+    async def __aenter__(self):
+        self.channel_id = self.endpoint.open_channel()
+        self.messages = self.endpoint.channels[self.channel_id]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        del self.endpoint.channels[self.channel_id]
+
+    def send(self, *message):
+        self.endpoint.transport.sendto(encode([self.channel_id, *message]), self.remote)
+
+    async def receive(self, attempts):
+        """The next message on the channel, or None after timeout seconds without one"""
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            if attempts >= self.retries:
+                raise ServiceTimeoutError(service=self.service, deadline=self.timeout * (attempts + 1)) from None
+            return None
+
+    def progress(self, done, total):
+        if self.progress_callback is not None:
+            self.progress_callback(done, total)
+
+    async def send_chunks(self, data, file_digest, indexes):
+        sent = 0
+        for count, index in enumerate(indexes, 1):
+            start = index * self.chunk_size
+            # Sliced in the call so no view of the file outlives it
+            self.send(file_digest, index, data[start:start + self.chunk_size])
+            sent += min(self.chunk_size, len(data) - start)
+            if count % self.window == 0:
+                await self.endpoint.writable.wait()
+                await asyncio.sleep(0)
+        return sent
+
+    async def upload(self, local_path, remote_path):
+        with open(local_path, "rb") as f:
+            mode = os.fstat(f.fileno()).st_mode & 0o777
+            if os.fstat(f.fileno()).st_size == 0:
+                return await self._upload(b"", mode, remote_path)
+            # Mapped rather than read, so chunks are slices of the page cache instead of copies of the file
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as data:
+                return await self._upload(data, mode, remote_path)
+
+    async def _upload(self, data, mode, remote_path):
+        size = len(data)
+        num_chunks = -(-size // self.chunk_size)
+        file_digest = await executor.run_blocking(file_hash, data)
+        self.send(file_digest, num_chunks)
+        self.send("export", file_digest, remote_path, mode)
+        sent = await self.send_chunks(data, file_digest, range(num_chunks))
+        self.progress(sent, size)
+        attempts = 0
+        while True:
+            message = await self.receive(attempts)
+            if message is None:
+                attempts += 1
+                # The service answers the repeated request with an ACK or NAK, so lost chunks are found either way
+                self.send(file_digest, num_chunks)
+                self.send("export", file_digest, remote_path, mode)
+                continue
+            attempts = 0
+            if len(message) == 4 and message[1] == file_digest and message[2] is False:
+                missing = list(ranges_indexes(message[3]))
+                metrics.increment("file_protocol_retransmitted_chunks", len(missing), direction="upload")
+                await self.send_chunks(data, file_digest, missing)
+            elif len(message) == 4 and message[1] == file_digest and message[2] is True:
+                self.progress(size, size)
+            elif message[1] is True and len(message) == 2:
+                return f"Uploaded {size} bytes in {num_chunks} chunks to {remote_path}"
+            elif message[1] is False:
+                raise FileProtocolError(service=self.service, message=message[2] if len(message) > 2 else "")
+
+    async def download(self, remote_path, local_path):
+        self.send("import", remote_path)
+        attempts = 0
+        while True:
+            message = await self.receive(attempts)
+            if message is None:
+                attempts += 1
+                self.send("import", remote_path)
+            elif message[1] is False:
+                raise FileProtocolError(service=self.service, message=message[2] if len(message) > 2 else "")
+            elif message[1] is True and len(message) == 5:
+                break
+        _, _, file_digest, num_chunks, mode = message
+        fd = await executor.run_blocking(os.open, local_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = await self._download(fd, file_digest, num_chunks)
+        finally:
+            os.close(fd)
+        self.send(file_digest, True, num_chunks)
+        received_digest = await executor.run_blocking(_hash_file, local_path)
+        if received_digest != file_digest:
+            raise FileProtocolError(
+                service=self.service,
+                message=f"Hash of downloaded {remote_path} is {received_digest}, not {file_digest}")
+        return f"Downloaded {size} bytes in {num_chunks} chunks from {remote_path}"
+
+    def request_missing(self, file_digest, num_chunks, received):
+        """Sends a NAK for the chunks not received yet, and returns the last of them"""
+        missing = [index for index in range(num_chunks) if index not in received]
+        metrics.increment("file_protocol_retransmitted_chunks", len(missing), direction="download")
+        self.send(file_digest, False, missing_ranges(missing))
+        return missing[-1]
+
+    async def _download(self, fd, file_digest, num_chunks):
+        received = set()
+        pending = []  # Chunks received but not yet written, as (index, data)
+        chunk_length = None  # Length of every chunk but the last, set by the service
+        done = 0
+        attempts = 0
+        # Missing chunks are requested as soon as the last chunk of the current pass arrives,
+        # or after timeout seconds without a message if that one is lost too
+        last_in_pass = num_chunks - 1
+        while len(received) < num_chunks:
+            message = await self.receive(attempts)
+            if message is None:
+                attempts += 1
+                last_in_pass = self.request_missing(file_digest, num_chunks, received)
+                continue
+            attempts = 0
+            if message[1] is False:
+                raise FileProtocolError(service=self.service, message=message[2] if len(message) > 2 else "")
+            if len(message) != 4 or message[1] != file_digest or not isinstance(message[3], memoryview):
+                continue
+            index, chunk = message[2], message[3]
+            if index in received or not 0 <= index < num_chunks:
+                continue
+            received.add(index)
+            pending.append((index, chunk))
+            if index < num_chunks - 1:
+                chunk_length = len(chunk)
+            done += len(chunk)
+            self.progress(done, None)
+            if index == last_in_pass and len(received) < num_chunks:
+                last_in_pass = self.request_missing(file_digest, num_chunks, received)
+            if len(pending) >= self.window and (chunk_length is not None or num_chunks == 1):
+                await executor.run_blocking(_write_chunks, fd, pending, chunk_length or 0)
+                pending = []
+        if pending:
+            await executor.run_blocking(_write_chunks, fd, pending, chunk_length or 0)
+        return done
+
+
+async def transfer(connection_type, local_address, remote_address, local_filepath, remote_filepath,
+                   progress_callback=None):
+    """
+    Uploads or downloads a file with the file transfer service at remote_address, receiving its replies on
+    local_address. Returns a summary of the transfer.
+    """
+    endpoint = await get_endpoint(*local_address)
+    async with Transfer(
+            endpoint=endpoint, remote=remote_address, chunk_size=_chunk_size, window=_window,
+            timeout=_timeout, retries=_retries, progress_callback=progress_callback) as channel:
+        with metrics.timed("file_protocol", direction=connection_type):
+            if connection_type == "upload":
+                return await channel.upload(local_path=local_filepath, remote_path=remote_filepath)
+            return await channel.download(remote_path=remote_filepath, local_path=local_filepath)
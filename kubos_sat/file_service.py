@@ -1,17 +1,153 @@
 import asyncio
+import contextlib
+import heapq
+import itertools
 import time
 import traceback
 import logging
 import toml
-import subprocess
 import os
 import datetime
+import shlex
 import uuid
+from kubos_sat import executor
+from kubos_sat import breakers
+from kubos_sat import compression
+from kubos_sat import file_protocol
+from kubos_sat import major_tom
+from kubos_sat import metrics
 from kubos_sat.tools import check_client
 from kubos_sat.exceptions import *
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TRANSFER_WORKERS = 2
+PROGRESS_INTERVAL = 10
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class TransferScheduler:
+    """
+    Runs file client transfers on a fixed number of parallel workers.
+    Waiting transfers are started highest priority first, then in the order they were submitted,
+    and their queue position is reported to Major Tom as it changes.
+    When the workers are shared by several satellites, each transfer can be given an owner and a limit
+    on how many workers that owner can use at once, so one satellite can't hold all of them.
+    """
+
+    def __init__(self, workers=DEFAULT_TRANSFER_WORKERS):
+        self.workers = workers
+        self.active = 0
+        self.active_by_owner = {}
+        self.waiting = []
+        self.owner_limits = {}
+        self.sequence = itertools.count()
+        self.changed = asyncio.Condition()
+        self.updates = set()  # Queue position updates being sent
+
+    def position(self, entry):
+        return sum(1 for waiting in self.waiting if waiting < entry) + 1
+
+    def next_entry(self):
+        """Highest priority waiting transfer whose owner is under its limit, or None"""
+        for entry in sorted(self.waiting):
+            owner = entry[2]
+            if self.active_by_owner.get(owner, 0) < self.owner_limits.get(owner, self.workers):
+                return entry
+        return None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority="normal", gateway=None, command_id=None, owner=None, owner_limit=None):
+        entry = (PRIORITIES[priority], next(self.sequence), owner)
+        if owner_limit is not None:
+            self.owner_limits[owner] = owner_limit
+        with metrics.timed("transfer_wait", priority=priority):
+            async with self.changed:
+                heapq.heappush(self.waiting, entry)
+                self.changed.notify_all()
+                try:
+                    reported = None
+                    while self.active >= self.workers or self.next_entry() != entry:
+                        position = self.position(entry)
+                        if gateway is not None and position != reported:
+                            executor.run_in_background(
+                                gateway.transmit_command_update(
+                                    command_id=command_id,
+                                    state="processing_on_gateway",
+                                    dict={
+                                        "status": f"Waiting for a transfer worker. Position in transfer queue: {position} of {len(self.waiting)} ({priority} priority)"}),
+                                tasks=self.updates, description="send a transfer queue position")
+                            reported = position
+                        await self.changed.wait()
+                except BaseException:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.changed.notify_all()
+                    raise
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.active += 1
+                self.active_by_owner[owner] = self.active_by_owner.get(owner, 0) + 1
+                self.changed.notify_all()
+        try:
+            yield
+        finally:
+            async with self.changed:
+                self.active -= 1
+                self.active_by_owner[owner] -= 1
+                self.changed.notify_all()
+
+
+async def report_progress(gateway, command_id, state, description, interval=PROGRESS_INTERVAL):
+    """Sends periodic status updates while a transfer without its own progress reporting runs"""
+    start = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        await gateway.transmit_command_update(
+            command_id=command_id,
+            state=state,
+            dict={"status": f"{description} ({int(time.monotonic() - start)}s elapsed)"})
+
+
+class ProgressUpdater:
+    """Progress callback that sends at most one status update to Major Tom per interval"""
+
+    def __init__(self, gateway, command_id, state, description, interval=PROGRESS_INTERVAL):
+        self.gateway = gateway
+        self.command_id = command_id
+        self.state = state
+        self.description = description
+        self.interval = interval
+        self.last_update = time.monotonic()
+        self.updates = set()  # Progress updates being sent
+
+    def __call__(self, done, total):
+        now = time.monotonic()
+        if now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        if total:
+            progress = f"{done / 1e6:.1f} of {total / 1e6:.1f} MB, {100 * done / total:.0f}%"
+        else:
+            progress = f"{done / 1e6:.1f} MB"
+        executor.run_in_background(
+            self.gateway.transmit_command_update(
+                command_id=self.command_id,
+                state=self.state,
+                dict={"status": f"{self.description} ({progress})"}),
+            tasks=self.updates, description="send a transfer progress update")
+
+
+@contextlib.contextmanager
+def removed_on_error(path):
+    """Deletes a partially written file if the transfer writing it fails or is cancelled"""
+    try:
+        yield
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        raise
+
 
 class FileService:
     def __init__(self, port, file_client_path, downlink_ip, downlink_port):
@@ -21,10 +157,12 @@ class FileService:
         self.downlink_port = str(downlink_port)
 
     def build(self, kubos_sat):
-        success = check_client(client_path=kubos_sat.file_client_path,
-                               service_name="file-transfer-service")
-        if not success:
-            return
+        # The native client doesn't need the binary
+        if not file_protocol.enabled():
+            success = check_client(client_path=kubos_sat.file_client_path,
+                                   service_name="file-transfer-service")
+            if not success:
+                return
         kubos_sat.definitions["uplink_file"] = {
             "display_name": "Uplink File",
             "description": "Uplink a staged file to the spacecraft. Leave destination_name empty to keep the same name. If the app-service is present in the config file, you can also have it automatically register the app after completing the transfer.",
@@ -33,7 +171,9 @@ class FileService:
                 {"name": "destination_directory", "type": "string",
                     "default": kubos_sat.default_uplink_dir},
                 {"name": "destination_name", "type": "string"},
-                {"name": "gateway_download_path", "type": "string"}
+                {"name": "gateway_download_path", "type": "string"},
+                {"name": "priority", "type": "string", "range": list(PRIORITIES), "default": "normal"},
+                compression.field(kubos_sat)
             ]
         }
         kubos_sat.definitions["downlink_file"] = {
@@ -41,7 +181,9 @@ class FileService:
             "description": "Downlink a file from the spacecraft. The full path of the file must be in the filename.",
             "tags": ["File Transfer"],
             "fields": [
-                {"name": "filename", "type": "string"}
+                {"name": "filename", "type": "string"},
+                {"name": "priority", "type": "string", "range": list(PRIORITIES), "default": "normal"},
+                compression.field(kubos_sat)
             ]
         }
         if "app-service" in kubos_sat.config:
@@ -61,126 +203,388 @@ class FileService:
             ]
         }
 
-    def uplink_file(self, kubos_sat, gateway, command):
-        logger.debug("Downloading file from Major Tom")
-        asyncio.ensure_future(gateway.transmit_command_update(
-            command_id=command.id,
-            state="processing_on_gateway",
-            dict={
-                "status": "Downloading Staged File from Major Tom for Transmission"}))
-        local_filename, content = gateway.download_staged_file(
-            gateway_download_path=command.fields["gateway_download_path"])
-        logger.debug(f'Writing file: "{local_filename}" locally')
-        asyncio.ensure_future(gateway.transmit_command_update(
-            command_id=command.id,
-            state="processing_on_gateway",
-            dict={
-                "status": f"Writing file: {local_filename} locally"}))
-        with open(local_filename, "wb") as f:
-            f.write(content)
-        try:
-            if command.fields["destination_name"] == "":
-                destination_name = local_filename
-            else:
-                destination_name = command.fields["destination_name"]
-            destination_path = command.fields["destination_directory"] + destination_name
-            asyncio.ensure_future(gateway.transmit_command_update(
+    async def uplink_file(self, kubos_sat, gateway, command):
+        cache = kubos_sat.uplink_cache
+        cached = None
+        if cache is not None:
+            cached = cache.lookup(command.fields["gateway_download_path"])
+        if cached is not None:
+            local_filename, local_path = cached
+            logger.debug(f"Using cached copy of staged file: {local_filename}")
+            await gateway.transmit_command_update(
+                command_id=command.id,
+                state="processing_on_gateway",
+                dict={
+                    "status": f"Using cached copy of staged file: {local_filename}"})
+        else:
+            logger.debug("Downloading file from Major Tom")
+            await gateway.transmit_command_update(
                 command_id=command.id,
-                state="uplinking_to_system",
+                state="processing_on_gateway",
                 dict={
-                    "status": f"Uploading {local_filename} to {destination_path} on satellite."}))
-            output = self.file_client(
-                connection_type="upload",
-                ip=kubos_sat.ip,
-                local_filepath=local_filename,
-                remote_filepath=destination_path)
+                    "status": "Downloading Staged File from Major Tom for Transmission"})
+            local_filename, local_path, digest = await major_tom.download_staged_file(
+                gateway=gateway,
+                gateway_download_path=command.fields["gateway_download_path"],
+                directory=cache.directory if cache is not None else ".",
+                hash_algorithm="sha256" if cache is not None else None,
+                progress_callback=ProgressUpdater(
+                    gateway=gateway,
+                    command_id=command.id,
+                    state="processing_on_gateway",
+                    description="Downloading Staged File from Major Tom for Transmission"))
+            if digest is not None:
+                await gateway.transmit_command_update(
+                    command_id=command.id,
+                    state="processing_on_gateway",
+                    dict={
+                        "status": f"Downloaded staged file: {local_filename} ({digest})"})
+            if cache is not None:
+                local_path = cache.store(
+                    gateway_download_path=command.fields["gateway_download_path"],
+                    filename=local_filename,
+                    local_path=local_path,
+                    digest=digest)
+        try:
+            if cache is not None:
+                pin = cache.pinned(local_path)
+            else:
+                pin = contextlib.nullcontext()
+            with pin:
+                if command.fields["destination_name"] == "":
+                    destination_name = local_filename
+                else:
+                    destination_name = command.fields["destination_name"]
+                destination_path = command.fields["destination_directory"] + destination_name
+                output, savings = await self.uplink_transfer(
+                    kubos_sat=kubos_sat,
+                    gateway=gateway,
+                    command=command,
+                    local_filename=local_filename,
+                    local_path=local_path,
+                    destination_path=destination_path)
+            details = ""
+            if savings is not None:
+                details += f"\n{savings}"
+            if cache is not None:
+                details += f"\n{cache.stats()}"
             if command.fields["register_as_mission_app"] == "yes":
-                asyncio.ensure_future(gateway.transmit_command_update(
+                # Registering completes the command with the app service's response, so the details go in the status
+                await gateway.transmit_command_update(
                     command_id=command.id,
                     state="executing_on_system",
-                    dict={"status": "File transferred successfully. Registering with the mission app service."}))
-                kubos_sat.app_service.register_app(
+                    dict={"status": f"File transferred successfully. Registering with the mission app service.{details}"})
+                await kubos_sat.app_service.register_app(
                     kubos_sat=kubos_sat, gateway=gateway,
                     command=command, app_path=destination_path)
             else:
-                asyncio.ensure_future(gateway.complete_command(
+                await gateway.complete_command(
                     command_id=command.id,
-                    output=output.stdout.decode('ascii')))
+                    output=output + details)
         finally:
-            logger.debug(f"Deleting local file: {local_filename}")
-            os.remove(local_filename)
+            # Cached files are kept for the next uplink
+            if cache is None:
+                logger.debug(f"Deleting local file: {local_path}")
+                os.remove(local_path)
 
-    def downlink_file(self, kubos_sat, gateway, command):
-        local_filename = f"tempfile{str(uuid.uuid4())}.tmp"
+    async def downlink_file(self, kubos_sat, gateway, command):
         if command.fields["filename"].strip() == '':
-            asyncio.ensure_future(gateway.fail_command(
+            await gateway.fail_command(
                 command_id=command.id,
-                errors=["filename cannot be empty"]))
+                errors=["filename cannot be empty"])
             return
 
-        asyncio.ensure_future(gateway.transmit_command_update(
-            command_id=command.id,
-            state="downlinking_from_system",
-            dict={
-                "status": f"Downlinking file: {command.fields['filename']}"}))
-
-        output = self.file_client(
-            connection_type="download",
-            ip=kubos_sat.ip,
-            remote_filepath=command.fields["filename"],
-            local_filepath=local_filename)
+        cache = kubos_sat.downlink_cache
+        version = None
+        cached_path = None
+        savings = None
+        if cache is not None:
+            version = await self.remote_version(kubos_sat=kubos_sat, remote_path=command.fields["filename"])
+            if version is not None:
+                cached_path = cache.lookup(remote_path=command.fields["filename"], version=version)
 
-        try:
-            asyncio.ensure_future(gateway.transmit_command_update(
+        if cached_path is not None:
+            await gateway.transmit_command_update(
                 command_id=command.id,
                 state="processing_on_gateway",
                 dict={
-                    "status": f"File: {command.fields['filename']} successfully Downlinked! Uploading to Major Tom."}))
-            gateway.upload_downlinked_file(
-                filename=command.fields["filename"],
-                filepath=local_filename,
-                system=kubos_sat.name,
-                timestamp=time.time()*1000,
+                    "status": f"File: {command.fields['filename']} is unchanged since it was last downlinked. Uploading cached copy to Major Tom."})
+            local_filename = cached_path
+        else:
+            local_filename = f"tempfile{str(uuid.uuid4())}.tmp"
+            if cache is not None:
+                local_filename = os.path.join(cache.directory, local_filename)
+            with removed_on_error(local_filename):
+                _, savings = await self.downlink_transfer(
+                    kubos_sat=kubos_sat,
+                    gateway=gateway,
+                    command=command,
+                    remote_path=command.fields["filename"],
+                    local_path=local_filename,
+                    size=version[1] if version is not None else None)
+            if version is not None:
+                local_filename = cache.store(
+                    remote_path=command.fields["filename"], version=version, local_path=local_filename)
+            await gateway.transmit_command_update(
                 command_id=command.id,
-                metadata=None)
-            asyncio.ensure_future(gateway.complete_command(
+                state="processing_on_gateway",
+                dict={
+                    "status": f"File: {command.fields['filename']} successfully Downlinked! Uploading to Major Tom."})
+
+        try:
+            if version is not None:
+                pin = cache.pinned(local_filename)
+            else:
+                pin = contextlib.nullcontext()
+            with pin:
+                # Runs after the transfer worker is released, so the next downlink can use the link while this uploads
+                await major_tom.upload_downlinked_file(
+                    gateway=gateway,
+                    filename=command.fields["filename"],
+                    filepath=local_filename,
+                    system=kubos_sat.name,
+                    timestamp=time.time()*1000,
+                    command_id=command.id,
+                    metadata=None,
+                    progress_callback=ProgressUpdater(
+                        gateway=gateway,
+                        command_id=command.id,
+                        state="processing_on_gateway",
+                        description=f"Uploading {command.fields['filename']} to Major Tom"))
+            output = f'Downlinked File: {command.fields["filename"]} Uploaded to Major Tom.'
+            if savings is not None:
+                output += f"\n{savings}"
+            if cache is not None:
+                output += f"\n{cache.stats()}"
+            await gateway.complete_command(
                 command_id=command.id,
-                output=f'Downlinked File: {command.fields["filename"]} Uploaded to Major Tom.'))
+                output=output)
         finally:
-            os.remove(local_filename)
+            # Cached files are kept for the next downlink
+            if version is None:
+                os.remove(local_filename)
 
-    def update_kubos_config_toml(self, kubos_sat, gateway, command):
-        local_filename = f"tempfile{str(uuid.uuid4())}.tmp"
+    async def uplink_transfer(self, kubos_sat, gateway, command, local_filename, local_path, destination_path):
+        """
+        Uploads a file, gzip compressed and decompressed on the satellite if the command's compression field asks for it.
+        Returns the file client's output, and a summary of the bytes saved if it was compressed.
+        """
+        transfer = dict(
+            kubos_sat=kubos_sat,
+            gateway=gateway,
+            command=command,
+            priority=command.fields.get("priority", "normal"),
+            state="uplinking_to_system",
+            description=f"Uploading {local_filename} to {destination_path} on satellite.",
+            connection_type="upload")
+        mode = command.fields.get("compression", "no")
+        size = os.path.getsize(local_path)
+        if not (compression.available(kubos_sat) and compression.worth_compressing(mode, local_filename, size)):
+            return await self.scheduled_transfer(local_filepath=local_path, remote_filepath=destination_path, **transfer), None
 
-        asyncio.ensure_future(gateway.transmit_command_update(
-            command_id=command.id,
+        compressed_path = f"{local_path}.{uuid.uuid4()}.gz"
+        remote_compressed = compression.remote_path(destination_path, suffix=command.id)
+        try:
+            await gateway.transmit_command_update(
+                command_id=command.id,
+                state="processing_on_gateway",
+                dict={"status": f"Compressing {local_filename} for transfer"})
+            compressed_size = await executor.run_blocking(compression.compress_file, local_path, compressed_path)
+            if mode == "auto" and not compression.saves_enough(size, compressed_size):
+                logger.debug(f"Compressing {local_filename} only saved {size - compressed_size} bytes. Sending it uncompressed.")
+                return await self.scheduled_transfer(local_filepath=local_path, remote_filepath=destination_path, **transfer), None
+            # Both the compressed copy and the decompressed file are on the satellite while it's decompressed
+            await self.check_remote_space(
+                kubos_sat=kubos_sat, command=command,
+                needed={destination_path: size, remote_compressed: compressed_size})
+            limit = await self.remote_limit(kubos_sat=kubos_sat)
+            try:
+                output = await self.scheduled_transfer(
+                    local_filepath=compressed_path, remote_filepath=remote_compressed, **transfer)
+                await gateway.transmit_command_update(
+                    command_id=command.id,
+                    state="executing_on_system",
+                    dict={"status": f"Decompressing {destination_path} on the satellite"})
+                await kubos_sat.shell_service.long_shell_client(
+                    ip=kubos_sat.ip, command=compression.decompress_command(remote_compressed, destination_path, limit=limit))
+            finally:
+                await self.remove_remote(kubos_sat=kubos_sat, remote_path=remote_compressed)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(compressed_path)
+        metrics.increment("compression_saved_bytes", size - compressed_size, direction="upload")
+        return output, compression.savings(size, compressed_size)
+
+    async def downlink_transfer(self, kubos_sat, gateway, command, remote_path, local_path, size=None):
+        """
+        Downloads a file, gzip compressed on the satellite first if the command's compression field asks for it.
+        Returns the file client's output, and a summary of the bytes saved if it was compressed.
+        size is the file's size on the satellite, if it's known.
+        """
+        transfer = dict(
+            kubos_sat=kubos_sat,
+            gateway=gateway,
+            command=command,
+            priority=command.fields.get("priority", "normal"),
             state="downlinking_from_system",
-            dict={
-                "status": f"Downlinking file: {command.fields['config_location']}"}))
+            description=f"Downlinking file: {remote_path}",
+            connection_type="download")
+        mode = command.fields.get("compression", "no")
+        if not compression.available(kubos_sat) or not compression.worth_compressing(mode, remote_path, size):
+            return await self.scheduled_transfer(local_filepath=local_path, remote_filepath=remote_path, **transfer), None
+        if size is None:
+            # Needed to check there's room to compress it, and small files aren't worth the extra round trips
+            version = await self.remote_version(kubos_sat=kubos_sat, remote_path=remote_path)
+            if version is not None:
+                size = version[1]
+                if not compression.worth_compressing(mode, remote_path, size):
+                    return await self.scheduled_transfer(local_filepath=local_path, remote_filepath=remote_path, **transfer), None
 
-        output = self.file_client(
-            connection_type="download",
-            ip=kubos_sat.ip,
-            remote_filepath=command.fields["config_location"],
-            local_filepath=local_filename)
+        compressed_path = f"{local_path}.gz"
+        remote_compressed = compression.remote_path(remote_path, suffix=command.id)
+        if size is not None:
+            # The compressed copy is at most about the size of the file
+            shortfall = compression.space_shortfall(
+                await self.remote_free_space(kubos_sat=kubos_sat, paths=[remote_compressed]), [size])
+            if shortfall is not None:
+                logger.info(f"Not enough space on the satellite to compress {remote_path} ({shortfall}). Sending it uncompressed.")
+                return await self.scheduled_transfer(local_filepath=local_path, remote_filepath=remote_path, **transfer), None
+        limit = await self.remote_limit(kubos_sat=kubos_sat)
+        try:
+            await gateway.transmit_command_update(
+                command_id=command.id,
+                state="executing_on_system",
+                dict={"status": f"Compressing {remote_path} on the satellite"})
+            try:
+                await kubos_sat.shell_service.long_shell_client(
+                    ip=kubos_sat.ip, command=compression.compress_command(remote_path, remote_compressed, limit=limit))
+                output = await self.scheduled_transfer(
+                    local_filepath=compressed_path, remote_filepath=remote_compressed, **transfer)
+            finally:
+                await self.remove_remote(kubos_sat=kubos_sat, remote_path=remote_compressed)
+            compressed_size = os.path.getsize(compressed_path)
+            size = await executor.run_blocking(compression.decompress_file, compressed_path, local_path)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(compressed_path)
+        metrics.increment("compression_saved_bytes", size - compressed_size, direction="download")
+        return output, compression.savings(size, compressed_size)
+
+    async def remote_limit(self, kubos_sat):
+        """Prefix that stops gzip or gunzip on the satellite when long_shell_client stops waiting for it"""
+        shell_service = kubos_sat.shell_service
+        return await shell_service.timeout_prefix(
+            ip=kubos_sat.ip, seconds=shell_service.guard(ip=kubos_sat.ip).deadline.maximum)
+
+    async def remote_free_space(self, kubos_sat, paths):
+        """Output of compression.free_space_command for the paths"""
+        output = await kubos_sat.shell_service.shell_client(
+            ip=kubos_sat.ip, command=compression.free_space_command(paths))
+        return output.stdout.decode("utf-8", errors="replace")
+
+    async def check_remote_space(self, kubos_sat, command, needed):
+        """Raises a CommandError if the satellite doesn't have room for the bytes needed at each path"""
+        shortfall = compression.space_shortfall(
+            await self.remote_free_space(kubos_sat=kubos_sat, paths=list(needed)), list(needed.values()))
+        if shortfall is not None:
+            raise CommandError(command=command, message=f"Not enough space on the satellite: {shortfall}")
+
+    async def remove_remote(self, kubos_sat, remote_path):
+        """Removes a temporary file from the satellite, logging rather than raising if that fails"""
+        try:
+            await kubos_sat.shell_service.shell_client(ip=kubos_sat.ip, command=f"rm -f {shlex.quote(remote_path)}")
+        except Exception as e:
+            logger.warning(f"Failed to remove {remote_path} from the satellite: {type(e).__name__}: {e}")
+
+    async def remote_version(self, kubos_sat, remote_path):
+        """
+        Returns the size and modification time of a file on the satellite, or None if it can't be found.
+        Uses a stat through the shell service if it's available, otherwise what the last file list update saw.
+        If the stat fails, the file may have changed or been removed since it was listed, so None is returned.
+        """
+        if kubos_sat.shell_service is not None and kubos_sat.shell_service.shell_client_path is not None:
+            try:
+                return await kubos_sat.shell_service.stat(ip=kubos_sat.ip, path=remote_path)
+            except Exception as e:
+                logger.warning(f"Failed to stat {remote_path} on the satellite: {type(e).__name__}: {e}")
+                return None
+        for snapshot in kubos_sat.file_list_snapshots.values():
+            if remote_path in snapshot["files"]:
+                return ("file_list",) + snapshot["files"][remote_path]
+        return None
+
+    async def update_kubos_config_toml(self, kubos_sat, gateway, command):
+        local_filename = f"tempfile{str(uuid.uuid4())}.tmp"
+
+        # The config is small and the definitions depend on it, so it goes ahead of other transfers
+        with removed_on_error(local_filename):
+            output = await self.scheduled_transfer(
+                kubos_sat=kubos_sat,
+                gateway=gateway,
+                command=command,
+                priority="high",
+                state="downlinking_from_system",
+                description=f"Downlinking file: {command.fields['config_location']}",
+                connection_type="download",
+                remote_filepath=command.fields["config_location"],
+                local_filepath=local_filename)
 
-        asyncio.ensure_future(gateway.transmit_command_update(
+        await gateway.transmit_command_update(
             command_id=command.id,
             state="processing_on_gateway",
             dict={
-                "status": f"Config file successfully Downlinked! Rebuilding command definitions"}))
-
-        os.remove(kubos_sat.sat_config_path)
-        os.rename(local_filename, kubos_sat.sat_config_path)
-        kubos_sat.build_command_definitions()
-        asyncio.ensure_future(gateway.update_command_definitions(
-            system=kubos_sat.name,
-            definitions=kubos_sat.definitions))
-        asyncio.ensure_future(gateway.complete_command(
+                "status": f"Config file successfully Downlinked! Rebuilding command definitions"})
+
+        # Replaced in one step so the config watcher never sees it missing
+        os.replace(local_filename, kubos_sat.sat_config_path)
+        await kubos_sat.reload_command_definitions()
+        await kubos_sat.push_command_definitions(gateway=gateway)
+        await gateway.complete_command(
             command_id=command.id,
-            output="Command definitions updated with new config."))
+            output="Command definitions updated with new config.")
+
+    async def scheduled_transfer(self, kubos_sat, gateway, command, priority, state, description, **transfer):
+        """Waits for a transfer worker, then runs the file client with progress updates"""
+        async with kubos_sat.transfer_scheduler.slot(
+                priority=priority, gateway=gateway, command_id=command.id,
+                owner=kubos_sat.name, owner_limit=kubos_sat.transfer_workers):
+            await gateway.transmit_command_update(
+                command_id=command.id,
+                state=state,
+                dict={"status": description})
+            if file_protocol.enabled():
+                # The native client reports how much of the file has been transferred
+                return await self.file_client(
+                    ip=kubos_sat.ip,
+                    progress_callback=ProgressUpdater(
+                        gateway=gateway, command_id=command.id, state=state, description=description),
+                    **transfer)
+            progress = asyncio.ensure_future(report_progress(
+                gateway=gateway, command_id=command.id, state=state, description=description))
+            try:
+                return await self.file_client(ip=kubos_sat.ip, **transfer)
+            finally:
+                progress.cancel()
+
+    async def file_client(self, connection_type, ip: str, local_filepath: str, remote_filepath: str, progress_callback=None):
+        """
+        Transfers a file with the native file protocol client if it's enabled, otherwise the file client binary.
+        Returns the client's output. progress_callback is only called by the native client.
+        """
+        if file_protocol.enabled():
+            async def transfer():
+                return await file_protocol.transfer(
+                    connection_type=connection_type,
+                    local_address=(self.downlink_ip, int(self.downlink_port)),
+                    remote_address=(ip, int(self.port)),
+                    local_filepath=local_filepath,
+                    remote_filepath=remote_filepath,
+                    progress_callback=progress_callback)
+
+            # Errors the service reports, such as a missing file, don't count against it
+            return await breakers.file_client_guard(ip=ip, port=self.port).call(
+                transfer, failures=(OSError, ServiceTimeoutError))
 
-    def file_client(self, connection_type, ip: str, local_filepath: str, remote_filepath: str):
         if connection_type == "upload":
             send = local_filepath
             receive = remote_filepath
@@ -191,21 +595,24 @@ class FileService:
             raise ValueError(
                 f'connection_type must be "upload" or "download", not: {connection_type}')
 
-        output = subprocess.run(
-            [self.file_client_path,
-             "-h", self.downlink_ip,
-             "-P", self.downlink_port,
-             "-r", ip,
-             "-p", self.port,
-             connection_type,
-             send,
-             receive],
-            capture_output=True)
-
-        logger.debug(f"Command: {output.args}")
-        logger.debug(f"File Client Output: \n{output.stdout.decode('ascii')}")
-
-        # Checking stderr is a hack until the client properly implements return codes
-        if output.returncode != 0 or output.stderr != b'':
-            raise FileTransferError(output=output)
+        async def transfer():
+            output = await executor.run_subprocess(
+                [self.file_client_path,
+                 "-h", self.downlink_ip,
+                 "-P", self.downlink_port,
+                 "-r", ip,
+                 "-p", self.port,
+                 connection_type,
+                 send,
+                 receive])
+
+            logger.debug(f"Command: {output.args}")
+            logger.debug(f"File Client Output: \n{output.stdout.decode('ascii')}")
+
+            # Checking stderr is a hack until the client properly implements return codes
+            if output.returncode != 0 or output.stderr != b'':
+                raise FileTransferError(output=output)
+            return output.stdout.decode('ascii')
+
+        output = await breakers.file_client_guard(ip=ip, port=self.port).call(transfer)
         return output
@@ -1,11 +1,437 @@
 import json
 import logging
 import asyncio
-import requests
+import re
+from kubos_sat import metrics
+from kubos_sat import breakers
 from kubos_sat.exceptions import *
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_KEEPALIVE_TIMEOUT = 120
+DEFAULT_BATCH_WINDOW = 0.05
+DEFAULT_MAX_BATCH_SIZE = 20
+
+
+class GraphqlClient:
+    """
+    Async GraphQL client shared by every command that talks to a KubOS service.
+    Keeps a pool of persistent connections for each (ip, port) service and limits how many
+    requests can be in flight to each of them at once.
+    """
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_in_flight = max_in_flight
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions = {}
+        self.in_flight_limits = {}
+
+    def _service(self, ip, port):
+        key = (ip, str(port))
+        if key not in self.sessions or self.sessions[key].closed:
+            # Imported here since it's slow to import and not needed until the first query
+            import aiohttp
+            # One pooled connection per allowed in-flight request, kept open between queries
+            connector = aiohttp.TCPConnector(
+                limit=self.max_in_flight,
+                keepalive_timeout=self.keepalive_timeout)
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=self.connect_timeout,
+                sock_read=self.read_timeout)
+            self.sessions[key] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self.in_flight_limits[key] = asyncio.Semaphore(self.max_in_flight)
+        return self.sessions[key], self.in_flight_limits[key]
+
+    def _guard(self, ip, port):
+        return breakers.guard(
+            name=f"GraphQL service {ip}:{port}",
+            max_deadline=self.read_timeout,
+            probe=lambda: self.ping(ip=ip, port=port))
+
+    async def _post(self, session, ip, port, graphql):
+        async with session.post(f"http://{ip}:{port}/graphql", json=graphql) as response:
+            # KubOS services don't always set a JSON content type
+            return await response.json(content_type=None)
+
+    async def query(self, query, ip, port, variables=None):
+        graphql = {
+            'query': query,
+            'variables': variables
+        }
+        logger.debug(json.dumps(graphql))
+        session, in_flight_limit = self._service(ip=ip, port=port)
+        guard = self._guard(ip=ip, port=port)
+        # Fails fast if the service is down, rather than after waiting for a slot
+        guard.check()
+        import aiohttp
+        async with in_flight_limit:
+            with metrics.timed("graphql", service=f"{ip}:{port}"):
+                return await guard.call(
+                    lambda: self._post(session=session, ip=ip, port=port, graphql=graphql),
+                    failures=(aiohttp.ClientError, OSError, ValueError))
+
+    async def long_query(self, query, ip, port, variables=None):
+        """
+        Sends a query on its own with the read timeout as its deadline, for raw GraphQL commands that can ask for anything.
+        A slow reply to one of those says nothing about the service's health, so timeouts aren't counted by the breaker.
+        """
+        graphql = {
+            'query': query,
+            'variables': variables
+        }
+        logger.debug(json.dumps(graphql))
+        session, in_flight_limit = self._service(ip=ip, port=port)
+        guard = self._guard(ip=ip, port=port)
+        guard.check()
+        import aiohttp
+        async with in_flight_limit:
+            with metrics.timed("graphql", service=f"{ip}:{port}"):
+                try:
+                    json_result = await asyncio.wait_for(
+                        self._post(session=session, ip=ip, port=port, graphql=graphql), timeout=self.read_timeout)
+                except asyncio.TimeoutError:
+                    raise ServiceTimeoutError(service=guard.name, deadline=self.read_timeout) from None
+                except (aiohttp.ClientError, OSError, ValueError) as e:
+                    guard.record_failure(e)
+                    raise
+        guard.record_success()
+        return json_result
+
+    async def ping(self, ip, port):
+        """
+        Sends a "{ ping }" query to the service, without its deadline or circuit breaker.
+        A reply closes the breaker, if it's open.
+        """
+        session, _ = self._service(ip=ip, port=port)
+        json_result = await self._post(session=session, ip=ip, port=port, graphql={'query': "{ ping }", 'variables': None})
+        if 'errors' in json_result:
+            raise GraphqlError(errors=json_result["errors"])
+        self._guard(ip=ip, port=port).record_success()
+        return json_result
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+        self.in_flight_limits = {}
+
+
+_TOKEN_PATTERN = re.compile(r'''
+    (?P<ignored>[\s,\ufeff]+|\#[^\n\r]*) |
+    (?P<block_string>"""(?:\\"""|[^"]|"(?!""))*""") |
+    (?P<string>"(?:\\.|[^"\\\n])*") |
+    (?P<spread>\.\.\.) |
+    (?P<variable>\$[_A-Za-z][_0-9A-Za-z]*) |
+    (?P<name>[_A-Za-z][_0-9A-Za-z]*) |
+    (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?) |
+    (?P<punctuator>[!():=@\[\]{}|&])
+''', re.VERBOSE)
+
+_OPENING = {"{": "}", "(": ")", "[": "]"}
+
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = _TOKEN_PATTERN.match(query, position)
+        if match is None:
+            raise ValueError(f"Unexpected character in GraphQL document at {position}: {query[position]!r}")
+        if match.lastgroup != "ignored":
+            tokens.append((match.lastgroup, match.group()))
+        position = match.end()
+    return tokens
+
+
+def _matching_close(tokens, start):
+    """Index of the token closing the bracket opened at tokens[start]"""
+    depth = 0
+    for index in range(start, len(tokens)):
+        text = tokens[index][1]
+        if tokens[index][0] != "punctuator":
+            continue
+        if text in _OPENING:
+            depth += 1
+        elif text in _OPENING.values():
+            depth -= 1
+            if depth == 0:
+                return index
+    raise ValueError("Unbalanced brackets in GraphQL document")
+
+
+class BatchOperation:
+    """
+    A single GraphQL operation rewritten so it can share a document with other operations.
+    Every variable and root field is prefixed, and *.aliases maps the prefixed root fields
+    back to the keys the caller expects in its response.
+    """
+
+    def __init__(self, query, original_variables, variables, operation_type, variable_definitions, selections, aliases):
+        self.query = query
+        self.original_variables = original_variables
+        self.variables = variables
+        self.operation_type = operation_type
+        self.variable_definitions = variable_definitions
+        self.selections = selections
+        self.aliases = aliases
+
+    @classmethod
+    def parse(cls, query, variables, prefix):
+        """Returns None if the operation can't be safely merged with others"""
+        original_variables = variables
+        if isinstance(variables, str):
+            if variables.strip() == "":
+                variables = None
+            else:
+                try:
+                    variables = json.loads(variables)
+                except ValueError:
+                    return None
+        if variables is not None and not isinstance(variables, dict):
+            return None
+        try:
+            tokens = _tokenize(query)
+        except ValueError:
+            return None
+        if not tokens:
+            return None
+
+        index = 0
+        operation_type = "query"
+        variable_definitions = []
+        if tokens[0] == ("name", "query") or tokens[0] == ("name", "mutation"):
+            operation_type = tokens[0][1]
+            index = 1
+            if index < len(tokens) and tokens[index][0] == "name":
+                index += 1  # Operation names are dropped when merged
+            if index < len(tokens) and tokens[index][1] == "(":
+                try:
+                    close = _matching_close(tokens, index)
+                except ValueError:
+                    return None
+                variable_definitions = tokens[index + 1:close]
+                index = close + 1
+        if index >= len(tokens) or tokens[index][1] != "{":
+            # Subscriptions, fragments and operation directives are sent on their own
+            return None
+        try:
+            close = _matching_close(tokens, index)
+        except ValueError:
+            return None
+        if close != len(tokens) - 1:
+            # Multiple operations or fragment definitions
+            return None
+
+        body = tokens[index + 1:close]
+        selections = []
+        aliases = {}
+        depth = 0
+        position = 0
+        while position < len(body):
+            kind, text = body[position]
+            if kind == "punctuator" and text in _OPENING:
+                depth += 1
+            elif kind == "punctuator" and text in _OPENING.values():
+                depth -= 1
+            elif depth == 0 and kind == "spread":
+                return None
+            elif depth == 0 and kind == "punctuator" and text == "@":
+                # Skip the directive name so it isn't mistaken for a field
+                selections.extend(body[position:position + 2])
+                position += 2
+                continue
+            elif depth == 0 and kind == "name":
+                if position + 2 < len(body) and body[position + 1][1] == ":":
+                    response_key = text
+                    field = body[position + 2]
+                    position += 3
+                else:
+                    response_key = text
+                    field = body[position]
+                    position += 1
+                alias = f"{prefix}_{response_key}"
+                aliases[alias] = response_key
+                selections.extend([("name", alias), ("punctuator", ":"), field])
+                continue
+            selections.append(body[position])
+            position += 1
+
+        variable_definitions = [cls._rename(token, prefix) for token in variable_definitions]
+        selections = [cls._rename(token, prefix) for token in selections]
+        if variables:
+            variables = {f"{prefix}_{name}": value for name, value in variables.items()}
+        return cls(query=query, original_variables=original_variables, variables=variables,
+                   operation_type=operation_type,
+                   variable_definitions=variable_definitions, selections=selections, aliases=aliases)
+
+    @staticmethod
+    def _rename(token, prefix):
+        if token[0] == "variable":
+            return ("variable", f"${prefix}_{token[1][1:]}")
+        return token
+
+
+def merge_operations(operations):
+    """Builds one aliased document and variables dict from operations of the same type"""
+    variable_definitions = []
+    selections = []
+    variables = {}
+    for operation in operations:
+        variable_definitions.extend(text for _, text in operation.variable_definitions)
+        selections.extend(text for _, text in operation.selections)
+        if operation.variables:
+            variables.update(operation.variables)
+    query = operations[0].operation_type + " Batch"
+    if variable_definitions:
+        query += "(" + " ".join(variable_definitions) + ")"
+    query += " { " + " ".join(selections) + " }"
+    return query, variables or None
+
+
+def split_result(json_result, operations):
+    """
+    Splits an aliased batch response back into one response per operation.
+    Returns None if the whole document failed, since the response doesn't say which operations ran.
+    """
+    data = json_result.get("data")
+    errors = json_result.get("errors") or []
+
+    owners = {}
+    for operation in operations:
+        for alias in operation.aliases:
+            owners[alias] = operation
+    routed = {id(operation): [] for operation in operations}
+    unrouted = []
+    for error in errors:
+        path = error.get("path") or []
+        if path and path[0] in owners:
+            operation = owners[path[0]]
+            error = dict(error, path=[operation.aliases[path[0]]] + list(path[1:]))
+            routed[id(operation)].append(error)
+        else:
+            unrouted.append(error)
+
+    if data is None:
+        return None
+
+    results = []
+    for operation in operations:
+        result = {"data": None}
+        if data is not None:
+            result["data"] = {
+                response_key: data.get(alias) for alias, response_key in operation.aliases.items()}
+        operation_errors = routed[id(operation)] + unrouted
+        if operation_errors:
+            result["errors"] = operation_errors
+        results.append(result)
+    return results
+
+
+class GraphqlBatcher:
+    """
+    Collects operations sent to the same service within a short window and sends them as a
+    single aliased GraphQL document, then routes each part of the response back to its caller.
+    """
+
+    def __init__(self, client, window=DEFAULT_BATCH_WINDOW, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        self.client = client
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending = {}
+        self.requests = {}  # Task sending each batch, by the batch's id, so it can be aborted
+        self.sequence = 0
+
+    async def query(self, query, ip, port, variables=None):
+        if self.window <= 0:
+            return await self.client.query(query=query, ip=ip, port=port, variables=variables)
+        self.sequence += 1
+        operation = BatchOperation.parse(query, variables, prefix=f"b{self.sequence}")
+        if operation is None:
+            return await self.client.query(query=query, ip=ip, port=port, variables=variables)
+
+        loop = asyncio.get_running_loop()
+        key = (ip, str(port), operation.operation_type)
+        if key not in self.pending:
+            self.pending[key] = []
+            loop.call_later(self.window, self._flush, key, self.pending[key])
+        batch = self.pending[key]
+        future = loop.create_future()
+        batch.append((operation, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key, batch)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Drop the operation if its batch hasn't been sent yet.
+            # A sent batch is shared with other commands, so it's only aborted once all of them are cancelled.
+            if self.pending.get(key) is batch:
+                batch.remove((operation, future))
+            elif id(batch) in self.requests and all(waiter.cancelled() for _, waiter in batch):
+                self.requests[id(batch)].cancel()
+            raise
+
+    def _flush(self, key, batch):
+        if self.pending.get(key) is not batch:
+            # Already sent because it filled up before the window closed
+            return
+        del self.pending[key]
+        if not batch:
+            # Every operation in it was cancelled
+            return
+        self.requests[id(batch)] = asyncio.ensure_future(self._send(ip=key[0], port=key[1], batch=batch))
+
+    async def _send(self, ip, port, batch):
+        operations = [operation for operation, _ in batch]
+        try:
+            results = None
+            if len(operations) > 1:
+                query, variables = merge_operations(operations)
+                logger.debug(f"Sending {len(operations)} batched operations to {ip}:{port}")
+                metrics.increment("graphql_batched_operations_total", value=len(operations), service=f"{ip}:{port}")
+                json_result = await self.client.query(query=query, ip=ip, port=port, variables=variables)
+                results = split_result(json_result, operations)
+                if results is None and operations[0].operation_type == "mutation":
+                    # Some of the mutations may have run, so they're failed rather than sent again
+                    raise GraphqlMutationError(errors=json_result.get("errors"))
+            if results is None:
+                results = await asyncio.gather(*[
+                    self.client.query(query=operation.query, ip=ip, port=port,
+                                      variables=operation.original_variables)
+                    for operation in operations], return_exceptions=True)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.requests.pop(id(batch), None)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                # The command was cancelled while waiting on the batch
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+client = GraphqlClient()
+batcher = GraphqlBatcher(client=client)
+
+
+def configure(batch_window=DEFAULT_BATCH_WINDOW, max_batch_size=DEFAULT_MAX_BATCH_SIZE, **kwargs):
+    """Replaces the shared GraphQL client and batcher with ones using the given settings"""
+    global client, batcher
+    client = GraphqlClient(**kwargs)
+    batcher = GraphqlBatcher(client=client, window=batch_window, max_batch_size=max_batch_size)
+
 
 def build(kubos_sat, service):
     graphql_command_name = "graphql-"+service
@@ -25,52 +451,51 @@ def build(kubos_sat, service):
     kubos_sat.graphql_service_commands.append(graphql_command_name)
 
 
-def graphql_command(gateway, command):
-    query_with_command_updates(
+async def graphql_command(gateway, command):
+    await query_with_command_updates(
         query=command.fields['query'],
         ip=command.fields['ip'],
         port=command.fields['port'],
         command_id=command.id,
         gateway=gateway,
-        variables=command.fields["variables"])
+        variables=command.fields["variables"],
+        fixed_deadline=True)
 
 
-def query_with_command_updates(query, ip, port, gateway, command_id, variables=None):
+async def query_with_command_updates(query, ip, port, gateway, command_id, variables=None, fixed_deadline=False):
     """GraphQL Request Command"""
-    json_result = query_with_validation(query=query, ip=ip, port=port, variables=variables)
+    json_result = await query_with_validation(
+        query=query, ip=ip, port=port, variables=variables, fixed_deadline=fixed_deadline)
 
-    asyncio.ensure_future(gateway.complete_command(
+    await gateway.complete_command(
         command_id=command_id,
-        output=json.dumps(json_result)))
+        output=json.dumps(json_result))
 
 
-def query_with_validation(query, ip, port, variables=None):
+async def query_with_validation(query, ip, port, variables=None, fixed_deadline=False):
     """GraphQL Request Command"""
-    json_result = raw_query(query=query, ip=ip, port=port, variables=variables)
+    json_result = await raw_query(query=query, ip=ip, port=port, variables=variables, fixed_deadline=fixed_deadline)
 
     if 'errors' in json_result:
-        raise GraphqlError(errors=result["errors"])
+        raise GraphqlError(errors=json_result["errors"])
 
     for mutation_return in json_result["data"]:
-        if "success" in json_result["data"][mutation_return]:
+        # Only mutation results are objects with a "success" field
+        if isinstance(json_result["data"][mutation_return], dict) and "success" in json_result["data"][mutation_return]:
             if not json_result["data"][mutation_return]["success"]:
                 raise GraphqlMutationError(errors=json_result['data'][mutation_return]['errors'])
 
     return json_result
 
 
-def raw_query(query, ip, port, variables=None):
-    """GraphQL Query"""
-    graphql = {
-        'query': query,
-        'variables': variables
-    }
-    logger.debug(json.dumps(graphql))
-    url = f"http://{ip}:{port}/graphql"
-    request = requests.post(
-        url,
-        json=graphql)
-
-    json_result = request.json()
+async def raw_query(query, ip, port, variables=None, fixed_deadline=False):
+    """
+    GraphQL Query.
+    With fixed_deadline, it's sent on its own with the read timeout, for queries that can take any amount of time.
+    """
+    if fixed_deadline:
+        json_result = await client.long_query(query=query, ip=ip, port=port, variables=variables)
+    else:
+        json_result = await batcher.query(query=query, ip=ip, port=port, variables=variables)
     logger.debug(json.dumps(json_result, indent=2))
     return json_result
@@ -1,4 +1,6 @@
 import asyncio
+import copy
+import hashlib
 import time
 import traceback
 import logging
@@ -9,120 +11,316 @@ import os
 import datetime
 import uuid
 from kubos_sat import graphql
+from kubos_sat import executor
+from kubos_sat import tools
+from kubos_sat import metrics
 from kubos_sat.shell_service import ShellService
-from kubos_sat.file_service import FileService
+from kubos_sat.file_service import FileService, TransferScheduler, DEFAULT_TRANSFER_WORKERS
 from kubos_sat.app_service import AppService
 from kubos_sat.exceptions import *
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CONFIG_WATCH_INTERVAL = 5
+LOCAL_COMMANDS = ("command_definitions_update",)  # Resolved without contacting the satellite
+
+
+def base_definitions():
+    return {
+        "command_definitions_update": {
+            "display_name": "Command Definitions Update",
+            "description": "Retrieves the service information from the local config.toml and builds command definitions for each of the services within it.",
+            "fields": []
+        }
+    }
+
 
 class KubosSat:
-    def __init__(self, name, ip: str, sat_config_path: str, file_client_path=None, shell_client_path=None, file_list_directories=None, default_uplink_dir="/home/kubos/"):
+    def __init__(self, name, ip: str, sat_config_path: str, file_client_path=None, shell_client_path=None, file_list_directories=None, default_uplink_dir="/home/kubos/", command_limits=None, default_command_limit=None, transfer_workers=DEFAULT_TRANSFER_WORKERS, uplink_cache=None, downlink_cache=None, file_list_mode="stat", max_commands=None, transfer_scheduler=None, app_cache_path=None):
         self.name = name
         self.ip = ip  # IP where KubOS is reachable. Overrides IPs in the config file.
         self.sat_config_path = sat_config_path
         self.file_client_path = file_client_path
         self.shell_client_path = shell_client_path
-        self.definitions = {
-            "command_definitions_update": {
-                "display_name": "Command Definitions Update",
-                "description": "Retrieves the service information from the local config.toml and builds command definitions for each of the services within it.",
-                "fields": []
-            }
-        }
+        self.definitions = base_definitions()
+        self.pushed_definitions = None  # Last definitions sent to Major Tom
+        self.config = None  # Config the command definitions were built from
+        self.loaded_config = None  # Last parse of the config file
+        self.config_stamp = None
+        self.config_digest = None
         self.file_list_directories = file_list_directories
+        self.file_list_mode = file_list_mode
         self.default_uplink_dir = default_uplink_dir
+        self.file_service = None
+        self.shell_service = None
         self.app_service = None
+        self.app_cache_path = app_cache_path  # Where the registered apps are saved between restarts, if anywhere
         self.graphql_service_commands = []
+        self.command_limiter = executor.CommandLimiter(
+            limits=command_limits, default_limit=default_command_limit, total_limit=max_commands)
+        # A shared scheduler's workers are used by several satellites, so this satellite is limited to transfer_workers of them
+        self.transfer_workers = transfer_workers
+        self.transfer_scheduler = transfer_scheduler or TransferScheduler(workers=transfer_workers)
+        self.uplink_cache = uplink_cache
+        self.downlink_cache = downlink_cache
+        self.file_list_snapshots = {}  # Size and timestamp of the files last listed in each directory
+        self.preparation = None
+        self.running_commands = {}  # Task resolving each command, by command id, so it can be cancelled
+        self.command_updates = None  # CommandUpdateChannel that command updates are sent through, if any
+        self.link_monitor = None  # LinkMonitor that holds commands while the satellite is out of contact, if any
+        metrics.gauge("commands_running", lambda: len(self.running_commands), satellite=name)
+        metrics.gauge("transfers_active", lambda: self.transfer_scheduler.active_by_owner.get(name, 0), satellite=name)
+        metrics.gauge("transfer_queue_depth", lambda: sum(1 for entry in self.transfer_scheduler.waiting if entry[2] == name), satellite=name)
+
+    def prepare(self):
+        """
+        Gets the satellite ready to resolve commands in the background.
+        Returns a task that finishes once it's ready. Commands received before then wait for it.
+        """
+        self.preparation = asyncio.ensure_future(self._prepare())
+        return self.preparation
+
+    async def _prepare(self):
+        # The config is parsed and the client binaries are probed concurrently,
+        # then the command definitions are built from the cached results
+        loaded, _, _ = await asyncio.gather(
+            executor.run_blocking(self.read_config),
+            tools.check_client_async(client_path=self.file_client_path, service_name="file-transfer-service"),
+            tools.check_client_async(client_path=self.shell_client_path, service_name="shell-service"))
+        self.build_command_definitions(self.save_config(*loaded))
+
+    def start(self, gateway):
+        """Sends the command definitions to Major Tom and fetches the registered apps in the background"""
+        asyncio.ensure_future(self.push_command_definitions(gateway=gateway))
+        if self.app_service is not None:
+            asyncio.ensure_future(self.fetch_apps(gateway=gateway))
+        if self.link_monitor is not None and self.link_monitor.held:
+            # majortom_gateway is slow to import, and only needed here when commands were held before a restart
+            from majortom_gateway.command import Command
+            logger.info(f"Resuming {len(self.link_monitor.held)} commands held before the gateway restarted")
+            for json_command in list(self.link_monitor.held.values()):
+                asyncio.ensure_future(self.command_callback(command=Command(json_command), gateway=gateway))
+
+    async def fetch_apps(self, gateway):
+        try:
+            await self.app_service.build_from_app_service(kubos_sat=self, gateway=gateway)
+        except Exception as e:
+            logger.warning(
+                f'Failed to retrieve apps from the app service. Issue the "Retrieve Apps" command once it\'s reachable. Error: {type(e).__name__}: {e}')
+
+    async def refresh_file_list_periodically(self, gateway, interval):
+        """Sends Major Tom any new or changed files in the file list directories every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.shell_service is None or "update_file_list" not in self.definitions:
+                continue
+            try:
+                await self.shell_service.sync_file_list(
+                    kubos_sat=self, gateway=gateway, directories=self.file_list_directories)
+            except Exception as e:
+                logger.warning(f"Periodic file list update failed: {type(e).__name__}: {e}")
+
+    async def refresh_apps_periodically(self, gateway, interval):
+        """Updates the commands of any apps registered, changed or removed since the last check, every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.app_service is None:
+                continue
+            try:
+                await self.app_service.refresh(kubos_sat=self, gateway=gateway)
+            except Exception as e:
+                logger.warning(f"Periodic app registry refresh failed: {type(e).__name__}: {e}")
 
     async def cancel_callback(self, command_id, gateway):
-        asyncio.ensure_future(gateway.cancel_command(command_id=command_id))
+        if self.command_updates is not None:
+            gateway = self.command_updates
+        task = self.running_commands.get(command_id)
+        if task is not None:
+            # Interrupts the resolver wherever it's waiting, which kills its client binary or aborts its request,
+            # deletes its partial files and frees its transfer slot
+            logger.info(f"Cancelling command: {command_id}")
+            task.cancel()
+        await gateway.cancel_command(command_id=command_id)
 
     async def command_callback(self, command, gateway):
+        if self.command_updates is not None:
+            gateway = self.command_updates
+        self.running_commands[command.id] = asyncio.current_task()
         try:
+            if self.preparation is not None:
+                # Shielded, since the preparation is shared and cancelling this command mustn't cancel it for the rest
+                try:
+                    await asyncio.shield(self.preparation)
+                except asyncio.CancelledError:
+                    if not self.preparation.cancelled():
+                        raise
+                    raise CommandError(
+                        command=command, message="The gateway's preparation was cancelled before the command definitions were built")
             if command.type not in self.definitions:
                 raise CommandError(
                     command=command, message=f'Command: {command.type} is not defined in the Gateway. There is likely a mismatch between the Gateway and command definitions in Major Tom. Please issue the "Command Definitions Update" or "Retrieve Apps" command. Currently available commands are: {list(self.definitions.keys())}')
 
-            if command.type == "command_definitions_update":
-                self.build_command_definitions_command(gateway=gateway, command=command)
-            elif command.type in self.graphql_service_commands:
-                """Direct GraphQL Request Command"""
-                graphql.graphql_command(gateway=gateway, command=command)
-            elif command.type == "uplink_file":
-                self.file_service.uplink_file(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type == "downlink_file":
-                self.file_service.downlink_file(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type == "update_kubos_config_toml":
-                self.file_service.update_kubos_config_toml(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type == "update_file_list":
-                self.shell_service.update_file_list(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type == "retrieve_apps":
-                self.app_service.build_from_app_service(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type in self.app_service.apps:
-                self.app_service.start_app(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type == "uninstall_app":
-                self.app_service.uninstall_app(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type == "register_app":
-                self.app_service.register_app(
-                    kubos_sat=self, gateway=gateway, command=command)
-            elif command.type == "kill_app":
-                self.app_service.kill_app(
-                    kubos_sat=self, gateway=gateway, command=command)
-            else:
-                raise CommandError(
-                    command=command, message=f'Command Type: {command.type} is defined but does not have a resolver implemented. Please check that the definition matches a resolver case in the "command_callback" function.')
+            if self.link_monitor is not None and command.type not in LOCAL_COMMANDS:
+                await self.link_monitor.wait_until_up(command=command, gateway=gateway)
+
+            with metrics.timed("command", command_type=command.type):
+                async with self.command_limiter.slot(command.type):
+                    if command.type == "command_definitions_update":
+                        await self.build_command_definitions_command(gateway=gateway, command=command)
+                    elif command.type in self.graphql_service_commands:
+                        """Direct GraphQL Request Command"""
+                        await graphql.graphql_command(gateway=gateway, command=command)
+                    elif command.type == "uplink_file":
+                        await self.file_service.uplink_file(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "downlink_file":
+                        await self.file_service.downlink_file(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "update_kubos_config_toml":
+                        await self.file_service.update_kubos_config_toml(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "update_file_list":
+                        await self.shell_service.update_file_list(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "run_shell_command":
+                        await self.shell_service.run_shell_command(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "retrieve_apps":
+                        await self.app_service.build_from_app_service(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif self.app_service is not None and command.type in self.app_service.apps:
+                        await self.app_service.start_app(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "uninstall_app":
+                        await self.app_service.uninstall_app(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "register_app":
+                        await self.app_service.register_app(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    elif command.type == "kill_app":
+                        await self.app_service.kill_app(
+                            kubos_sat=self, gateway=gateway, command=command)
+                    else:
+                        raise CommandError(
+                            command=command, message=f'Command Type: {command.type} is defined but does not have a resolver implemented. Please check that the definition matches a resolver case in the "command_callback" function.')
 
+        except asyncio.CancelledError:
+            logger.info(f"Command {command.id} ({command.type}) was cancelled")
         except Exception as e:
-            asyncio.ensure_future(gateway.fail_command(
+            await gateway.fail_command(
                 command_id=command.id, errors=[
-                    f"Error Message: {e}\nError Type: {type(e)}\n\n{traceback.format_exc()}"]))
-
-    def build_command_definitions_command(self, gateway, command):
-        self.definitions = {
-            "command_definitions_update": {
-                "display_name": "Command Definitions Update",
-                "description": "Retrieves the service information from the local config.toml and builds command definitions for each of the services within it.",
-                "fields": []
-            }
-        }
-        self.build_command_definitions()
-        asyncio.ensure_future(gateway.update_command_definitions(
-            system=self.name,
-            definitions=self.definitions))
-        asyncio.ensure_future(gateway.complete_command(
+                    f"Error Message: {e}\nError Type: {type(e)}\n\n{traceback.format_exc()}"])
+        finally:
+            self.running_commands.pop(command.id, None)
+
+    async def build_command_definitions_command(self, gateway, command):
+        await self.reload_command_definitions(force=True)
+        if await self.push_command_definitions(gateway=gateway):
+            output = f"Updated Definitions from config file: {self.sat_config_path}"
+        else:
+            output = f"Definitions are already up to date with config file: {self.sat_config_path}"
+        await gateway.complete_command(
             command_id=command.id,
-            output=f"Updated Definitions from config file: {self.sat_config_path}"))
+            output=output)
+
+    async def push_command_definitions(self, gateway):
+        """Sends the command definitions to Major Tom, unless they're the same as the last ones sent"""
+        if self.definitions == self.pushed_definitions:
+            logger.debug("Command definitions are unchanged. Skipping update.")
+            return False
+        # Major Tom replaces all of a system's definitions with each update, so changes are sent as a full set
+        self.pushed_definitions = copy.deepcopy(self.definitions)
+        with metrics.timed("major_tom", call="update_command_definitions"):
+            await gateway.update_command_definitions(
+                system=self.name,
+                definitions=self.pushed_definitions)
+        return True
 
-    def build_command_definitions(self):
-        """Builds Command Definitions"""
-        self.config = toml.load(self.sat_config_path)
-        for service in self.config:
+    async def watch_config(self, gateway, interval=DEFAULT_CONFIG_WATCH_INTERVAL):
+        """Rebuilds and pushes the command definitions whenever the KubOS config file changes"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await self.reload_command_definitions():
+                    logger.info(f"Reloaded changed config file: {self.sat_config_path}")
+                    await self.push_command_definitions(gateway=gateway)
+            except Exception as e:
+                logger.warning(f"Failed to reload config file {self.sat_config_path}: {type(e).__name__}: {e}")
+
+    def load_config(self):
+        """Parses the KubOS config, reusing the last parse if the file's modification time or contents are unchanged"""
+        return self.save_config(*self.read_config())
+
+    def read_config(self):
+        """
+        The blocking part of load_config, which can run in the background. It doesn't change the satellite,
+        and returns the file's stamp and digest with the parsed config to be saved together by save_config.
+        """
+        stat = os.stat(self.sat_config_path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if self.loaded_config is not None and stamp == self.config_stamp:
+            return stamp, self.config_digest, self.loaded_config
+        with open(self.sat_config_path, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if self.loaded_config is not None and digest == self.config_digest:
+            return stamp, digest, self.loaded_config
+        return stamp, digest, toml.loads(content.decode())
+
+    def save_config(self, stamp, digest, config):
+        self.config_stamp, self.config_digest, self.loaded_config = stamp, digest, config
+        return config
+
+    async def reload_command_definitions(self, force=False):
+        """
+        Parses the KubOS config in the background, then rebuilds the command definitions from it.
+        Returns False without rebuilding if the config is unchanged.
+        """
+        config = self.save_config(*await executor.run_blocking(self.read_config))
+        if config is self.config and not force:
+            return False
+        self.build_command_definitions(config)
+        return True
+
+    def build_command_definitions(self, config):
+        """
+        Builds Command Definitions from a parsed config.
+        Commands read the definitions while they run, so everything is built first and then switched over together.
+        """
+        # The services build into a copy of the satellite, which only shares what they don't change
+        staged = copy.copy(self)
+        staged.config = config
+        staged.definitions = base_definitions()
+        staged.graphql_service_commands = []
+        for service in config:
             # Non GraphQL Services and raw GraphQL Commands
             if service == "file-transfer-service":
-                self.file_service = FileService(
-                    port=self.config["file-transfer-service"]["addr"]["port"],
+                staged.file_service = FileService(
+                    port=config["file-transfer-service"]["addr"]["port"],
                     file_client_path=self.file_client_path,
-                    downlink_ip=self.config["file-transfer-service"]["downlink_ip"],
-                    downlink_port=self.config["file-transfer-service"]["downlink_port"])
-                self.file_service.build(kubos_sat=self)
+                    downlink_ip=config["file-transfer-service"]["downlink_ip"],
+                    downlink_port=config["file-transfer-service"]["downlink_port"])
+                staged.file_service.build(kubos_sat=staged)
             elif service == "shell-service":
-                self.shell_service = ShellService(
-                    port=self.config["shell-service"]["addr"]["port"],
-                    shell_client_path=self.shell_client_path)
-                self.shell_service.build(kubos_sat=self)
+                staged.shell_service = ShellService(
+                    port=config["shell-service"]["addr"]["port"],
+                    shell_client_path=self.shell_client_path,
+                    file_list_mode=self.file_list_mode)
+                staged.shell_service.build(kubos_sat=staged)
             else:
-                graphql.build(kubos_sat=self, service=service)
+                graphql.build(kubos_sat=staged, service=service)
 
             # Predefined GraphQL Service Commands
             if service == "app-service":
-                self.app_service = AppService(port=self.config["app-service"]["addr"]["port"])
-                self.app_service.build(kubos_sat=self)
+                port = config["app-service"]["addr"]["port"]
+                # The registered apps are kept through config reloads, so their commands stay defined
+                if staged.app_service is None or staged.app_service.port != port:
+                    staged.app_service = AppService(port=port, cache_path=self.app_cache_path)
+                staged.app_service.build(kubos_sat=staged)
+
+        self.config = config
+        self.definitions = staged.definitions
+        self.graphql_service_commands = staged.graphql_service_commands
+        self.file_service = staged.file_service
+        self.shell_service = staged.shell_service
+        self.app_service = staged.app_service
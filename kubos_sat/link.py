@@ -0,0 +1,124 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+from kubos_sat import graphql
+from kubos_sat import executor
+from kubos_sat import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROBE_SERVICE = "monitor-service"
+DEFAULT_PROBE_INTERVAL = 10
+DEFAULT_PROBE_TIMEOUT = 5
+DEFAULT_FAILURES_TO_DOWN = 2
+
+
+class LinkMonitor:
+    """
+    Tracks whether the satellite is reachable with a "{ ping }" query to one of its GraphQL services every interval.
+    The link is down after failures_to_down probes in a row fail, and up again after one succeeds.
+    Commands that arrive while it's down are held until it's up, then all released together, so the
+    command limits are the only limit on how much of a short contact window is used.
+    With a queue_path, the held commands are saved there and resumed after a restart.
+    """
+
+    def __init__(self, kubos_sat, service=DEFAULT_PROBE_SERVICE, interval=DEFAULT_PROBE_INTERVAL,
+                 timeout=DEFAULT_PROBE_TIMEOUT, failures_to_down=DEFAULT_FAILURES_TO_DOWN, queue_path=None):
+        self.kubos_sat = kubos_sat
+        self.service = service
+        self.interval = interval
+        self.timeout = timeout
+        self.failures_to_down = failures_to_down
+        self.queue_path = queue_path
+        self.failures = 0
+        self.changed_at = time.monotonic()
+        self.held = self.load_queue()  # Held commands, as received from Major Tom, by command id
+        self.link_up = asyncio.Event()
+        # Assumed up until a probe says otherwise, so commands aren't held while the first probes run.
+        # Commands held before a restart stay held until a probe succeeds.
+        if not self.held:
+            self.link_up.set()
+        self.saving = asyncio.Lock()
+        metrics.gauge("link_up", lambda: int(self.link_up.is_set()), satellite=kubos_sat.name)
+        metrics.gauge("commands_held", lambda: len(self.held), satellite=kubos_sat.name)
+
+    def load_queue(self):
+        if self.queue_path is None:
+            return collections.OrderedDict()
+        try:
+            with open(self.queue_path) as f:
+                commands = json.load(f)["commands"]
+        except FileNotFoundError:
+            return collections.OrderedDict()
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Held command queue {self.queue_path} is corrupt, ignoring it: {e}")
+            return collections.OrderedDict()
+        return collections.OrderedDict((command["id"], command) for command in commands)
+
+    def _save_queue(self, commands):
+        directory = os.path.dirname(self.queue_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.queue_path + ".tmp", "w") as f:
+            json.dump({"commands": commands}, f)
+        os.replace(self.queue_path + ".tmp", self.queue_path)
+
+    async def save_queue(self):
+        if self.queue_path is None:
+            return
+        # One write at a time, each saving the commands held when it starts
+        async with self.saving:
+            await executor.run_blocking(self._save_queue, list(self.held.values()))
+
+    async def probe(self):
+        address = self.kubos_sat.config[self.service]["addr"]
+        # Sent even while the service's circuit breaker is open, so the link is seen coming back straight away
+        await asyncio.wait_for(graphql.client.ping(ip=self.kubos_sat.ip, port=address["port"]), timeout=self.timeout)
+
+    async def run(self):
+        if self.service not in self.kubos_sat.config:
+            logger.warning(f"Link probe service {self.service} is not in the KubOS config. Not monitoring the link to {self.kubos_sat.name}.")
+            self.link_up.set()
+            return
+        while True:
+            try:
+                with metrics.timed("link_probe", satellite=self.kubos_sat.name):
+                    await self.probe()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                logger.debug(f"Link probe to {self.kubos_sat.name} failed: {type(e).__name__}: {e}")
+                if self.link_up.is_set() and self.failures >= self.failures_to_down:
+                    logger.warning(f"Link to {self.kubos_sat.name} is down. Holding commands until it's back up.")
+                    self.link_up.clear()
+                    self.changed_at = time.monotonic()
+            else:
+                self.failures = 0
+                if not self.link_up.is_set():
+                    logger.info(
+                        f"Link to {self.kubos_sat.name} is up after {time.monotonic() - self.changed_at:.0f}s. "
+                        f"Releasing {len(self.held)} held commands.")
+                    self.link_up.set()
+                    self.changed_at = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    async def wait_until_up(self, command, gateway):
+        """Holds the command while the link is down. Returns once it's up, or straight away if it already is."""
+        if self.link_up.is_set():
+            return
+        self.held[command.id] = command.json_command
+        try:
+            await self.save_queue()
+            await gateway.transmit_command_update(
+                command_id=command.id,
+                state="queued_on_gateway",
+                dict={"status": f"Link to the satellite is down. Held in queue position {len(self.held)} until it's back up."})
+            with metrics.timed("link_wait", satellite=self.kubos_sat.name):
+                await self.link_up.wait()
+        finally:
+            self.held.pop(command.id, None)
+            await asyncio.shield(self.save_queue())
@@ -0,0 +1,166 @@
+import base64
+import hashlib
+import logging
+import os
+import re
+import uuid
+from kubos_sat import executor
+from kubos_sat import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 300  # Seconds without any data from Major Tom before a transfer is abandoned
+
+_chunk_size = DEFAULT_CHUNK_SIZE
+_hash_algorithm = None
+_session = None
+
+
+def configure(chunk_size=DEFAULT_CHUNK_SIZE, hash_algorithm=None):
+    """Sets how files are streamed to and from Major Tom"""
+    global _chunk_size, _hash_algorithm
+    if hash_algorithm is not None:
+        hashlib.new(hash_algorithm)  # Raises ValueError for an unknown algorithm
+    _chunk_size = chunk_size
+    _hash_algorithm = hash_algorithm
+
+
+def get_session():
+    """Shared HTTP session for Major Tom file transfers, so connections are reused"""
+    global _session
+    if _session is None or _session.closed:
+        import aiohttp
+        # Transfers take as long as their file needs, so only a stalled connection is timed out
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(
+            total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT))
+    return _session
+
+
+def base_url(gateway):
+    if gateway.http:
+        return "http://" + gateway.host
+    return "https://" + gateway.host
+
+
+async def download_staged_file(gateway, gateway_download_path, directory=".", progress_callback=None, hash_algorithm=None):
+    """
+    Streams a staged file from Major Tom to a local temp file in fixed-size chunks,
+    so memory use doesn't depend on the size of the file.
+    Returns the filename given by Major Tom, the local path it was written to,
+    and its hex digest if a hash algorithm is given or configured.
+    progress_callback is called with the bytes written so far and the total size (None if unknown).
+    """
+    local_path = os.path.join(directory, f"tempfile{str(uuid.uuid4())}.tmp")
+    if hash_algorithm is None:
+        hash_algorithm = _hash_algorithm
+    digest = hashlib.new(hash_algorithm) if hash_algorithm else None
+    with metrics.timed("major_tom", call="download_staged_file"):
+        async with get_session().get(base_url(gateway) + gateway_download_path, headers=gateway.headers) as response:
+            if response.status != 200:
+                raise RuntimeError(f"File Download Failed. Status code: {response.status}")
+            filename = re.findall('filename="(.+)";', response.headers['Content-Disposition'])[0]
+            total = response.content_length
+            written = 0
+            try:
+                with open(local_path, "wb") as f:
+                    async for chunk in response.content.iter_chunked(_chunk_size):
+                        if digest is not None:
+                            digest.update(chunk)
+                        # Disk writes can stall, so keep them off the event loop
+                        await executor.run_blocking(f.write, chunk)
+                        written += len(chunk)
+                        if progress_callback is not None:
+                            progress_callback(written, total)
+            except BaseException:
+                os.remove(local_path)
+                raise
+    if total is not None and written != total:
+        os.remove(local_path)
+        raise RuntimeError(f"File Download Failed. Received {written} of {total} bytes")
+    logger.info(f"Downloaded Staged File: {filename} ({written} bytes)")
+    return filename, local_path, digest.hexdigest() if digest is not None else None
+
+
+def file_md5(filepath):
+    """Base64 MD5 of a file, read in chunks. Major Tom's file storage checks uploads against it."""
+    digest = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(_chunk_size), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode()
+
+
+async def read_chunks(filepath, progress_callback=None):
+    """Yields a file in fixed-size chunks, reading each one off the event loop"""
+    sent = 0
+    total = os.path.getsize(filepath)
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = await executor.run_blocking(f.read, _chunk_size)
+            if not chunk:
+                return
+            yield chunk
+            sent += len(chunk)
+            if progress_callback is not None:
+                progress_callback(sent, total)
+
+
+async def upload_downlinked_file(gateway, filename, filepath, system, timestamp, content_type="binary/octet-stream",
+                                 command_id=None, metadata=None, progress_callback=None):
+    """
+    Streams a downlinked file to Major Tom in fixed-size chunks, so memory use doesn't depend on the size of the file.
+    Makes the same requests as GatewayAPI.upload_downlinked_file.
+    progress_callback is called with the bytes uploaded so far and the total size.
+    """
+    byte_size = os.path.getsize(filepath)
+    checksum = await executor.run_blocking(file_md5, filepath)
+    session = get_session()
+
+    # Request an upload URL from Major Tom
+    request_data = {
+        "filename": filename,
+        "byte_size": str(byte_size),
+        "content_type": content_type,
+        "checksum": checksum
+    }
+    with metrics.timed("major_tom", call="direct_upload"):
+        async with session.post(base_url(gateway) + "/rails/active_storage/direct_uploads",
+                                headers=gateway.headers, data=request_data) as response:
+            if response.status != 200:
+                logger.error(f"Transaction Failed. Status code: {response.status} \n Text Response: {await response.text()}")
+                raise RuntimeError(f"File Upload Request Failed. Status code: {response.status}")
+            request_content = await response.json(content_type=None)
+
+    # PUT the file to Major Tom's file bucket. The length is set so the body isn't sent chunk-encoded, which S3 rejects.
+    headers = {
+        "Content-Type": content_type,
+        "Content-MD5": checksum,
+        "Content-Length": str(byte_size)
+    }
+    with metrics.timed("major_tom", call="upload_file"):
+        async with session.put(request_content["direct_upload"]["url"], headers=headers,
+                               data=read_chunks(filepath, progress_callback=progress_callback)) as response:
+            if response.status not in (200, 204):
+                logger.error(f"Transaction Failed. Status code: {response.status} \n Text Response: {await response.text()}")
+                raise RuntimeError(f"File Upload Failed. Status code: {response.status}")
+
+    # Data about the file to show to the operator
+    file_data = {
+        "signed_id": request_content["signed_id"],
+        "name": filename,
+        "timestamp": timestamp,
+        "system": system
+    }
+    if command_id is not None:
+        file_data["command_id"] = command_id
+    if metadata is not None:
+        file_data["metadata"] = metadata
+    with metrics.timed("major_tom", call="downlinked_files"):
+        async with session.post(base_url(gateway) + "/gateway_api/v1.0/downlinked_files",
+                                headers=gateway.headers, json=file_data) as response:
+            if response.status != 200:
+                logger.error(f"Transaction Failed. Status code: {response.status} \n Text Response: {await response.text()}")
+                raise RuntimeError(f"File Data Post Failed. Status code: {response.status}")
+    logger.info(f"Uploaded Downlinked File: {filename} ({byte_size} bytes)")
@@ -0,0 +1,212 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PUSH_INTERVAL = 60
+DEFAULT_SUBSYSTEM = "gateway"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+class Histogram:
+    """Counts of observed durations in fixed buckets, with their sum"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q quantile falls in. Values past the last bucket report the last bucket."""
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Registry:
+    """
+    Counters, timing histograms and gauges, each identified by a name and a set of labels,
+    such as the command type or service they were measured for.
+    Gauges are functions that are read whenever the metrics are collected.
+    *.children holds registries of other processes, by name, which are collected along with this one.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.children = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    def gauge(self, name, function, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = function
+
+    def forget(self, **labels):
+        """Removes the gauges with all of the given labels, such as those of a satellite that's no longer served"""
+        for key in list(self.gauges):
+            if set(labels.items()) <= set(key[1]):
+                del self.gauges[key]
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        """
+        Records how long the block takes in the {name}_seconds histogram, and counts it in
+        {name}_total with an outcome label of "ok", "error" or "cancelled".
+        """
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.monotonic() - start, **labels)
+            self.increment(f"{name}_total", outcome=outcome, **labels)
+
+    def _gauge_values(self):
+        for (name, labels), function in self.gauges.items():
+            try:
+                yield name, labels, function()
+            except Exception as e:
+                logger.debug(f"Failed to read gauge {name}: {type(e).__name__}: {e}")
+
+    def render(self):
+        """Text exposition format read by Prometheus and compatible scrapers"""
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"kubos_gateway_{name}{_label_text(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"kubos_gateway_{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"kubos_gateway_{name}_sum{_label_text(labels)} {histogram.sum}")
+            lines.append(f"kubos_gateway_{name}_count{_label_text(labels)} {histogram.count}")
+        for name, labels, value in self._gauge_values():
+            lines.append(f"kubos_gateway_{name}{_label_text(labels)} {value}")
+        return "".join(f"{line}\n" for line in lines) + "".join(child.render() for child in self.children.values())
+
+    def measurements(self, system, subsystem=DEFAULT_SUBSYSTEM):
+        """Current values as Major Tom measurements, named after the metric and its label values"""
+        timestamp = int(time.time() * 1000)
+        values = []
+        for (name, labels), value in self.counters.items():
+            values.append((name, labels, value))
+        for (name, labels), histogram in self.histograms.items():
+            values.append((f"{name}.count", labels, histogram.count))
+            if histogram.count:
+                values.append((f"{name}.mean", labels, histogram.sum / histogram.count))
+                values.append((f"{name}.p50", labels, histogram.quantile(0.5)))
+                values.append((f"{name}.p99", labels, histogram.quantile(0.99)))
+        values.extend(self._gauge_values())
+        measurements = [{
+            "system": system,
+            "subsystem": subsystem,
+            "metric": ".".join([name] + [str(value) for _, value in labels]),
+            "value": value,
+            "timestamp": timestamp
+        } for name, labels, value in values]
+        for child in self.children.values():
+            measurements.extend(child.measurements(system=system, subsystem=subsystem))
+        return measurements
+
+    def snapshot(self):
+        """Current values as plain data, which can be sent to another process and loaded with Registry.from_snapshot"""
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+            "histograms": [
+                [name, labels, histogram.buckets, histogram.counts, histogram.sum, histogram.count]
+                for (name, labels), histogram in self.histograms.items()],
+            "gauges": list(self._gauge_values())}
+
+    @classmethod
+    def from_snapshot(cls, snapshot, **labels):
+        """Registry with the values of a snapshot, each given the extra labels, such as the process it came from"""
+        def key(name, snapshot_labels):
+            return name, tuple(sorted([tuple(label) for label in snapshot_labels] + list(labels.items())))
+
+        registry = cls()
+        for name, snapshot_labels, value in snapshot["counters"]:
+            registry.counters[key(name, snapshot_labels)] = value
+        for name, snapshot_labels, buckets, counts, total, count in snapshot["histograms"]:
+            histogram = Histogram(buckets=tuple(buckets))
+            histogram.counts, histogram.sum, histogram.count = counts, total, count
+            registry.histograms[key(name, snapshot_labels)] = histogram
+        for name, snapshot_labels, value in snapshot["gauges"]:
+            registry.gauges[key(name, snapshot_labels)] = lambda value=value: value
+        return registry
+
+
+registry = Registry()
+increment = registry.increment
+observe = registry.observe
+gauge = registry.gauge
+timed = registry.timed
+
+
+async def serve(host=DEFAULT_HOST, port=None, health=None):
+    """
+    Serves the metrics at http://{host}:{port}/metrics for scraping.
+    If given, health is a function whose result is served as JSON at http://{host}:{port}/health
+    """
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain")
+
+    async def health_check(request):
+        return web.json_response(health())
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    if health is not None:
+        app.router.add_get("/health", health_check)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving gateway metrics at http://{host}:{port}/metrics")
+    return runner
+
+
+async def push_periodically(gateway, system, interval=DEFAULT_PUSH_INTERVAL, subsystem=DEFAULT_SUBSYSTEM):
+    """Sends the gateway's own metrics to Major Tom as measurements of the given system every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await gateway.transmit_metrics(registry.measurements(system=system, subsystem=subsystem))
+        except Exception as e:
+            logger.warning(f"Failed to send gateway metrics: {type(e).__name__}: {e}")
@@ -1,24 +1,139 @@
 import asyncio
+import contextlib
+import math
+import os
 import time
 import logging
-import subprocess
 import datetime
+import shlex
+import hashlib
+import uuid
+from kubos_sat import executor
+from kubos_sat import breakers
+from kubos_sat import major_tom
 from kubos_sat.tools import check_client
 from kubos_sat.exceptions import *
 
 logger = logging.getLogger(__name__)
 
 
+FILE_LIST_MODES = ["stat", "ls"]
+DEFAULT_OUTPUT_LIMIT = 64 * 1024
+DEFAULT_UPDATE_INTERVAL = 1
+DEFAULT_COMMAND_TIMEOUT = 60
+DEFAULT_SPOOL_DIRECTORY = "."
+TIMEOUT_GRACE = 10  # Seconds the satellite is given to stop a timed out command before the shell client is killed
+# Finds out how the satellite's timeout command takes its time limit. Older BusyBox builds only take it with -t.
+TIMEOUT_PROBE = "if timeout 1 true 2>/dev/null; then echo positional; elif timeout -t 1 true 2>/dev/null; then echo busybox; fi"
+
+_output_limit = DEFAULT_OUTPUT_LIMIT
+_update_interval = DEFAULT_UPDATE_INTERVAL
+_command_timeout = DEFAULT_COMMAND_TIMEOUT
+_spool_directory = DEFAULT_SPOOL_DIRECTORY
+
+
+def configure(output_limit=DEFAULT_OUTPUT_LIMIT, update_interval=DEFAULT_UPDATE_INTERVAL,
+              command_timeout=DEFAULT_COMMAND_TIMEOUT, spool_directory=DEFAULT_SPOOL_DIRECTORY):
+    """Sets how the output of run_shell_command is streamed to Major Tom"""
+    global _output_limit, _update_interval, _command_timeout, _spool_directory
+    _output_limit = output_limit
+    _update_interval = update_interval
+    _command_timeout = command_timeout
+    _spool_directory = spool_directory
+
+
+def _append(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+class StreamedOutput:
+    """
+    Output of a command run with ShellService.run_shell_command.
+    The last output_limit bytes are kept and sent to Major Tom as the command's output at most every
+    update_interval seconds while it runs. Once there's more output than that, all of it is also
+    spooled to a file in spool_directory, so it can be uploaded to Major Tom in full when the command finishes.
+    """
+
+    def __init__(self, gateway, command_id, description, output_limit=None, update_interval=None, spool_directory=None):
+        self.gateway = gateway
+        self.command_id = command_id
+        self.description = description
+        self.output_limit = output_limit if output_limit is not None else _output_limit
+        self.update_interval = update_interval if update_interval is not None else _update_interval
+        self.spool_directory = spool_directory if spool_directory is not None else _spool_directory
+        self.tail = bytearray()
+        self.unspooled = bytearray()  # Output not written to the spool file yet
+        self.total = 0
+        self.spool_path = None
+        self.changed = asyncio.Event()
+
+    async def write(self, data):
+        self.total += len(data)
+        self.tail += data
+        del self.tail[:max(len(self.tail) - self.output_limit, 0)]
+        self.unspooled += data
+        if self.total > self.output_limit:
+            if self.spool_path is None:
+                if self.spool_directory:
+                    await executor.run_blocking(os.makedirs, self.spool_directory, exist_ok=True)
+                self.spool_path = os.path.join(self.spool_directory, f"shell-output-{uuid.uuid4()}.tmp")
+            if len(self.unspooled) >= self.output_limit:
+                await self.spool()
+        self.changed.set()
+
+    async def spool(self):
+        data, self.unspooled = bytes(self.unspooled), bytearray()
+        await executor.run_blocking(_append, self.spool_path, data)
+
+    async def finish(self):
+        """Writes what's left to the spool file, if there is one"""
+        if self.spool_path is not None and self.unspooled:
+            await self.spool()
+        self.unspooled = bytearray()
+
+    @property
+    def text(self):
+        # The tail can start partway through a character, which is replaced
+        text = self.tail.decode("utf-8", errors="replace")
+        if self.total > len(self.tail):
+            return f"[Showing the last {len(self.tail)} of {self.total} bytes]\n{text}"
+        return text
+
+    async def send_updates(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            await self.gateway.transmit_command_update(
+                command_id=self.command_id,
+                state="executing_on_system",
+                dict={"status": f"{self.description} ({self.total} bytes of output)", "output": self.text})
+            await asyncio.sleep(self.update_interval)
+
+
 class ShellService:
-    def __init__(self, port, shell_client_path):
+    def __init__(self, port, shell_client_path, file_list_mode="stat"):
+        if file_list_mode not in FILE_LIST_MODES:
+            raise ValueError(f"file_list_mode must be one of {FILE_LIST_MODES}, not: {file_list_mode}")
         self.port = str(port)
         self.shell_client_path = shell_client_path
+        self.file_list_mode = file_list_mode
+        self.timeout_form = None  # How the satellite's timeout command is called, once it's been probed
 
     def build(self, kubos_sat):
         success = check_client(client_path=self.shell_client_path,
                                service_name="shell-service")
         if not success:
             return
+        kubos_sat.definitions["run_shell_command"] = {
+            "display_name": "Run Shell Command",
+            "description": "Runs a command on the spacecraft with the KubOS Shell Service and shows its output as it's produced. Commands still running after timeout seconds, such as log tails, are stopped on the spacecraft. A timeout of 0 lets them run until they exit. Output too long to show is uploaded as a file.",
+            "tags": ["Shell"],
+            "fields": [
+                {"name": "command", "type": "string"},
+                {"name": "timeout", "type": "number", "default": _command_timeout}
+            ]
+        }
         if kubos_sat.file_list_directories is None:
             logger.warn(
                 "File List Directories are undefined. Skipping command definitions that require file list directories to resolve.")
@@ -29,91 +144,347 @@ class ShellService:
         file_list_directories.append("All Directories")
         kubos_sat.definitions["update_file_list"] = {
             "display_name": "Update File List",
-            "description": "Update the list of files in one or all downlink directories using the KubOS Shell Service",
+            "description": "Update the list of files in one or all downlink directories using the KubOS Shell Service. Only new or changed files are sent, unless full_list is set to yes.",
             "tags": ["File Transfer"],
             "fields": [
                 {"name": "directory_to_update", "type": "string", "default": "All Directories",
-                    "range": file_list_directories}
+                    "range": file_list_directories},
+                {"name": "full_list", "type": "string", "range": ["yes", "no"], "default": "no"}
             ]
         }
 
-    def update_file_list(self, kubos_sat, gateway, command):
+    async def update_file_list(self, kubos_sat, gateway, command):
         if command.fields["directory_to_update"] == "All Directories":
             directories = kubos_sat.file_list_directories
         else:
             directories = [command.fields["directory_to_update"]]
 
+        files, removed, unchanged, failed = await self.sync_file_list(
+            kubos_sat=kubos_sat,
+            gateway=gateway,
+            directories=directories,
+            full=command.fields.get("full_list", "no") == "yes")
+        output = f"File list updated with {len(files)} new or changed files from directories: {[directory for directory in directories if directory not in failed]}. Unchanged directories: {unchanged}. Files removed from the satellite: {removed}"
+        if failed:
+            await gateway.fail_command(
+                command_id=command.id,
+                errors=[f"Failed to list {directory}: {failure}" for directory, failure in failed.items()] + [output])
+            return
+        await gateway.complete_command(
+            command_id=command.id,
+            output=output)
+
+    async def sync_file_list(self, kubos_sat, gateway, directories, full=False):
+        """
+        Lists each directory and sends Major Tom only the files that were added or changed since the last listing.
+        Directories whose listing is unchanged aren't parsed at all.
+        Major Tom has no way to remove files from the list, so removed files are only counted.
+        Returns the files sent, the number removed, the unchanged directories and why any directories couldn't be listed.
+        """
         files = []
+        removed = 0
+        unchanged = []
+        failed = {}
+        snapshots = {}
+        if self.file_list_mode == "stat":
+            listings = await self.stat_directories(ip=kubos_sat.ip, directories=directories)
+            parse = parse_stat_output
+        else:
+            listings = await self.ls_directories(ip=kubos_sat.ip, directories=directories)
+            parse = parse_ls_output
+
         for directory in directories:
-            output = self.shell_client(ip=kubos_sat.ip, command=f"ls -lp {directory}")
+            file_output, failure = listing_failure(listings.get(directory, ""))
+            if failure is not None:
+                # Its files are kept as they were rather than replaced by an empty listing
+                logger.warning(f"Failed to list {directory} on the satellite: {failure}")
+                failed[directory] = failure
+                continue
+            output_digest = hashlib.sha1(file_output.encode()).hexdigest()
+            snapshot = kubos_sat.file_list_snapshots.get(directory)
+            if snapshot is not None and snapshot["digest"] == output_digest and not full:
+                unchanged.append(directory)
+                continue
+
+            previous = snapshot["files"] if snapshot is not None else {}
+            current = {}
+            for file in parse(directory=directory, file_output=file_output):
+                current[file["name"]] = (file["size"], file["timestamp"])
+                if full or previous.get(file["name"]) != current[file["name"]]:
+                    files.append(file)
+            removed += len(previous.keys() - current.keys())
+            snapshots[directory] = {"digest": output_digest, "files": current}
+
+        if files:
+            await gateway.update_file_list(system=kubos_sat.name, files=files)
+        # Only once Major Tom has the files, so they're sent again next time if that failed
+        kubos_sat.file_list_snapshots.update(snapshots)
+        return files, removed, unchanged, failed
+
+    async def run_shell_command(self, kubos_sat, gateway, command):
+        shell_command = command.fields["command"]
+        timeout = command.fields.get("timeout")
+        timeout = float(_command_timeout if timeout is None else timeout)
+        if timeout < 0:
+            raise CommandError(command=command, message=f"The timeout can't be negative: {timeout:g}")
+        remote_command = shell_command
+        client_timeout = None
+        if timeout:
+            # The satellite stops the command itself, since killing the shell client here leaves it running there.
+            # The client is only killed if the satellite doesn't stop it in time.
+            remote_command = await self.timeout_prefix(ip=kubos_sat.ip, seconds=timeout) + f"sh -c {shlex.quote(shell_command)}"
+            client_timeout = math.ceil(timeout) + TIMEOUT_GRACE
+        guard = self.guard(ip=kubos_sat.ip)
+        guard.check()
+        output = StreamedOutput(gateway=gateway, command_id=command.id, description=f"Running: {shell_command}")
+        await gateway.transmit_command_update(
+            command_id=command.id,
+            state="executing_on_system",
+            dict={"status": f"Running: {shell_command}"})
+        updates = asyncio.ensure_future(output.send_updates())
+        start = time.monotonic()
+        try:
+            try:
+                returncode = await asyncio.wait_for(
+                    executor.stream_subprocess(
+                        [self.shell_client_path, "-i", kubos_sat.ip, "-p", self.port, "run", "-c", remote_command],
+                        output_callback=output.write),
+                    timeout=client_timeout)
+                if returncode != 0 and timeout and time.monotonic() - start >= timeout:
+                    # Stopped by timeout on the satellite
+                    returncode = None
+            except asyncio.TimeoutError:
+                # Expected for commands that don't exit on their own, so it doesn't count towards the breaker
+                returncode = None
+            except OSError as e:
+                guard.record_failure(e)
+                raise
+            guard.record_success()
+            await output.finish()
+        except BaseException:
+            if output.spool_path is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(output.spool_path)
+            raise
+        finally:
+            updates.cancel()
+
+        result = output.text
+        if output.spool_path is not None:
+            filename = f"shell-output-{command.id}.txt"
+            try:
+                await major_tom.upload_downlinked_file(
+                    gateway=gateway,
+                    filename=filename,
+                    filepath=output.spool_path,
+                    system=kubos_sat.name,
+                    timestamp=time.time()*1000,
+                    content_type="text/plain",
+                    command_id=command.id,
+                    metadata={"command": shell_command})
+            finally:
+                os.remove(output.spool_path)
+            result += f"\n[Full output of {output.total} bytes uploaded to Major Tom as {filename}]"
+        if returncode is None:
+            await gateway.complete_command(
+                command_id=command.id,
+                output=f"{result}\n[Stopped after {timeout:g}s]")
+        elif returncode == 0:
+            await gateway.complete_command(command_id=command.id, output=result)
+        else:
+            await gateway.fail_command(
+                command_id=command.id,
+                errors=[f"Shell command exited with status {returncode}", result])
+
+    async def ls_directories(self, ip: str, directories):
+        """
+        Lists each directory with "ls -lp", one shell client call per directory.
+        A listing that fails ends with a line starting with "!", which listing_failure splits off.
+        """
+        listings = {}
+        for directory in directories:
+            output = await self.long_shell_client(
+                ip=ip, command=f'ls -lp {directory} || echo "!ls exited with status $?"')
             logger.debug(f"Command: {output.args}")
             logger.debug(f"Shell Client Output: \n{output.stdout.decode('ascii')}")
+            listings[directory] = output.stdout.decode("ascii")
+        return listings
 
-            # TODO: Check that the shell service actually responded. Currently the client gives no way to differentiate between no files being in the directory and a timeout occurring.
-
-            file_output = output.stdout.decode("ascii")
-
-            # Each line is a line of output from the command response
-            output_list = file_output.split('\n')
-
-            for line in output_list:
-                # Split each line into sections
-                line_list = line.split(" ")
-
-                # Throw out spaces and empty fields
-                file_info_list = []
-                for field in line_list:
-                    if field not in ["", " "]:
-                        file_info_list.append(field)
-
-                # Make sure it's a output line
-                if len(file_info_list) < 9:
-                    continue
-
-                # Throw out Directories
-                if file_info_list[-1][-1] == "/":
-                    continue
-
-                # Reassemble filename
-                filename = ""
-                for filename_part in file_info_list[8:]:
-                    # Add Spaces back in (doesn't work if there were 2 spaces in the filename)
-                    filename += filename_part + " "
-                filename = filename[:-1]  # Remove Trailing Space
-
-                # Commonize file timestamp string
-                if len(file_info_list[7]) == 4:
-                    string_time = "00:00" + file_info_list[5] + \
-                        '{:0>2}'.format(file_info_list[6]) + file_info_list[7]
-                else:
-                    string_time = file_info_list[7] + file_info_list[5] + \
-                        '{:0>2}'.format(file_info_list[6]) + str(datetime.datetime.now().year)
-
-                # Strip time and get datetime object
-                timestamp = (datetime.datetime.strptime(string_time, "%H:%M%b%d%Y") -
-                             datetime.datetime.utcfromtimestamp(0)).total_seconds()*1000
-
-                if timestamp == 0:
-                    timestamp = 1  # Timestamp cannot be 0 for Major Tom
-
-                # Append File
-                files.append({
-                    "name": directory+filename,
-                    "size": int(file_info_list[4]),
-                    "timestamp": timestamp,
-                    "metadata": {"full ls line": line, "directory": directory, "filename": filename}
-                })
-
-        asyncio.ensure_future(gateway.update_file_list(system=kubos_sat.name, files=files))
-        asyncio.ensure_future(gateway.complete_command(
-            command_id=command.id,
-            output=f"File list updated with {len(files)} files from directories: {directories}"))
+    async def stat_directories(self, ip: str, directories):
+        """
+        Lists all the directories in a single shell client call.
+        Each directory's section starts with a "#<directory>" line, followed by a
+        "<file type>|<size>|<epoch mtime>|<path>" line per entry. The path is the last field,
+        so filenames containing the delimiter or repeated spaces are kept intact.
+        find passes the entries to stat in batches that fit the argument limit, however many there are,
+        and prints nothing for an empty directory. If listing a directory fails, such as when it's missing
+        or can't be read, its section ends with a line starting with "!", which listing_failure splits off.
+        """
+        script = "; ".join(
+            f"echo {shlex.quote('#' + directory)}; "
+            f"find {shlex.quote(directory)} -maxdepth 1 -mindepth 1 -exec stat -c '%F|%s|%Y|%n' {{}} + "
+            f'|| echo "!find exited with status $?"'
+            for directory in directories)
+        output = await self.long_shell_client(ip=ip, command=script)
+        logger.debug(f"Command: {output.args}")
+        # Filenames aren't guaranteed to be ASCII
+        return split_stat_output(output.stdout.decode("utf-8", errors="replace"))
+
+    async def stat(self, ip: str, path: str):
+        """Returns the size and modification time of a file on the satellite, or None if it doesn't exist"""
+        output = await self.shell_client(ip=ip, command=f"stat -c '%s %Y' {shlex.quote(path)}")
+        try:
+            size, mtime = output.stdout.decode("ascii").split()
+            return ("stat", int(size), int(mtime))
+        except ValueError:
+            return None
+
+    async def timeout_prefix(self, ip: str, seconds):
+        """
+        What to put in front of a command so the satellite stops it after seconds, rounded up.
+        The first call probes which form of timeout the satellite has. It's empty if the satellite has none.
+        """
+        if self.timeout_form is None:
+            output = await self.shell_client(ip=ip, command=TIMEOUT_PROBE)
+            self.timeout_form = output.stdout.decode("ascii", errors="replace").strip()
+            if not self.timeout_form:
+                logger.warning(
+                    f"The satellite at {ip} has no timeout command, so commands that time out keep running there")
+        if self.timeout_form == "positional":
+            return f"timeout {math.ceil(seconds)} "
+        if self.timeout_form == "busybox":
+            return f"timeout -t {math.ceil(seconds)} "
+        return ""
+
+    def guard(self, ip: str):
+        return breakers.shell_client_guard(
+            ip=ip, port=self.port, probe=lambda: self._run_shell_client(ip=ip, command="true"))
 
-    def shell_client(self, ip: str, command: str):
-        return subprocess.run([
+    async def shell_client(self, ip: str, command: str):
+        # A command that fails on the satellite is a reply from the service, so only hangs and a client that
+        # can't run count towards the breaker
+        return await self.guard(ip=ip).call(lambda: self._run_shell_client(ip=ip, command=command), failures=(OSError,))
+
+    async def long_shell_client(self, ip: str, command: str):
+        """
+        Like shell_client, for commands whose run time depends on their input, such as compressing a file.
+        They're given the longest shell deadline rather than the adaptive one, and missing it doesn't count towards the breaker.
+        """
+        guard = self.guard(ip=ip)
+        guard.check()
+        try:
+            output = await asyncio.wait_for(
+                self._run_shell_client(ip=ip, command=command), timeout=guard.deadline.maximum)
+        except asyncio.TimeoutError:
+            raise ServiceTimeoutError(service=guard.name, deadline=guard.deadline.maximum) from None
+        except OSError as e:
+            guard.record_failure(e)
+            raise
+        guard.record_success()
+        return output
+
+    async def _run_shell_client(self, ip, command):
+        return await executor.run_subprocess([
             self.shell_client_path,
             "-i", ip,
             "-p", self.port,
             "run",
             "-c", command],
-            capture_output=True, check=True)
+            check=True)
+
+
+def parse_ls_output(directory, file_output):
+    """Parses the output of "ls -lp" into Major Tom file list entries"""
+    files = []
+    # Each line is a line of output from the command response
+    output_list = file_output.split('\n')
+
+    for line in output_list:
+        # Split each line into sections
+        line_list = line.split(" ")
+
+        # Throw out spaces and empty fields
+        file_info_list = []
+        for field in line_list:
+            if field not in ["", " "]:
+                file_info_list.append(field)
+
+        # Make sure it's a output line
+        if len(file_info_list) < 9:
+            continue
+
+        # Throw out Directories
+        if file_info_list[-1][-1] == "/":
+            continue
+
+        # Reassemble filename
+        filename = ""
+        for filename_part in file_info_list[8:]:
+            # Add Spaces back in (doesn't work if there were 2 spaces in the filename)
+            filename += filename_part + " "
+        filename = filename[:-1]  # Remove Trailing Space
+
+        # Commonize file timestamp string
+        if len(file_info_list[7]) == 4:
+            string_time = "00:00" + file_info_list[5] + \
+                '{:0>2}'.format(file_info_list[6]) + file_info_list[7]
+        else:
+            string_time = file_info_list[7] + file_info_list[5] + \
+                '{:0>2}'.format(file_info_list[6]) + str(datetime.datetime.now().year)
+
+        # Strip time and get datetime object
+        timestamp = (datetime.datetime.strptime(string_time, "%H:%M%b%d%Y") -
+                     datetime.datetime.utcfromtimestamp(0)).total_seconds()*1000
+
+        if timestamp == 0:
+            timestamp = 1  # Timestamp cannot be 0 for Major Tom
+
+        # Append File
+        files.append({
+            "name": directory+filename,
+            "size": int(file_info_list[4]),
+            "timestamp": timestamp,
+            "metadata": {"full ls line": line, "directory": directory, "filename": filename}
+        })
+    return files
+
+
+def listing_failure(file_output):
+    """
+    Splits the failure line off the end of a directory's listing.
+    Returns the listing without it, and the failure, or None if the directory was listed.
+    """
+    listing, _, last_line = file_output.rstrip("\n").rpartition("\n")
+    if last_line.startswith("!"):
+        return listing, last_line[1:]
+    return file_output, None
+
+
+def split_stat_output(file_output):
+    """Splits the output of ShellService.stat_directories into each directory's section"""
+    sections = {}
+    for section in ("\n" + file_output).split("\n#")[1:]:
+        directory, _, listing = section.partition("\n")
+        sections[directory] = listing
+    return sections
+
+
+def parse_stat_output(directory, file_output):
+    """Parses one directory's section of ShellService.stat_directories output into Major Tom file list entries"""
+    files = []
+    prefix_length = len(directory)
+    for line in file_output.splitlines():
+        fields = line.split("|", 3)
+        # Skips directories, links and anything that isn't a complete line
+        if len(fields) != 4 or not fields[0].startswith("regular"):
+            continue
+        # Timestamp cannot be 0 for Major Tom
+        timestamp = int(fields[2]) * 1000 or 1
+        filename = fields[3][prefix_length:]
+        files.append({
+            "name": fields[3],
+            "size": int(fields[1]),
+            "timestamp": timestamp,
+            "metadata": {"directory": directory, "filename": filename}
+        })
+    return files
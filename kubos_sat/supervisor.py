@@ -0,0 +1,258 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import time
+from kubos_sat import executor
+from kubos_sat import metrics
+from kubos_sat.command_updates import TERMINAL_STATES
+from kubos_sat.worker import Connection, STREAM_LIMIT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESTART_DELAY = 1
+DEFAULT_MAX_RESTART_DELAY = 60
+DEFAULT_REBALANCE_INTERVAL = 60
+REMOVE_TIMEOUT = 30
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class WorkerProcess:
+    """
+    A worker process and the satellites assigned to it. The process is restarted whenever it exits,
+    waiting twice as long after each crash, up to max_restart_delay.
+    *.satellites holds the satellite tables of the gateway config assigned to it, by name.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.name = f"worker-{index}"
+        self.satellites = {}
+        self.process = None
+        self.connection = None
+        self.restarts = 0
+        self.last_report = None
+        self.removals = {}  # Futures waiting for the process to stop serving a satellite, by name
+        metrics.gauge("worker_up", lambda: int(self.connection is not None), worker=self.name)
+
+    @property
+    def up(self):
+        return self.connection is not None
+
+    async def run(self):
+        delay = self.supervisor.restart_delay
+        while True:
+            started = time.monotonic()
+            returncode = await self.run_once()
+            if time.monotonic() - started > self.supervisor.max_restart_delay:
+                delay = self.supervisor.restart_delay
+            logger.warning(f"{self.name} exited with status {returncode}. Restarting it in {delay}s")
+            self.restarts += 1
+            metrics.increment("worker_restarts", worker=self.name)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.supervisor.max_restart_delay)
+
+    async def run_once(self):
+        """Runs the process until it exits, and returns its exit status"""
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(filter(None, [PACKAGE_ROOT, environment.get("PYTHONPATH")]))
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "kubos_sat.worker",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=environment,
+            limit=STREAM_LIMIT)
+        logger.info(f"Started {self.name} with pid {self.process.pid} for {', '.join(self.satellites)}")
+        connection = Connection(self.process.stdout, self.process.stdin)
+        try:
+            await connection.send(dict(self.supervisor.worker_settings, index=self.index))
+            for satellite_config in self.satellites.values():
+                await connection.send({"type": "add", "satellite": satellite_config})
+            self.connection = connection
+            while True:
+                message = await connection.receive()
+                if message is None:
+                    break
+                await self.supervisor.handle_message(self, message)
+        except ConnectionError as e:
+            logger.warning(f"Lost the connection to {self.name}: {type(e).__name__}: {e}")
+        finally:
+            self.connection = None
+            self.supervisor.worker_stopped(self)
+            if self.process.returncode is None and self.process.stdin is not None:
+                self.process.stdin.close()
+        return await self.process.wait()
+
+    async def remove(self, name):
+        """Stops the process from serving a satellite, and waits until it has"""
+        self.removals[name] = asyncio.get_running_loop().create_future()
+        try:
+            await self.connection.send({"type": "remove", "name": name})
+            await asyncio.wait_for(self.removals[name], timeout=REMOVE_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            logger.warning(f"{self.name} didn't confirm it stopped serving {name}: {type(e).__name__}")
+        finally:
+            del self.removals[name]
+
+    def health(self):
+        return {
+            "name": self.name,
+            "pid": self.process.pid if self.process is not None else None,
+            "up": self.up,
+            "restarts": self.restarts,
+            "satellites": sorted(self.satellites),
+            "commands_in_flight": sum(1 for name in self.supervisor.in_flight.values() if name in self.satellites),
+            "seconds_since_report": None if self.last_report is None else round(time.monotonic() - self.last_report, 1)}
+
+
+class Supervisor:
+    """
+    Spreads the satellites across a pool of worker processes, so a large constellation isn't limited to one core.
+    The supervisor holds the only connection to Major Tom. It routes each command to the worker serving the
+    command's system, and sends on the messages workers pass back. Workers that exit are restarted, and every
+    rebalance_interval the busiest idle satellite is moved from the busiest worker to the least busy one.
+    """
+
+    def __init__(self, satellite_configs, worker_settings, workers=None, restart_delay=DEFAULT_RESTART_DELAY,
+                 max_restart_delay=DEFAULT_MAX_RESTART_DELAY, rebalance_interval=DEFAULT_REBALANCE_INTERVAL):
+        # Settings every worker is started with: the Major Tom host and credentials, log level and gateway config
+        self.worker_settings = worker_settings
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.rebalance_interval = rebalance_interval
+        worker_count = min(workers or os.cpu_count() or 1, len(satellite_configs))
+        self.workers = [WorkerProcess(supervisor=self, index=index) for index in range(worker_count)]
+        self.assignments = {}  # Worker serving each satellite, by name
+        self.ready = {}  # Set while the satellite's worker is serving it, by name
+        for index, satellite_config in enumerate(satellite_configs):
+            worker = self.workers[index % worker_count]
+            worker.satellites[satellite_config["name"]] = satellite_config
+            self.assignments[satellite_config["name"]] = worker
+            self.ready[satellite_config["name"]] = asyncio.Event()
+        self.in_flight = {}  # Satellite resolving each command, by command id
+        self.command_counts = collections.Counter()  # Commands per satellite since the last rebalance
+        self.gateway = None
+        self.tasks = []
+        self.failures = set()  # Commands of stopped workers being failed
+        metrics.gauge("commands_in_flight", lambda: len(self.in_flight))
+
+    def start(self, gateway):
+        self.gateway = gateway
+        self.tasks = [asyncio.ensure_future(worker.run()) for worker in self.workers]
+        self.tasks.append(asyncio.ensure_future(self.rebalance_periodically()))
+
+    def satellite_for(self, system):
+        if len(self.assignments) == 1:
+            return next(iter(self.assignments))
+        return system if system in self.assignments else None
+
+    async def command_callback(self, command, gateway):
+        name = self.satellite_for(command.system)
+        if name is None:
+            await gateway.fail_command(
+                command_id=command.id,
+                errors=[f"System: {command.system} is not served by this gateway. Satellites served: {list(self.assignments)}"])
+            return
+        self.command_counts[name] += 1
+        # Waits while the satellite's worker is restarting or it's being moved to another worker
+        await self.ready[name].wait()
+        self.in_flight[command.id] = name
+        try:
+            await self.assignments[name].connection.send({"type": "command", "command": command.json_command})
+        except ConnectionError:
+            # The worker exited before the command reached it
+            if self.in_flight.pop(command.id, None) is not None:
+                await gateway.fail_command(
+                    command_id=command.id, errors=[f"Gateway worker serving {name} stopped before it received the command"])
+
+    async def cancel_callback(self, command_id, gateway):
+        name = self.in_flight.get(command_id)
+        if name is not None and self.ready[name].is_set():
+            try:
+                await self.assignments[name].connection.send({"type": "cancel", "id": command_id})
+                return
+            except ConnectionError:
+                pass
+        await gateway.cancel_command(command_id=command_id)
+
+    async def handle_message(self, worker, message):
+        if message["type"] == "transmit":
+            payload = message["payload"]
+            if payload.get("type") == "command_update" and payload["command"]["state"] in TERMINAL_STATES:
+                self.in_flight.pop(payload["command"]["id"], None)
+            await self.gateway.transmit(payload)
+        elif message["type"] == "added":
+            if self.assignments.get(message["name"]) is worker:
+                self.ready[message["name"]].set()
+        elif message["type"] == "removed":
+            if message["name"] in worker.removals:
+                worker.removals[message["name"]].set_result(None)
+        elif message["type"] == "report":
+            worker.last_report = time.monotonic()
+            metrics.registry.children[worker.name] = metrics.Registry.from_snapshot(message["metrics"], worker=worker.name)
+        else:
+            logger.warning(f"Unknown message type from {worker.name}: {message['type']}")
+
+    def worker_stopped(self, worker):
+        """Holds new commands for the worker's satellites until it's back, and fails the ones it was resolving"""
+        metrics.registry.children.pop(worker.name, None)
+        for name in worker.satellites:
+            self.ready[name].clear()
+        for command_id, name in list(self.in_flight.items()):
+            if name in worker.satellites:
+                del self.in_flight[command_id]
+                executor.run_in_background(
+                    self.gateway.fail_command(
+                        command_id=command_id, errors=[f"Gateway worker serving {name} stopped while resolving the command"]),
+                    tasks=self.failures, description=f"fail command {command_id}")
+
+    async def move(self, name, destination):
+        source = self.assignments[name]
+        logger.info(f"Moving {name} from {source.name} to {destination.name}")
+        self.ready[name].clear()
+        satellite_config = source.satellites.pop(name)
+        if source.up:
+            await source.remove(name)
+        destination.satellites[name] = satellite_config
+        self.assignments[name] = destination
+        if destination.up:
+            await destination.connection.send({"type": "add", "satellite": satellite_config})
+        # Otherwise the satellite is added when the destination restarts
+
+    async def rebalance(self):
+        """
+        Moves the satellite that would best even out the commands each worker received since the last rebalance
+        from the busiest worker to the least busy one. Only satellites with no commands in flight are moved.
+        """
+        counts, self.command_counts = self.command_counts, collections.Counter()
+        workers = [worker for worker in self.workers if worker.up]
+        if len(workers) < 2:
+            return
+        load = {worker: sum(counts[name] for name in worker.satellites) for worker in workers}
+        busiest = max(workers, key=load.get)
+        least_busy = min(workers, key=load.get)
+        gap = load[busiest] - load[least_busy]
+        busy = set(self.in_flight.values())
+        candidates = [
+            name for name in busiest.satellites
+            if 0 < counts[name] < gap and name not in busy and self.ready[name].is_set()]
+        if candidates:
+            await self.move(max(candidates, key=counts.get), destination=least_busy)
+
+    async def rebalance_periodically(self):
+        while True:
+            await asyncio.sleep(self.rebalance_interval)
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.warning(f"Failed to rebalance satellites: {type(e).__name__}: {e}")
+
+    def health(self):
+        return {
+            "connected": self.gateway is not None and self.gateway.websocket is not None,
+            "workers": [worker.health() for worker in self.workers],
+            "satellites": {
+                name: {"worker": worker.name, "ready": self.ready[name].is_set()}
+                for name, worker in self.assignments.items()}}
@@ -0,0 +1,154 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+from kubos_sat import graphql
+from kubos_sat import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 10
+DEFAULT_JITTER = 0.1
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1
+
+
+def flatten(value, path=""):
+    """Yields (metric name, value) for every numeric leaf of a GraphQL result"""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            yield from flatten(child, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for index, child in enumerate(value):
+            yield from flatten(child, f"{path}.{index}" if path else str(index))
+    elif isinstance(value, bool):
+        yield path, int(value)
+    elif isinstance(value, (int, float)):
+        yield path, value
+
+
+class MeasurementQueue:
+    """
+    Bounded queue of measurements waiting to be sent to Major Tom.
+    When it's full, new values replace the queued values of the same metric so only the latest
+    is sent. Pollers of metrics that aren't queued yet wait until there is room.
+    """
+
+    def __init__(self, max_size=DEFAULT_QUEUE_SIZE):
+        self.max_size = max_size
+        self.series = collections.OrderedDict()
+        self.size = 0
+        self.coalesced = 0
+        self.changed = asyncio.Condition()
+
+    async def put(self, measurement):
+        key = (measurement["system"], measurement["subsystem"], measurement["metric"])
+        async with self.changed:
+            if self.size >= self.max_size and key in self.series:
+                self.coalesced += len(self.series[key])
+                self.size -= len(self.series[key])
+                self.series[key] = [measurement]
+                self.size += 1
+                return
+            await self.changed.wait_for(lambda: self.size < self.max_size)
+            self.series.setdefault(key, []).append(measurement)
+            self.size += 1
+            self.changed.notify_all()
+
+    async def take(self, max_count):
+        """Waits for measurements, then removes and returns up to max_count of them"""
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.size > 0)
+            measurements = []
+            while self.series and len(measurements) < max_count:
+                key, queued = next(iter(self.series.items()))
+                count = max_count - len(measurements)
+                measurements.extend(queued[:count])
+                if count >= len(queued):
+                    del self.series[key]
+                else:
+                    self.series[key] = queued[count:]
+            self.size -= len(measurements)
+            self.changed.notify_all()
+            return measurements
+
+
+class TelemetryService:
+    """
+    Polls telemetry queries from the KubOS GraphQL services and pushes the results
+    to Major Tom as measurements.
+    *.definitions is a list of dicts from the "telemetry" section of the gateway config
+    """
+
+    def __init__(self, kubos_sat, gateway, definitions, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.kubos_sat = kubos_sat
+        self.gateway = gateway
+        self.definitions = definitions
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = MeasurementQueue(max_size=queue_size)
+        metrics.gauge("telemetry_queue_depth", lambda: self.queue.size, satellite=kubos_sat.name)
+        self.tasks = []
+
+    def start(self):
+        for definition in self.definitions:
+            service = definition["service"]
+            if service not in self.kubos_sat.config:
+                logger.warning(
+                    f"Telemetry service {service} is not in the KubOS config. Skipping its telemetry query.")
+                continue
+            self.tasks.append(asyncio.ensure_future(self.poll(definition)))
+        if self.tasks:
+            self.tasks.append(asyncio.ensure_future(self.publish()))
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def poll(self, definition):
+        service = definition["service"]
+        subsystem = definition.get("subsystem", service)
+        interval = definition.get("interval", DEFAULT_INTERVAL)
+        jitter = definition.get("jitter", DEFAULT_JITTER)
+        port = self.kubos_sat.config[service]["addr"]["port"]
+
+        # Spread out the first polls so services configured with the same interval don't all fire at once
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            try:
+                result = await graphql.query_with_validation(
+                    query=definition["query"], ip=self.kubos_sat.ip, port=port)
+                timestamp = int(time.time() * 1000)
+                for metric, value in flatten(result["data"]):
+                    await self.queue.put({
+                        "system": self.kubos_sat.name,
+                        "subsystem": subsystem,
+                        "metric": metric,
+                        "value": value,
+                        "timestamp": timestamp})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Telemetry query to {service} failed: {type(e).__name__}: {e}")
+            await asyncio.sleep(interval * random.uniform(1 - jitter, 1 + jitter))
+
+    async def publish(self):
+        while True:
+            measurements = await self.queue.take(self.batch_size)
+            try:
+                with metrics.timed("major_tom", call="transmit_metrics"):
+                    await self.gateway.transmit_metrics(metrics=measurements)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to transmit {len(measurements)} measurements: {type(e).__name__}: {e}")
+            if self.queue.coalesced:
+                logger.info(
+                    f"Major Tom link is behind. Replaced {self.queue.coalesced} queued measurements with newer values.")
+                self.queue.coalesced = 0
+            # Lets measurements accumulate into larger batches between sends
+            await asyncio.sleep(self.flush_interval)
@@ -1,19 +1,68 @@
+import asyncio
+import os
 import subprocess
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Probe results keyed by client path, modification time and size, so unchanged binaries are only probed once
+_client_checks = {}
+
+
+def _client_key(client_path):
+    try:
+        stat = os.stat(client_path)
+    except OSError:
+        return None
+    return (client_path, stat.st_mtime_ns, stat.st_size)
+
+
+def _log_client_error(service_name, e):
+    logger.error(
+        f"{service_name} client binary experienced an error, please verify it's built and in the location specified in the local gateway config. Error: {type(e)} {e.args}")
+
 
 def check_client(client_path, service_name):
     if client_path is None:
         logger.warn(
             f"No {service_name} client binary defined. Skipping command definitions that require the client to resolve.")
         return False
+    key = _client_key(client_path)
+    if key in _client_checks:
+        return _client_checks[key]
     try:
         output = subprocess.run([client_path, "--help"],
                                 capture_output=True, check=True)
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        logger.error(
-            f"{service_name} client binary experienced an error, please verify it's built and in the location specified in the local gateway config. Error: {type(e)} {e.args}")
-        return False
-    return True
+        _log_client_error(service_name, e)
+        success = False
+    else:
+        success = True
+    if key is not None:
+        _client_checks[key] = success
+    return success
+
+
+async def check_client_async(client_path, service_name):
+    """Same as check_client, but probes the binary without blocking the event loop"""
+    if client_path is None:
+        return check_client(client_path=client_path, service_name=service_name)
+    key = _client_key(client_path)
+    if key in _client_checks:
+        return _client_checks[key]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            client_path, "--help",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+        returncode = await process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, [client_path, "--help"])
+    except (subprocess.CalledProcessError, OSError) as e:
+        _log_client_error(service_name, e)
+        success = False
+    else:
+        success = True
+    if key is not None:
+        _client_checks[key] = success
+    return success
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+from majortom_gateway import GatewayAPI
+from majortom_gateway.command import Command
+from kubos_sat import configuration
+from kubos_sat import metrics
+from kubos_sat.constellation import Constellation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT_INTERVAL = 5
+STREAM_LIMIT = 2 ** 26  # Command definitions and file lists are sent as single messages
+
+
+class Connection:
+    """JSON messages between the supervisor and a worker process, one per line"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, message):
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        await self.writer.drain()
+
+    async def receive(self):
+        """Returns the next message, or None once the other end has closed the connection"""
+        line = await self.reader.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+
+class WorkerGateway(GatewayAPI):
+    """
+    Stands in for the Major Tom connection in a worker process. Messages for Major Tom are passed
+    to the supervisor, which sends them over its websocket. File transfers use Major Tom's HTTP API directly.
+    """
+
+    def __init__(self, connection, **kwargs):
+        super().__init__(**kwargs)
+        self.connection = connection
+
+    async def transmit(self, payload):
+        await self.connection.send({"type": "transmit", "payload": payload})
+
+
+class Worker:
+    """
+    Serves the satellites the supervisor assigns to this process. Satellites are added and removed
+    as the supervisor rebalances them, and the process exits when the supervisor closes its stdin.
+    """
+
+    def __init__(self, connection, gateway, gateway_config, name, report_interval=DEFAULT_REPORT_INTERVAL):
+        self.connection = connection
+        self.gateway = gateway
+        self.gateway_config = gateway_config
+        self.name = name
+        self.report_interval = report_interval
+        self.constellation = Constellation(satellites=[])
+        self.constellation.use_command_updates(configuration.build_command_updates(gateway_config, gateway=gateway))
+        self.transfer_scheduler = configuration.build_transfer_scheduler(gateway_config)
+        # Each process keeps its own uplink cache, since the cache index isn't shared between processes
+        self.uplink_cache = configuration.build_uplink_cache(gateway_config, subdirectory=name)
+        self.background_tasks = {}  # Started by configuration.start_background_tasks, by satellite name
+        self.finished = None
+
+    async def add(self, satellite_config):
+        name = satellite_config["name"]
+        satellite = configuration.build_satellite(
+            satellite_config=satellite_config,
+            gateway_config=self.gateway_config,
+            transfer_scheduler=self.transfer_scheduler,
+            uplink_cache=self.uplink_cache,
+            # Kept per satellite, so the cache still applies after it moves to another worker
+            own_downlink_cache=True)
+        satellite.command_updates = self.constellation.command_updates
+        self.constellation.satellites[name] = satellite
+        await satellite.prepare()
+        satellite.start(gateway=self.gateway)
+        self.background_tasks[name] = configuration.start_background_tasks(
+            satellite=satellite, satellite_config=satellite_config, gateway_config=self.gateway_config,
+            gateway=self.gateway)
+        logger.info(f"Serving {name}")
+        await self.connection.send({"type": "added", "name": name})
+
+    async def remove(self, name):
+        satellite = self.constellation.satellites.pop(name, None)
+        configuration.stop_background_tasks(self.background_tasks.pop(name, []))
+        if satellite is not None:
+            for task in satellite.running_commands.values():
+                task.cancel()
+        metrics.registry.forget(satellite=name)
+        logger.info(f"Stopped serving {name}")
+        await self.connection.send({"type": "removed", "name": name})
+
+    async def report_periodically(self):
+        """Sends the supervisor this process's metrics and the number of commands each satellite is running"""
+        while True:
+            await asyncio.sleep(self.report_interval)
+            await self.connection.send({
+                "type": "report",
+                "metrics": metrics.registry.snapshot(),
+                "running": {
+                    name: len(satellite.running_commands)
+                    for name, satellite in self.constellation.satellites.items()}})
+
+    def _run_in_background(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        task.add_done_callback(self._check_task)
+
+    def _check_task(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        # A satellite that can't be served leaves the process in an unknown state, so it exits to be restarted
+        logger.error(f"{self.name} failed: {type(task.exception()).__name__}: {task.exception()}")
+        if not self.finished.done():
+            self.finished.set_exception(task.exception())
+
+    async def receive_messages(self):
+        while True:
+            message = await self.connection.receive()
+            if message is None:
+                self.finished.set_result(None)
+                return
+            if message["type"] == "command":
+                self._run_in_background(self.constellation.command_callback(
+                    command=Command(message["command"]), gateway=self.gateway))
+            elif message["type"] == "cancel":
+                self._run_in_background(self.constellation.cancel_callback(
+                    command_id=message["id"], gateway=self.gateway))
+            elif message["type"] == "add":
+                self._run_in_background(self.add(message["satellite"]))
+            elif message["type"] == "remove":
+                self._run_in_background(self.remove(message["name"]))
+            else:
+                logger.warning(f"Unknown message type from the supervisor: {message['type']}")
+
+    async def run(self):
+        self.finished = asyncio.get_running_loop().create_future()
+        self.constellation.command_updates.start()
+        self._run_in_background(self.report_periodically())
+        receiving = asyncio.ensure_future(self.receive_messages())
+        try:
+            await self.finished
+        finally:
+            receiving.cancel()
+            await self.constellation.command_updates.stop()
+
+
+async def main(protocol_fd):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=STREAM_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(protocol_fd, "wb"))
+    connection = Connection(reader, asyncio.StreamWriter(transport, protocol, None, loop))
+
+    # The first message has the settings, so the gateway token isn't visible in the process list
+    settings = await connection.receive()
+    if settings is None:
+        return
+    name = f"worker-{settings['index']}"
+    logging.basicConfig(
+        level=settings["log_level"],
+        format=f'%(asctime)s - {name} - %(name)s - %(levelname)s - %(message)s')
+    configuration.configure_modules(settings["gateway_config"])
+    gateway = WorkerGateway(
+        connection=connection,
+        host=settings["host"],
+        gateway_token=settings["gateway_token"],
+        basic_auth=settings["basic_auth"],
+        http=settings["http"])
+    worker = Worker(
+        connection=connection,
+        gateway=gateway,
+        gateway_config=settings["gateway_config"],
+        name=name,
+        report_interval=settings.get("report_interval", DEFAULT_REPORT_INTERVAL))
+    await worker.run()
+
+
+if __name__ == "__main__":
+    # Messages to the supervisor use the original stdout. Anything else written to it goes to stderr with the logs.
+    protocol_fd = os.dup(1)
+    os.dup2(2, 1)
+    asyncio.run(main(protocol_fd))
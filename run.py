@@ -1,10 +1,14 @@
+import time
+startup_time = time.monotonic()
+
 import logging
 import asyncio
-import time
 import argparse
+import importlib
 import toml
-from majortom_gateway import GatewayAPI
-from kubos_sat import KubosSat
+from kubos_sat import executor
+from kubos_sat import configuration
+from kubos_sat.constellation import Constellation
 
 logger = logging.getLogger(__name__)
 
@@ -50,37 +54,64 @@ else:
 
 logger.debug("Loading Gateway Config")
 gateway_config = toml.load("gateway_config.local.toml")
+configuration.configure_modules(gateway_config)
+uplink_cache = configuration.build_uplink_cache(gateway_config)
 
 logger.info("Starting up!")
 loop = asyncio.get_event_loop()
 
-logger.debug("Setting up Satellite")
-satellite = KubosSat(
-    name=gateway_config["satellite"]["name"],
-    ip=gateway_config["satellite"]["ip"],
-    sat_config_path=gateway_config["satellite"]["config-path"],
-    file_client_path=gateway_config["client-binaries"]["file-client"],
-    shell_client_path=gateway_config["client-binaries"]["shell-client"],
-    file_list_directories=gateway_config["satellite"]["file-list-directories"],
-    default_uplink_dir=gateway_config["satellite"]["default-uplink-directory"])
-
-logger.debug("Setting up MajorTom")
-gateway = GatewayAPI(
-    host=args.majortomhost,
-    gateway_token=args.gatewaytoken,
-    basic_auth=args.basicauth,
-    command_callback=satellite.command_callback,
-    cancel_callback=satellite.cancel_callback,
-    http=args.http)
-
-logger.debug("Connecting to MajorTom")
-asyncio.ensure_future(gateway.connect_with_retries())
-
-logger.debug("Sending Command Definitions")
-satellite.build_command_definitions()
-asyncio.ensure_future(gateway.update_command_definitions(
-    system=satellite.name,
-    definitions=satellite.definitions))
+satellite_configs = configuration.satellite_configs(gateway_config)
+transfer_scheduler = configuration.build_transfer_scheduler(gateway_config)
+
+logger.debug("Setting up Satellites")
+satellites = [
+    configuration.build_satellite(
+        satellite_config=satellite_config,
+        gateway_config=gateway_config,
+        transfer_scheduler=transfer_scheduler,
+        uplink_cache=uplink_cache,
+        own_downlink_cache=len(satellite_configs) > 1)
+    for satellite_config in satellite_configs]
+constellation = Constellation(satellites=satellites)
+
+
+async def start_gateway():
+    logger.debug("Preparing Satellites")
+    preparation = constellation.prepare()
+
+    # majortom_gateway is slow to import, so it's imported while the satellites are being prepared
+    majortom_gateway = await executor.run_blocking(importlib.import_module, "majortom_gateway")
+
+    logger.debug("Setting up MajorTom")
+    gateway = majortom_gateway.GatewayAPI(
+        host=args.majortomhost,
+        gateway_token=args.gatewaytoken,
+        basic_auth=args.basicauth,
+        command_callback=constellation.command_callback,
+        cancel_callback=constellation.cancel_callback,
+        http=args.http)
+
+    constellation.use_command_updates(configuration.build_command_updates(gateway_config, gateway=gateway))
+    constellation.command_updates.start()
+
+    logger.debug("Connecting to MajorTom")
+    asyncio.ensure_future(gateway.connect_with_retries())
+
+    await preparation
+    logger.info(f"Ready for commands {time.monotonic() - startup_time:.2f}s after startup")
+
+    logger.debug("Sending Command Definitions and Retrieving Apps")
+    constellation.start(gateway=gateway)
+    return gateway
+
+
+gateway = loop.run_until_complete(start_gateway())
+
+for satellite, satellite_config in zip(satellites, satellite_configs):
+    configuration.start_background_tasks(
+        satellite=satellite, satellite_config=satellite_config, gateway_config=gateway_config, gateway=gateway)
+
+loop.run_until_complete(configuration.start_metrics(gateway_config, gateway=gateway, system=satellites[0].name))
 
 logger.debug("Starting Event Loop")
 loop.run_forever()
@@ -0,0 +1,93 @@
+import logging
+import asyncio
+import argparse
+import toml
+from majortom_gateway import GatewayAPI
+from kubos_sat import configuration
+from kubos_sat import supervisor
+from kubos_sat import worker
+
+logger = logging.getLogger(__name__)
+
+# Set up command line arguments
+parser = argparse.ArgumentParser(
+    description="Runs the gateway with its satellites spread across worker processes. Takes the same arguments as run.py.")
+# Required Args
+parser.add_argument(
+    "majortomhost",
+    help='Major Tom host name. Can also be an IP address for local development/on prem deployments.')
+parser.add_argument(
+    "gatewaytoken",
+    help='Gateway Token used to authenticate the connection. Look this up in Major Tom under the gateway page for the gateway you are trying to connect.')
+
+# Optional Args and Flags
+parser.add_argument(
+    '-b',
+    '--basicauth',
+    help='Basic Authentication credentials. Not required unless BasicAuth is active on the Major Tom instance. Must be in the format "username:password".')
+parser.add_argument(
+    '-l',
+    '--loglevel',
+    choices=["info", "error"],
+    help='Log level for the logger. Defaults to "debug", can be set to "info", or "error".')
+parser.add_argument(
+    '--http',
+    help="If included, you can instruct the gateway to connect without encryption. This is only to support on prem deployments or for local development when not using https.",
+    action="store_true")
+
+args = parser.parse_args()
+
+log_level = {"error": logging.ERROR, "info": logging.INFO}.get(args.loglevel, logging.DEBUG)
+logging.basicConfig(
+    level=log_level,
+    format='%(asctime)s - supervisor - %(name)s - %(levelname)s - %(message)s')
+
+logger.debug("Loading Gateway Config")
+gateway_config = toml.load("gateway_config.local.toml")
+supervisor_config = gateway_config.get("supervisor", {})
+satellite_configs = configuration.satellite_configs(gateway_config)
+
+logger.info("Starting up!")
+loop = asyncio.get_event_loop()
+
+
+async def start_supervisor():
+    gateway_supervisor = supervisor.Supervisor(
+        satellite_configs=satellite_configs,
+        worker_settings={
+            "host": args.majortomhost,
+            "gateway_token": args.gatewaytoken,
+            "basic_auth": args.basicauth,
+            "http": args.http,
+            "log_level": log_level,
+            "gateway_config": gateway_config,
+            "report_interval": supervisor_config.get("report-interval", worker.DEFAULT_REPORT_INTERVAL)},
+        workers=supervisor_config.get("workers"),
+        restart_delay=supervisor_config.get("restart-delay", supervisor.DEFAULT_RESTART_DELAY),
+        max_restart_delay=supervisor_config.get("max-restart-delay", supervisor.DEFAULT_MAX_RESTART_DELAY),
+        rebalance_interval=supervisor_config.get("rebalance-interval", supervisor.DEFAULT_REBALANCE_INTERVAL))
+
+    logger.debug("Setting up MajorTom")
+    gateway = GatewayAPI(
+        host=args.majortomhost,
+        gateway_token=args.gatewaytoken,
+        basic_auth=args.basicauth,
+        command_callback=gateway_supervisor.command_callback,
+        cancel_callback=gateway_supervisor.cancel_callback,
+        http=args.http)
+
+    logger.debug(f"Starting {len(gateway_supervisor.workers)} Workers")
+    gateway_supervisor.start(gateway=gateway)
+
+    logger.debug("Connecting to MajorTom")
+    asyncio.ensure_future(gateway.connect_with_retries())
+
+    await configuration.start_metrics(
+        gateway_config, gateway=gateway, system=satellite_configs[0]["name"], health=gateway_supervisor.health)
+    return gateway_supervisor
+
+
+gateway_supervisor = loop.run_until_complete(start_supervisor())
+
+logger.debug("Starting Event Loop")
+loop.run_forever()